@@ -0,0 +1,142 @@
+"""Measure the overhead of the crawl loop with a fake browser, Tor and capture.
+
+Usage: python3 bench/bench_crawl.py [--sites N] [--visits N] [--batches N]
+                                    [--playback S] [--bootstrap S]
+                                    [--browser-delay S] [--reuse-browser]
+                                    [--batch-capture MODE] [--pipeline]
+
+Runs `VideoCrawler.crawl` in process against the fakes in bench/fakes.py,
+with every playback compressed to --playback seconds, and reports the
+framework overhead per visit (the visit time outside playback), the
+phases it is spent in, the throughput and the memory growth. Nothing
+needs Tor, network access or root, so regressions in the orchestration
+code can be caught with a local run.
+"""
+import argparse
+import json
+import logging
+import os
+import resource
+import shutil
+import sys
+import tempfile
+from time import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import tbcrawler.common as cm  # noqa: E402
+import tbcrawler.crawler as crawler_mod  # noqa: E402
+import tbcrawler.pipeline  # noqa: E402
+import tbcrawler.splitter  # noqa: E402
+from tbcrawler.journal import CrawlJournal  # noqa: E402
+from tbcrawler.log import wl_log  # noqa: E402
+from fakes import (FakeBrowserWrapper, FakeTorController,  # noqa: E402
+                   FakeWebDriver, NullSniffer)
+
+PLATFORM_URLS = ('https://www.youtube.com/watch?v=bench%d',
+                 'https://vimeo.com/%d')
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def run(args, crawl_dir):
+    cm.CRAWL_DIR = crawl_dir
+    cm.LOGS_DIR = crawl_dir
+    # every visit plays for exactly --playback seconds
+    cm.MAX_PLAYBACK_TIME = args.playback
+    crawler_mod.Sniffer = NullSniffer
+    FakeWebDriver.delay = args.browser_delay
+
+    urls = [(PLATFORM_URLS[i % len(PLATFORM_URLS)] % i, 60)
+            for i in range(args.sites)]
+    config = {'visits': args.visits, 'batches': args.batches,
+              'pause_between_batches': 0, 'pause_between_videos': 0,
+              'pause_between_loads': 0}
+    journal = CrawlJournal(os.path.join(crawl_dir, cm.JOURNAL_FILENAME))
+    job = crawler_mod.CrawlJob(config, urls, 1, journal)
+    drivers = [FakeBrowserWrapper() for _ in range(2 if args.pipeline else 1)]
+    if args.reuse_browser:
+        for driver in drivers:
+            driver.enable_reuse(recycle_after=20)
+    controller = FakeTorController(args.bootstrap)
+    if args.pipeline:
+        crawler = tbcrawler.pipeline.PipelinedCrawler(
+            drivers, controller, screenshots=True,
+            batch_capture=args.batch_capture)
+    else:
+        crawler = crawler_mod.VideoCrawler(drivers[0], controller,
+                                           screenshots=True,
+                                           batch_capture=args.batch_capture)
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time()
+    crawler.crawl(job)
+    elapsed = time() - start
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if args.pipeline:
+        print("pipelining removed %.2f s of idle time (%.0f s per hour)"
+              % (crawler.idle_removed,
+                 3600 * crawler.idle_removed / crawler.pipeline_time))
+
+    with open(os.path.join(crawl_dir, cm.VISITS_FILENAME)) as f:
+        records = [json.loads(line) for line in f]
+    return records, elapsed, (rss_after - rss_before) / 1024.
+
+
+def report(records, elapsed, rss_mb):
+    failed = sum(record['outcome'] != 'success' for record in records)
+    overheads = [record['duration'] - record['phases'].get('playback', 0)
+                 for record in records]
+    phases = {}
+    for record in records:
+        for phase, duration in record['phases'].items():
+            phases[phase] = phases.get(phase, 0) + duration
+    print("%d visits (%d failed) in %.2f s: %.1f visits/s"
+          % (len(records), failed, elapsed, len(records) / elapsed))
+    print("overhead per visit: mean %.1f ms, p50 %.1f ms, p95 %.1f ms, "
+          "max %.1f ms" % (1000 * sum(overheads) / len(overheads),
+                           1000 * percentile(overheads, .5),
+                           1000 * percentile(overheads, .95),
+                           1000 * max(overheads)))
+    print("peak RSS growth: %.1f MB" % rss_mb)
+    print("time per phase and visit:")
+    for phase, duration in sorted(phases.items(), key=lambda item: -item[1]):
+        print("  %-16s %8.1f ms" % (phase, 1000 * duration / len(records)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sites', type=int, default=20)
+    parser.add_argument('--visits', type=int, default=2)
+    parser.add_argument('--batches', type=int, default=2)
+    parser.add_argument('--playback', type=float, default=0.05,
+                        help='Compressed playback time per visit (s).')
+    parser.add_argument('--bootstrap', type=float, default=0.,
+                        help='Fake Tor bootstrap delay per batch (s).')
+    parser.add_argument('--browser-delay', type=float, default=0.,
+                        help='Fake browser launch and quit delay (s).')
+    parser.add_argument('--reuse-browser', action='store_true', default=False)
+    parser.add_argument('--batch-capture', choices=tbcrawler.splitter.SPLIT_MODES,
+                        default=None)
+    parser.add_argument('--pipeline', action='store_true', default=False,
+                        help='Crawl with the PipelinedCrawler.')
+    parser.add_argument('--verbose', action='store_true', default=False)
+    args = parser.parse_args()
+    if args.pipeline and args.reuse_browser:
+        parser.error("--pipeline cannot be used with --reuse-browser")
+    if not args.verbose:
+        wl_log.setLevel(logging.WARNING)
+
+    crawl_dir = tempfile.mkdtemp()
+    try:
+        records, elapsed, rss_mb = run(args, crawl_dir)
+    finally:
+        shutil.rmtree(crawl_dir)
+    report(records, elapsed, rss_mb)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""Compare the streaming pcap filter against the scapy one.
+
+Usage: python3 bench/bench_filter_pcap.py [--packets N] [--skip-scapy]
+
+Writes a synthetic capture (71-byte snaplen, IPv4 TCP/UDP to a handful
+of addresses) and filters it with both implementations, each in its own
+process, reporting packets per second and peak memory growth.
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import resource
+import struct
+import sys
+import tempfile
+from time import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from tbcrawler import utils as ut  # noqa: E402
+
+GUARDS = ['171.25.193.9', '199.58.81.140']
+OTHERS = ['10.0.0.%d' % i for i in range(1, 20)]
+LOCAL = '192.168.1.10'
+SNAPLEN = 71
+
+
+def write_capture(path, num_packets):
+    rnd = random.Random(0)
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, SNAPLEN, 1))
+        for i in range(num_packets):
+            remote = rnd.choice(GUARDS + OTHERS)
+            src, dst = (LOCAL, remote) if i % 2 else (remote, LOCAL)
+            proto = 6 if rnd.random() < 0.9 else 17
+            ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 1500, i & 0xffff, 0,
+                             64, proto, 0, bytes(map(int, src.split('.'))),
+                             bytes(map(int, dst.split('.'))))
+            packet = b'\x00' * 12 + b'\x08\x00' + ip + b'\x00' * 40
+            packet = packet[:SNAPLEN]
+            f.write(struct.pack('<IIII', 1600000000 + i // 1000, i % 1000,
+                                len(packet), 1514))
+            f.write(packet)
+
+
+def run_filter(name, path, conn):
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time()
+    if name == 'scapy':
+        ut.filter_pcap_scapy(path, GUARDS)
+    else:
+        ut.filter_pcap(path, GUARDS)
+    elapsed = time() - start
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    conn.send((elapsed, rss_after - rss_before))
+
+
+def bench(name, template, num_packets):
+    path = template + '.' + name
+    with open(template, 'rb') as fin, open(path, 'wb') as fout:
+        fout.write(fin.read())
+    parent_conn, child_conn = multiprocessing.Pipe()
+    proc = multiprocessing.Process(target=run_filter,
+                                   args=(name, path, child_conn))
+    proc.start()
+    elapsed, rss_kb = parent_conn.recv()
+    proc.join()
+    out_size = os.path.getsize(path)
+    for leftover in (path, path + '.original'):
+        if os.path.exists(leftover):
+            os.remove(leftover)
+    print("%-9s %10.0f pkt/s %8.2f s  peak RSS +%6.1f MB  output %d bytes"
+          % (name, num_packets / elapsed, elapsed, rss_kb / 1024., out_size))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--packets', type=int, default=200000)
+    parser.add_argument('--skip-scapy', action='store_true', default=False)
+    args = parser.parse_args()
+
+    tempdir = tempfile.mkdtemp()
+    template = os.path.join(tempdir, 'capture.pcap')
+    write_capture(template, args.packets)
+    print("%d packets, %d bytes" % (args.packets, os.path.getsize(template)))
+    try:
+        bench('streaming', template, args.packets)
+        if not args.skip_scapy:
+            bench('scapy', template, args.packets)
+    finally:
+        os.remove(template)
+        os.rmdir(tempdir)
+
+
+if __name__ == '__main__':
+    main()
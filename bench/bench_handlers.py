@@ -0,0 +1,153 @@
+"""Time the real site handlers against the local replay pages.
+
+Usage: python3 bench/bench_handlers.py [--platforms P ...] [--visits N]
+                                       [--duration S] [--delay MS]
+                                       [--banner] [--ad S] [--page PAGE]
+                                       [--end-visit-on POLICY ...]
+
+Serves the pages of bench/replay_server.py on localhost and crawls them
+without Tor in headless Firefox, with the capture replaced by an empty
+one. Reports, for each platform, the visit time, the time spent in each
+phase and the latency of each wait of the handler, read back from
+visits.jsonl and the visit.json of every visit. Needs Firefox and
+geckodriver, but neither Tor, network access nor root.
+
+With --page blocked, captcha, consent or error, the visits load that page
+instead of the video, and the page class of each visit is checked against
+the class the replay page should get. Exits with status 1 on a mismatch.
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+from collections import defaultdict
+from time import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import tbcrawler.common as cm  # noqa: E402
+import tbcrawler.crawler as crawler_mod  # noqa: E402
+from selenium.webdriver import FirefoxOptions  # noqa: E402
+from tbcrawler.log import wl_log  # noqa: E402
+from tbcrawler.pytbcrawler import FirefoxWrapper  # noqa: E402
+from tbcrawler.termination import POLICIES, make_policy  # noqa: E402
+from fakes import NullSniffer  # noqa: E402
+from replay_server import PAGE_CLASSES, PLATFORMS, ReplayServer  # noqa: E402
+
+
+def mean(values):
+    return sum(values) / len(values) if values else 0.
+
+
+def run(args, server, crawl_dir):
+    cm.CRAWL_DIR = crawl_dir
+    cm.LOGS_DIR = crawl_dir
+    crawler_mod.Sniffer = NullSniffer
+    urls = [(server.url(platform, duration=args.duration, delay=args.delay,
+                        banner=int(args.banner), ad=args.ad, page=args.page),
+             args.duration)
+            for platform in args.platforms]
+    config = {'visits': args.visits, 'batches': 1,
+              'pause_between_batches': 0, 'pause_between_videos': 0,
+              'pause_between_loads': 0}
+    job = crawler_mod.CrawlJob(config, urls, 1)
+    opts = FirefoxOptions()
+    opts.add_argument("--headless")
+    # the replay player is muted, but let it start without a user gesture
+    opts.set_preference("media.autoplay.default", 0)
+    driver = FirefoxWrapper(options=opts)
+    crawler = crawler_mod.VideoCrawler(driver, None, screenshots=False,
+                                       termination=make_policy(args.end_visit_on))
+    start = time()
+    crawler.crawl(job)
+    elapsed = time() - start
+
+    with open(os.path.join(crawl_dir, cm.VISITS_FILENAME)) as f:
+        records = [json.loads(line) for line in f]
+    for record in records:
+        meta_file = os.path.join(crawl_dir, '_'.join(map(str, [
+            record['batch'], record['site'], record['visit']])), 'visit.json')
+        if os.path.isfile(meta_file):
+            with open(meta_file) as f:
+                record['waits'] = json.load(f).get('waits', [])
+    return records, elapsed
+
+
+def report(records, elapsed, platforms, page='video'):
+    """Print the timings, and return the number of visits whose page was
+    not classified as the replay page should be."""
+    print("%d visits in %.1f s" % (len(records), elapsed))
+    # the class of a video page depends on the banner and the timing
+    expected = PAGE_CLASSES[page][0] if page != 'video' else None
+    misclassified = 0
+    for i, platform in enumerate(platforms):
+        visits = [record for record in records if record['site'] == i]
+        if not visits:
+            continue
+        succeeded = [record for record in visits
+                     if record['outcome'] == 'success']
+        print("\n%s: %d/%d successful, %.2f s per visit"
+              % (platform, len(succeeded), len(visits),
+                 mean([record['duration'] for record in visits])))
+        classes = [record.get('page_class') for record in visits]
+        wrong = sum(page_class != expected for page_class in classes
+                    if expected)
+        misclassified += wrong
+        print("  page classes %s%s" % (', '.join(sorted(set(map(str, classes)))),
+                                       ' (%d not %s)' % (wrong, expected)
+                                       if wrong else ''))
+        phases = defaultdict(list)
+        waits = defaultdict(list)
+        for record in visits:
+            for phase, duration in record['phases'].items():
+                phases[phase].append(duration)
+            for wait in record.get('waits', []):
+                waits[wait['name']].append(wait)
+        for phase, durations in sorted(phases.items()):
+            print("  %-26s %8.3f s" % (phase, mean(durations)))
+        for name, samples in waits.items():
+            timed_out = sum(not wait['met'] for wait in samples)
+            print("  wait %-21s %8.3f s%s"
+                  % (name, mean([wait['latency'] for wait in samples]),
+                     ' (%d timed out)' % timed_out if timed_out else ''))
+    return misclassified
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--platforms', nargs='+', choices=PLATFORMS,
+                        default=list(PLATFORMS))
+    parser.add_argument('--visits', type=int, default=3)
+    parser.add_argument('--duration', type=int, default=20,
+                        help='Length of the replay videos (s).')
+    parser.add_argument('--delay', type=int, default=500,
+                        help='Time before the page elements appear (ms).')
+    parser.add_argument('--banner', action='store_true', default=False,
+                        help='Show cookie banners.')
+    parser.add_argument('--ad', type=int, default=0,
+                        help='Show ads, skippable after this time (s).')
+    parser.add_argument('--page', default='video', choices=sorted(PAGE_CLASSES),
+                        help='Load this page instead of the video.')
+    parser.add_argument('--end-visit-on', nargs='+', default=[],
+                        choices=sorted(POLICIES))
+    parser.add_argument('--verbose', action='store_true', default=False)
+    args = parser.parse_args()
+    if not args.verbose:
+        wl_log.setLevel(logging.WARNING)
+
+    server = ReplayServer().start()
+    crawl_dir = tempfile.mkdtemp()
+    try:
+        records, elapsed = run(args, server, crawl_dir)
+    finally:
+        server.stop()
+        shutil.rmtree(crawl_dir)
+    if report(records, elapsed, args.platforms, args.page):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
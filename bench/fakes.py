@@ -0,0 +1,177 @@
+"""In-process stand-ins for the browser, Tor and the capture.
+
+They let `VideoCrawler.crawl` run without Tor, a display, network access
+or root: the fake pages have a player that is ready at once, no cookie
+banners and no ads, so everything the crawler spends beyond the
+(compressed) playback time is its own overhead.
+"""
+import struct
+from contextlib import contextmanager
+from time import sleep
+
+from selenium.common.exceptions import NoSuchElementException
+
+from tbcrawler import pcaputils as pu
+from tbcrawler.pages import CLASSIFY_PAGE_JS
+from tbcrawler.metrics import span
+from tbcrawler.pytbcrawler import BrowserWrapper
+from tbcrawler.timeline import EventTimeline
+
+VIMEO_PLAY_BUTTON = "//button[@data-play-button='true']"
+
+
+class FakeElement(object):
+    def __init__(self, driver):
+        self.driver = driver
+
+    def is_displayed(self):
+        return True
+
+    def is_enabled(self):
+        return True
+
+    def click(self):
+        self.driver.clicks += 1
+
+
+class FakeSwitchTo(object):
+    def default_content(self):
+        pass
+
+    def frame(self, frame):
+        pass
+
+    def window(self, handle):
+        pass
+
+
+class FakeWebDriver(object):
+    """The subset of the WebDriver API that the visit handlers use.
+
+    Launching and quitting take `delay` seconds each.
+    """
+    delay = 0.
+
+    def __init__(self, *args, **kwargs):
+        sleep(self.delay)
+        self.current_url = 'about:blank'
+        self.clicks = 0
+        self.scripts = 0
+        self.switch_to = FakeSwitchTo()
+        self.window_handles = ['main']
+
+    def get(self, url):
+        self.current_url = url
+
+    def set_page_load_timeout(self, timeout):
+        pass
+
+    def execute_script(self, script, *args):
+        self.scripts += 1
+        if script == CLASSIFY_PAGE_JS:
+            return {'class': 'player', 'signature': 'video'}
+        if 'getVideoLoadedFraction' in script:
+            return 0.5
+        if 'getPlayerState()' in script:
+            return 1  # playing
+        return True  # the player API is ready, the video plays
+
+    def execute(self, command, params=None):
+        return {'value': None}  # ActionChains
+
+    def find_element(self, by, value):
+        if 'vimeo' in self.current_url and value == VIMEO_PLAY_BUTTON:
+            return FakeElement(self)
+        raise NoSuchElementException(value)
+
+    def find_elements(self, by, value):
+        return []
+
+    def get_screenshot_as_png(self):
+        return b''
+
+    def delete_all_cookies(self):
+        pass
+
+    CONTEXT_CHROME = 'chrome'
+
+    @contextmanager
+    def context(self, context):
+        yield
+
+    def execute_async_script(self, script, *args):
+        self.scripts += 1
+
+    def close(self):
+        pass
+
+    def quit(self):
+        sleep(self.delay)
+
+
+class FakeBrowserWrapper(BrowserWrapper):
+    """The real browser wrapper (launch, reuse and recycling) on top of
+    a fake WebDriver."""
+    driver_class = FakeWebDriver
+
+    def use_tor_ports(self, socks_port, control_port):
+        pass
+
+    def rss_mb(self):
+        return 0
+
+
+class FakeTorController(object):
+    """A Tor controller whose launch takes `bootstrap_delay` seconds."""
+
+    def __init__(self, bootstrap_delay=0.):
+        self.bootstrap_delay = bootstrap_delay
+        self.socks_port = 9050
+        self.control_port = 9051
+        self.launches = 0
+        self.timeline = EventTimeline()  # never attached: no events
+
+    @contextmanager
+    def launch(self):
+        with span('tor_launch'):
+            sleep(self.bootstrap_delay)
+        self.launches += 1
+        yield
+
+    def prepare_standby(self):
+        pass
+
+    def wake_standby(self):
+        pass
+
+    def get_guard_ips(self):
+        return ['171.25.193.9']
+
+    def get_entry_addresses(self):
+        return ['171.25.193.9']
+
+    def new_identity(self):
+        pass
+
+    def exclude_exits(self, fingerprints):
+        pass
+
+    def close(self):
+        pass
+
+
+class NullSniffer(object):
+    """Writes an empty capture instead of capturing."""
+
+    def __init__(self, path="/dev/null", *args, **kwargs):
+        self.pcap_file = path
+        self.stats = None
+
+    def __enter__(self):
+        with open(self.pcap_file, 'wb') as f:
+            f.write(struct.pack('<IHHiIII', pu.PCAP_MAGIC_USEC, 2, 4, 0, 0,
+                                71, pu.LINKTYPE_ETHERNET))
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pass
@@ -0,0 +1,363 @@
+"""Local pages that mimic the video platforms, for running the real
+visit handlers without the live sites.
+
+Each platform page has the elements the handlers look for, at the same
+XPaths: cookie banners, play, like and ad-skip buttons, and YouTube's
+`movie_player` API (`getPlayerState`, `getVideoLoadedFraction`). The
+player draws a synthetic video on a canvas, streamed to a <video>
+element, and fetches fake media segments from the server while it
+plays, so that visits also generate traffic.
+
+Page options are query parameters:
+  duration  video length in seconds (default 60)
+  delay     milliseconds before the page's elements appear (default 500)
+  banner    1 to show a cookie banner (default 0)
+  ad        seconds before an ad can be skipped, 0 for no ad (default 0)
+  page      video, or a page that is not the video (default video):
+            blocked  YouTube's "detected unusual traffic" page
+            captcha  a reCAPTCHA challenge
+            consent  a cookie wall that says some content isn't available
+            error    a "page not found" page
+
+`PAGE_CLASSES` holds the class and signature that `tbcrawler.pages`
+should give each page.
+
+Usage: python3 bench/replay_server.py [--port PORT]
+"""
+import argparse
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+PLATFORMS = ('youtube', 'vimeo', 'dailymotion', 'facebook', 'rumble')
+PAGE_PATHS = {'youtube': '/youtube/watch',
+              'vimeo': '/vimeo/%s',
+              'dailymotion': '/dailymotion/video/%s',
+              'facebook': '/facebook/watch',
+              'rumble': '/rumble/%s.html'}
+DEFAULT_OPTIONS = {'duration': '60', 'delay': '500', 'banner': '0', 'ad': '0',
+                   'page': 'video'}
+# title and body of the pages that are not the video
+OTHER_PAGES = {
+    'blocked': ('https://www.youtube.com/watch',
+                '<p>Our systems have detected unusual traffic from your '
+                'computer network. This page checks to see if it\'s really '
+                'you sending the requests, and not a robot.</p>'),
+    'captcha': ('Security check',
+                '<p>Please confirm that you are not a robot.</p>'
+                '<div class="g-recaptcha" data-sitekey="replay"></div>'),
+    'consent': ('Cookies',
+                '<div data-cookiebanner="banner"><p>Allow the use of cookies '
+                'on this browser? Some content isn\'t available unless you '
+                'allow them.</p><button>Allow all cookies</button></div>'),
+    'error': ('Page not found',
+              '<p>Sorry, this video does not exist.</p>'),
+}
+PAGE_CLASSES = {'video': ('player', 'video'),
+                'blocked': ('blocked', 'unusual_traffic'),
+                'captcha': ('captcha', 'recaptcha'),
+                'consent': ('consent', 'facebook_cookies'),
+                'error': ('error', 'not_found')}
+SEGMENT_BLOCK = os.urandom(1 << 16)
+MAX_SEGMENT_BYTES = 1 << 22
+
+# absolute XPaths the handlers use on Dailymotion and Facebook
+DAILYMOTION_BANNER_XPATH = '/html/body/div[2]/div/div/div[2]/div/div[1]/button'
+DAILYMOTION_LIKE_XPATH = "/html/body/div[1]/div/main/div/div[1]/div/div[1]/div/div[2]/div/div/div[2]/div[2]/button[2]"
+FACEBOOK_LIKE_XPATH = "/html/body/div[1]/div/div[1]/div/div[3]/div/div/div/div[1]/div[2]/div[1]/div/div/div[1]/div[2]/div[2]/div/div/div[1]/div/div[1]"
+
+
+class _Node(object):
+    def __init__(self, tag):
+        self.tag = tag
+        self.attributes = ''
+        self.html = ''
+        self.children = {}  # tag -> {position: node}
+
+    def child(self, tag, position):
+        positions = self.children.setdefault(tag, {})
+        if position not in positions:
+            positions[position] = _Node(tag)
+        return positions[position]
+
+    def render_children(self):
+        parts = []
+        for tag, positions in self.children.items():
+            for position in range(1, max(positions) + 1):
+                parts.append((positions.get(position) or _Node(tag)).render())
+        return ''.join(parts)
+
+    def render(self):
+        return '<%s%s>%s%s</%s>' % (self.tag, self.attributes, self.html,
+                                    self.render_children(), self.tag)
+
+
+def xpath_html(elements):
+    """Return the children of <body> such that each (xpath, attributes,
+    html) element is at its absolute XPath, e.g. /html/body/div[2]/button,
+    with empty siblings filling the positions before it."""
+    body = _Node('body')
+    for xpath, attributes, html in elements:
+        steps = xpath.strip('/').split('/')
+        assert steps[:2] == ['html', 'body'], xpath
+        node = body
+        for step in steps[2:]:
+            tag, _, position = step.partition('[')
+            node = node.child(tag, int(position.rstrip(']') or 1))
+        node.attributes += attributes
+        node.html = html
+    return body.render_children()
+
+
+def page(platform, options):
+    """Return the HTML of a platform page."""
+    if options.get('page', 'video') != 'video':
+        title, html = OTHER_PAGES[options['page']]
+        return ('<!DOCTYPE html><html><head><title>%s</title></head>'
+                '<body>%s</body></html>' % (title, html))
+    # a <section>, so that it does not shift the positions of the <div>s
+    player = ('<section data-role="player"><video muted="muted" '
+              'playsinline="playsinline"></video></section>')
+    banner = ' data-role="banner" hidden="hidden"'
+    hidden = ' hidden="hidden"'
+    if platform == 'youtube':
+        html = ('<div%s><button aria-label="Reject the use of cookies and '
+                'other data for the purposes described" data-role="reject">'
+                'Reject all</button></div>'
+                '<div id="movie_player">%s<button aria-label="Play" '
+                'data-role="play"%s>Play</button><button class="ytp-ad-skip-button '
+                'ytp-button" data-role="skip"%s>Skip</button></div>'
+                % (banner, player, hidden, hidden))
+    elif platform == 'vimeo':
+        html = ('<div%s><button id="onetrust-reject-all-handler" '
+                'data-role="reject">Reject all</button></div>%s'
+                '<button data-play-button="true" data-role="play"%s>Play</button>'
+                % (banner, player, hidden))
+    elif platform == 'dailymotion':
+        html = xpath_html([
+            (DAILYMOTION_LIKE_XPATH, ' data-role="like"' + hidden, 'Like'),
+            ('/html/body/div[2]', banner, ''),
+            (DAILYMOTION_BANNER_XPATH, ' data-role="reject"',
+             'Continue without accepting')]) + player
+    elif platform == 'facebook':
+        html = xpath_html([(FACEBOOK_LIKE_XPATH, ' data-role="like"' + hidden,
+                            'Like')]) + player
+    elif platform == 'rumble':
+        html = ('<div id="videoPlayer" data-role="play"%s>%s</div>'
+                '<iframe data-role="ad"%s></iframe>' % (hidden, player, hidden))
+    else:
+        raise ValueError(platform)
+    attributes = ''.join(' data-%s="%s"' % (name, value)
+                         for name, value in sorted(options.items()))
+    return ('<!DOCTYPE html><html><head><title>%s</title></head>'
+            '<body data-platform="%s"%s>%s<script src="/player.js"></script>'
+            '</body></html>' % (platform, platform, attributes, html))
+
+
+AD_PAGE = ('<!DOCTYPE html><html><body><p>Ad</p>'
+           '<button aria-label="Skip Ad" hidden="hidden" '
+           'onclick="parent.postMessage(\'skip\', \'*\')">Skip Ad</button>'
+           '<script>setTimeout(function () {'
+           'document.querySelector("button").hidden = false;'
+           '}, %d);</script></body></html>')
+
+PLAYER_JS = r"""
+(function () {
+  var body = document.body, data = body.dataset;
+  var platform = data.platform, duration = +data.duration;
+  var SEGMENT_SECONDS = 2, BUFFER_AHEAD = 30, SEGMENT_BYTES = 250000;
+  var AD_TAIL = 15;  // an ad that is not skipped ends after this time
+  var state = -1;           // unstarted, then 1 playing, 0 ended
+  var started = null, segments = 0, fetching = false, inAd = false;
+  var video = document.querySelector('video');
+  var canvas = document.createElement('canvas');
+  canvas.width = 320; canvas.height = 180;
+  var context = canvas.getContext('2d');
+  function role(name) { return document.querySelector('[data-role=' + name + ']'); }
+  function show(name) { var el = role(name); if (el) { el.hidden = false; } }
+  function hide(name) { var el = role(name); if (el) { el.hidden = true; } }
+
+  function position() {
+    return started === null ? 0 : (performance.now() - started) / 1000;
+  }
+  function draw() {
+    context.fillStyle = inAd ? '#600' : '#036';
+    context.fillRect(0, 0, canvas.width, canvas.height);
+    context.fillStyle = '#fff';
+    context.fillRect((position() * 40) % canvas.width, 0, 8, canvas.height);
+    requestAnimationFrame(draw);
+  }
+  function fetchSegments() {
+    if (fetching || state !== 1 || segments * SEGMENT_SECONDS >= duration ||
+        segments * SEGMENT_SECONDS > position() + BUFFER_AHEAD) {
+      return;
+    }
+    fetching = true;
+    fetch('/segment/' + segments + '?bytes=' + SEGMENT_BYTES, {cache: 'no-store'})
+      .then(function (response) { return response.arrayBuffer(); })
+      .then(function () { segments += 1; })
+      .finally(function () { fetching = false; fetchSegments(); });
+  }
+  function play() {
+    if (state === 1 || state === 0) { return; }
+    state = 1;
+    hide('play');
+    video.play();
+    started = performance.now();
+    fetchSegments();
+  }
+  function startAd(seconds) {
+    inAd = true;
+    if (platform === 'youtube') { video.play(); }  // Rumble's ad is in a frame
+    setTimeout(function () { if (inAd) { show('skip'); } }, seconds * 1000);
+    setTimeout(endAd, (seconds + AD_TAIL) * 1000);
+  }
+  function endAd() {
+    if (!inAd) { return; }
+    inAd = false;
+    hide('skip');
+    hide('ad');
+    play();
+  }
+
+  video.srcObject = canvas.captureStream(25);
+  draw();
+  setInterval(function () {
+    if (state === 1 && position() >= duration) {
+      state = 0;
+      video.pause();
+    }
+    fetchSegments();
+  }, 250);
+
+  var player = document.getElementById('movie_player');
+  if (player) {
+    player.getPlayerState = function () { return state; };
+    player.getVideoLoadedFraction = function () {
+      return Math.min(segments * SEGMENT_SECONDS / duration, 1);
+    };
+  }
+  if (role('skip')) { role('skip').onclick = endAd; }
+  window.addEventListener('message', function (event) {
+    if (event.data === 'skip') { endAd(); }
+  });
+
+  // starts playback once the page is usable, the way each platform does
+  function ready() {
+    var ad = +data.ad;
+    if (platform === 'youtube') {
+      if (ad) { startAd(ad); } else { play(); }
+      role('play').onclick = play;
+    } else if (platform === 'vimeo') {
+      show('play');
+      role('play').onclick = play;
+    } else if (platform === 'rumble') {
+      role('play').onclick = function () {
+        if (!ad) { play(); return; }
+        var frame = role('ad');
+        frame.src = '/rumble-ad?ad=' + ad;
+        frame.hidden = false;
+        startAd(ad);
+      };
+    } else {
+      show('like');
+      play();
+    }
+  }
+
+  setTimeout(function () {
+    if (platform === 'rumble') { show('play'); }
+    if (+data.banner && role('banner')) {
+      show('banner');
+      role('reject').onclick = function () {
+        setTimeout(function () { hide('banner'); ready(); }, 300);
+      };
+    } else {
+      ready();
+    }
+  }, +data.delay);
+})();
+"""
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        if url.path == '/player.js':
+            self._send(PLAYER_JS.encode(), 'application/javascript')
+        elif url.path == '/rumble-ad':
+            self._send((AD_PAGE % (1000 * float(query.get('ad', 5)))).encode())
+        elif url.path.startswith('/segment/'):
+            size = min(int(query.get('bytes', 0)), MAX_SEGMENT_BYTES)
+            block = SEGMENT_BLOCK * (size // len(SEGMENT_BLOCK) + 1)
+            self._send(block[:size], 'video/mp4')
+        else:
+            platform = url.path.strip('/').split('/')[0]
+            if platform not in PLATFORMS:
+                self.send_error(404)
+                return
+            options = dict(DEFAULT_OPTIONS)
+            options.update((name, value) for name, value in query.items()
+                           if name in DEFAULT_OPTIONS)
+            if options['page'] not in PAGE_CLASSES:
+                self.send_error(404)
+                return
+            self._send(page(platform, options).encode())
+
+    def _send(self, body, content_type='text/html; charset=utf-8'):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ReplayServer(object):
+    """Serves the platform pages on localhost, in a thread."""
+
+    def __init__(self, port=0, host='127.0.0.1'):
+        self.httpd = ThreadingHTTPServer((host, port), _Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       daemon=True, name='replay-server')
+
+    def url(self, platform, video='replay', **options):
+        """Return the URL of a platform page, with page options."""
+        path = PAGE_PATHS[platform]
+        if '%s' in path:
+            path %= video
+        else:
+            options['v'] = video
+        host, port = self.httpd.server_address[:2]
+        query = '?' + urlencode(sorted(options.items())) if options else ''
+        return 'http://%s:%d%s%s' % (host, port, path, query)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8000)
+    args = parser.parse_args()
+    server = ReplayServer(args.port)
+    for platform in PLATFORMS:
+        print(server.url(platform, banner=1))
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,295 @@
+"""In-process packet capture on a memory-mapped AF_PACKET ring.
+
+The kernel fills blocks of a TPACKET_V3 ring that is shared with this
+process, and a thread writes the packets of every retired block to a
+pcap file. The capture filter is compiled to classic BPF with libpcap
+(through ctypes) or with `tcpdump -ddd`, and attached to the socket, so
+only matching packets are copied, truncated to the snapshot length.
+"""
+import ctypes
+import ctypes.util
+import mmap
+import select
+import socket
+import struct
+import subprocess
+import threading
+from time import time
+
+from tbcrawler import pcaputils as pu
+from tbcrawler.log import wl_log
+
+SOL_PACKET = 263
+PACKET_RX_RING = 5
+PACKET_STATISTICS = 6
+PACKET_VERSION = 10
+TPACKET_V3 = 2
+SO_ATTACH_FILTER = 26
+ETH_P_ALL = 0x0003
+
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+TP_STATUS_VLAN_VALID = 0x10
+TP_STATUS_VLAN_TPID_VALID = 0x40
+PACKET_OUTGOING = 4
+
+ARPHRD_ETHER = 1
+ARPHRD_LOOPBACK = 772
+ARPHRD_NONE = 65534
+LINKTYPES = {ARPHRD_ETHER: pu.LINKTYPE_ETHERNET,
+             ARPHRD_LOOPBACK: pu.LINKTYPE_ETHERNET,
+             ARPHRD_NONE: pu.LINKTYPE_RAW}
+DLT_NAMES = {pu.LINKTYPE_ETHERNET: 'EN10MB', pu.LINKTYPE_RAW: 'RAW'}
+
+BPF_RET_K = 0x06
+BLOCK_SIZE = 1 << 20
+BLOCK_NR = 16
+FRAME_SIZE = 2048
+RETIRE_BLOCK_MS = 50   # a partly filled block is handed over after this time
+POLL_MS = 100
+
+# struct tpacket_block_desc up to offset_to_first_pkt in tpacket_hdr_v1
+BLOCK_HEADER = struct.Struct('=IIIII')
+BLOCK_STATUS_OFFSET = 8
+# struct tpacket3_hdr up to tp_mac, tp_net and the VLAN fields of hv1
+PACKET_HEADER = struct.Struct('=IIIIIIHHIIH')
+# the struct sockaddr_ll that follows the aligned tpacket3_hdr
+SLL_OFFSET = 48
+SLL_HEADER = struct.Struct('=HHiHBB')
+BPF_INSN = struct.Struct('=HBBI')
+STATS = struct.Struct('=III')
+
+
+class CaptureError(Exception):
+    pass
+
+
+class _BpfInsn(ctypes.Structure):
+    _fields_ = [('code', ctypes.c_ushort), ('jt', ctypes.c_ubyte),
+                ('jf', ctypes.c_ubyte), ('k', ctypes.c_uint32)]
+
+
+class _BpfProgram(ctypes.Structure):
+    _fields_ = [('bf_len', ctypes.c_uint),
+                ('bf_insns', ctypes.POINTER(_BpfInsn))]
+
+
+def _compile_libpcap(expression, linktype, snaplen):
+    path = ctypes.util.find_library('pcap')
+    if not path:
+        return None
+    libpcap = ctypes.CDLL(path)
+    libpcap.pcap_open_dead.restype = ctypes.c_void_p
+    libpcap.pcap_open_dead.argtypes = [ctypes.c_int, ctypes.c_int]
+    libpcap.pcap_compile.argtypes = [ctypes.c_void_p,
+                                     ctypes.POINTER(_BpfProgram),
+                                     ctypes.c_char_p, ctypes.c_int,
+                                     ctypes.c_uint32]
+    libpcap.pcap_geterr.restype = ctypes.c_char_p
+    libpcap.pcap_geterr.argtypes = [ctypes.c_void_p]
+    libpcap.pcap_freecode.argtypes = [ctypes.POINTER(_BpfProgram)]
+    libpcap.pcap_close.argtypes = [ctypes.c_void_p]
+    handle = libpcap.pcap_open_dead(linktype, snaplen)
+    program = _BpfProgram()
+    try:
+        if libpcap.pcap_compile(handle, ctypes.byref(program),
+                                expression.encode(), 1, 0xffffffff) < 0:
+            raise CaptureError("Invalid capture filter %r: %s" % (
+                expression, libpcap.pcap_geterr(handle).decode()))
+        insns = [(insn.code, insn.jt, insn.jf, insn.k)
+                 for insn in program.bf_insns[:program.bf_len]]
+        libpcap.pcap_freecode(ctypes.byref(program))
+        return insns
+    finally:
+        libpcap.pcap_close(handle)
+
+
+def _compile_tcpdump(expression, linktype, snaplen, device):
+    command = ['tcpdump', '-i', device, '-y', DLT_NAMES[linktype],
+               '-s', str(snaplen), '-ddd', expression]
+    try:
+        output = subprocess.check_output(command, stderr=subprocess.PIPE)
+    except OSError:
+        return None
+    except subprocess.CalledProcessError as exc:
+        raise CaptureError("Invalid capture filter %r: %s" % (
+            expression, exc.stderr.decode().strip()))
+    lines = output.decode().split('\n')
+    return [tuple(int(field) for field in line.split())
+            for line in lines[1:int(lines[0]) + 1]]
+
+
+def compile_filter(expression, linktype, snaplen, device):
+    """Return the classic BPF program of a capture filter expression, as
+    a list of (code, jt, jf, k) instructions.
+
+    Accepted packets are truncated to `snaplen` by the kernel.
+    """
+    if not expression.strip():
+        return [(BPF_RET_K, 0, 0, snaplen)]
+    insns = _compile_libpcap(expression, linktype, snaplen)
+    if insns is None:
+        insns = _compile_tcpdump(expression, linktype, snaplen, device)
+    if insns is None:
+        raise CaptureError("Compiling capture filters needs libpcap "
+                           "or tcpdump")
+    return [(code, jt, jf, min(k, snaplen) if code == BPF_RET_K else k)
+            for code, jt, jf, k in insns]
+
+
+def device_linktype(device):
+    """Return the pcap link type of a network interface."""
+    try:
+        with open('/sys/class/net/%s/type' % device) as f:
+            arphrd = int(f.read())
+    except (IOError, ValueError):
+        raise CaptureError("No such device: %s" % device)
+    if arphrd not in LINKTYPES:
+        raise CaptureError("Unsupported device type %d for %s"
+                           % (arphrd, device))
+    return LINKTYPES[arphrd]
+
+
+class RingCapture(object):
+    """Captures packets on `device` into a pcap file.
+
+    `start` returns once the socket is bound, so that no packet is
+    missed after it returns; `stop` writes the remaining packets and
+    returns the kernel statistics (see `stats`).
+    """
+
+    def __init__(self, pcap_path, device, bpf_filter="", snaplen=65535):
+        self.pcap_path = pcap_path
+        self.device = device
+        self.bpf_filter = bpf_filter
+        self.snaplen = snaplen
+        self.linktype = None
+        self.sock = None
+        self.ring = None
+        self.thread = None
+        self.error = None
+        self._stop_at = None
+        self.written = 0
+        self.packets = 0
+        self.drops = 0
+        self.freeze_q_count = 0
+
+    @property
+    def stats(self):
+        """Packets accepted by the filter, dropped because the ring was
+        full, and written to the capture."""
+        self._read_stats()
+        return {'packets': self.packets, 'drops': self.drops,
+                'written': self.written}
+
+    def start(self):
+        started = time()
+        self.linktype = device_linktype(self.device)
+        program = compile_filter(self.bpf_filter, self.linktype,
+                                 self.snaplen, self.device)
+        # no packets are queued before the socket is bound below
+        sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, 0)
+        try:
+            sock.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+            sock.setsockopt(SOL_PACKET, PACKET_RX_RING, struct.pack(
+                '=7I', BLOCK_SIZE, BLOCK_NR, FRAME_SIZE,
+                BLOCK_SIZE * BLOCK_NR // FRAME_SIZE, RETIRE_BLOCK_MS, 0, 0))
+            self._attach_filter(sock, program)
+            self.ring = mmap.mmap(sock.fileno(), BLOCK_SIZE * BLOCK_NR,
+                                  mmap.MAP_SHARED,
+                                  mmap.PROT_READ | mmap.PROT_WRITE)
+            sock.bind((self.device, ETH_P_ALL))
+        except OSError as exc:
+            sock.close()
+            raise CaptureError("Cannot capture on %s: %s" % (self.device, exc))
+        self.sock = sock
+        self.pcap = open(self.pcap_path, 'wb')
+        self.pcap.write(struct.pack('<IHHiIII', pu.PCAP_MAGIC_USEC, 2, 4, 0,
+                                    0, self.snaplen, self.linktype))
+        self.pcap.flush()
+        self.thread = threading.Thread(target=self._run, daemon=True,
+                                       name='capture-%s' % self.device)
+        self.thread.start()
+        wl_log.info("AF_PACKET capture on %s started in %.1f ms",
+                    self.device, (time() - started) * 1000)
+
+    def stop(self):
+        # the kernel retires the partly filled block within RETIRE_BLOCK_MS
+        self._stop_at = time() + 2 * RETIRE_BLOCK_MS / 1000.
+        self.thread.join()
+        stats = self.stats
+        self.sock.close()
+        self.ring.close()
+        self.pcap.close()
+        if self.error:
+            wl_log.error("AF_PACKET capture on %s failed: %s",
+                         self.device, self.error)
+        return stats
+
+    @staticmethod
+    def _attach_filter(sock, program):
+        insns = b''.join(BPF_INSN.pack(*insn) for insn in program)
+        buf = ctypes.create_string_buffer(insns, len(insns))
+        fprog = struct.pack('HP', len(program), ctypes.addressof(buf))
+        sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+
+    def _read_stats(self):
+        if self.sock is None or self.sock.fileno() < 0:
+            return
+        # reading the statistics resets them
+        packets, drops, freeze_q_count = STATS.unpack(
+            self.sock.getsockopt(SOL_PACKET, PACKET_STATISTICS, STATS.size))
+        self.packets += packets
+        self.drops += drops
+        self.freeze_q_count += freeze_q_count
+
+    def _run(self):
+        poller = select.poll()
+        poller.register(self.sock, select.POLLIN | select.POLLERR)
+        block = 0
+        try:
+            while True:
+                stopping = self._stop_at is not None and time() >= self._stop_at
+                offset = block * BLOCK_SIZE
+                status, = struct.unpack_from(
+                    '=I', self.ring, offset + BLOCK_STATUS_OFFSET)
+                if status & TP_STATUS_USER:
+                    self._write_block(offset)
+                    block = (block + 1) % BLOCK_NR
+                    continue
+                if stopping:
+                    break
+                poller.poll(POLL_MS)
+        except Exception as exc:
+            self.error = exc
+
+    def _write_block(self, offset):
+        ring = self.ring
+        _, _, _, num_pkts, pkt_offset = BLOCK_HEADER.unpack_from(ring, offset)
+        pkt_offset += offset
+        records = []
+        for _ in range(num_pkts):
+            (next_offset, sec, nsec, snaplen, length, status, mac, _,
+             _, vlan_tci, vlan_tpid) = PACKET_HEADER.unpack_from(ring, pkt_offset)
+            _, _, _, hatype, pkttype, _ = SLL_HEADER.unpack_from(
+                ring, pkt_offset + SLL_OFFSET)
+            # the loopback interface shows every packet twice; like
+            # libpcap, keep only the incoming copy
+            if not (hatype == ARPHRD_LOOPBACK and pkttype == PACKET_OUTGOING):
+                data = ring[pkt_offset + mac:pkt_offset + mac + snaplen]
+                if status & TP_STATUS_VLAN_VALID and len(data) >= 12:
+                    # the kernel strips the VLAN tag, put it back
+                    tpid = (vlan_tpid if status & TP_STATUS_VLAN_TPID_VALID
+                            else 0x8100)
+                    data = (data[:12] + struct.pack('!HH', tpid, vlan_tci)
+                            + data[12:])[:self.snaplen]
+                    length += 4
+                records.append(struct.pack('<IIII', sec, nsec // 1000,
+                                           len(data), length))
+                records.append(data)
+                self.written += 1
+            pkt_offset += next_offset
+        struct.pack_into('=I', ring, offset + BLOCK_STATUS_OFFSET,
+                         TP_STATUS_KERNEL)
+        self.pcap.write(b''.join(records))
+        self.pcap.flush()
@@ -11,18 +11,74 @@ MAX_SITES_PER_TOR_PROCESS = 100  # reset tor process after crawling 100 sites
 MAX_DUMP_SIZE = 120000
 # max filename length
 MAX_FNAME_LENGTH = 200
-STREAM_CLOSE_TIMEOUT = 20  # wait 20 seconds before raising an alarm signal
+STREAM_CLOSE_TIMEOUT = 20  # give up closing streams after 20 seconds
 # otherwise we had many cases where get_streams hanged
 
 # timeouts
 SOFT_VISIT_TIMEOUT = 120     # timeout used by selenium when attempting to load the page (before loading video)
 HARD_VISIT_TIMEOUT = 60*20   # hard timeout used by process and dumpcap to terminate irregardless of video load status
+# seconds after a deadline before what blocks the thread is killed (see
+# tbcrawler.deadlines)
+DEADLINE_GRACE = 5
+
+# end of playback: the expected playback time minus a margin, or at most
+# MAX_PLAYBACK_TIME (see tbcrawler.termination)
+PLAYBACK_END_MARGIN = 10     # in seconds
+MAX_PLAYBACK_TIME = 240      # in seconds
+PLAYER_LOADED_TAIL = 5       # keep capturing after the video fully loaded
+NETWORK_IDLE_TIME = 10       # the capture grows less than NETWORK_IDLE_BYTES
+NETWORK_IDLE_BYTES = 5000    # (~60 packets of 71 bytes) within this time
+NETWORK_IDLE_MIN_TIME = 30   # but not before this time of playback
+PERIODIC_ACTION_INTERVAL = 10  # seconds between pressing play/skip ad buttons
+
+# condition-based waits in the visit handlers (see tbcrawler.waits); each
+# returns as soon as its condition holds or its timeout passes
+WAIT_POLL_INTERVAL = 0.25    # in seconds
+PAGE_READY_TIMEOUT = 10      # the cookies banner or the player is present
+BANNER_CLOSE_TIMEOUT = 5     # the cookies banner went away after a click
+PLAYER_READY_TIMEOUT = 30    # the play button or player can be clicked
+AD_SKIP_TIMEOUT = 30         # an ad can be skipped, or the video plays
+PLAYBACK_START_TIMEOUT = 3   # the video plays before the first screenshot
+
+# a visit that the platform blocks ("detected unusual traffic") is retried
+# at once on new circuits, up to BLOCK_RETRIES times, after waiting
+# BLOCK_RETRY_BACKOFF * 2^n seconds (see tbcrawler.retries); Tor accepts
+# a NEWNYM signal every 10 seconds
+BLOCK_RETRIES = 2
+BLOCK_RETRY_BACKOFF = 10
+# exits that blocked at least this fraction of, and at least this many,
+# visits to a platform are excluded for the visits to that platform
+BLOCKED_EXIT_RATE = 0.5
+BLOCKED_EXIT_MIN_VISITS = 2
 
 # write youtube player status and take screenshots every so often
 SCREENSHOT_INTERVAL = 30.      # in seconds
+# screenshots are re-encoded and written by threads (see tbcrawler.screenshots)
+SCREENSHOT_WORKERS = 2
+SCREENSHOT_QUEUE_SIZE = 8      # screenshots waiting to be written
+SCREENSHOT_FORMATS = ('png', 'jpeg', 'webp')
 
 DEFAULT_SOCKS_PORT = 9051
 
+# parallel crawls: worker i uses the configured Tor ports plus i * offset
+# and lives in its own network namespace on the subnet 10.200.i.0/30
+WORKER_PORT_OFFSET = 10
+WORKER_NETNS_PREFIX = 'tbcrawl'
+WORKER_SUBNET = '10.200.%d.%d'
+
+# standby Tor processes alternate between the configured ports and these
+# ports plus the offset
+STANDBY_PORT_OFFSET = 5
+TOR_BOOTSTRAP_TIMEOUT = 270  # seconds
+
+# each Tor process gets a clone of the TBB Tor data directory, on tmpfs if
+# there is one; Tor only ever replaces these files (write a new file, then
+# rename it), so the clone links them instead of copying them
+TOR_DATA_ON_TMPFS = True
+TOR_LINKED_FILES = ('geoip', 'geoip6', 'cached-certs', 'cached-consensus',
+                    'cached-microdesc-consensus', 'cached-microdescs',
+                    'cached-descriptors', 'cached-extrainfo')
+
 # virtual display dimensions... based on Dell XPS 13
 # W = width of the virtual display
 # H = height of the virtual display
@@ -46,6 +102,18 @@ DEFAULT_FF_LOG = join(LOGS_DIR, 'ff.log')
 TEST_DIR = join(SRC_DIR, 'test')
 TBB_DIR = join(BASE_DIR, 'tor-browser')
 VIDEO_LIST = join(BASE_DIR, "videos.txt")
+JOURNAL_FILENAME = 'journal.sqlite'  # in the crawl directory
+VISITS_FILENAME = 'visits.jsonl'  # one record per visit, in the crawl directory
+
+# packing the visits of a crawl into archives (see tbcrawler.pack)
+PACK_DIRNAME = 'packed'         # in the crawl directory
+PACK_MANIFEST = 'manifest.jsonl'  # one line per packed visit, in PACK_DIRNAME
+PACK_SHARD_SIZE = 50            # visits per archive
+PACK_MIN_AGE = 60               # seconds a visit directory must be unchanged
+
+# checking the visits of a crawl (see tbcrawler.sanity): a capture is
+# flagged as short when it spans less than this fraction of the playback
+SANITY_MIN_CAPTURE_FRACTION = 0.9
 
 # PCAP capture filter
 DEFAULT_FILTER = ''
@@ -53,6 +121,17 @@ DEFAULT_FILTER = ''
 #DEFAULT_FILTER = 'not tcp port 22'
 #Filter need to remove SSH traffic if accessing remotely
 
+# with --filter-guards, only the traffic to the entry guards and bridges of
+# the Tor process is captured, unless there are more addresses than this
+MAX_FILTER_HOSTS = 32
+# and without Tor, only DNS and HTTPS over TCP or QUIC
+WITHOUT_TOR_FILTER = 'port 53 or port 443'
+
+# Ethernet, IP and TCP headers and TLS record lengths, but no payloads
+SNAPLEN = 71
+# capture with a tcpdump process per visit, or in process with 'afpacket'
+DEFAULT_CAPTURE_BACKEND = 'tcpdump'
+
 
 class TimeoutException(Exception):
     pass
@@ -1,37 +1,75 @@
+import itertools
+import json
+import os
 import sys
-from os.path import join, split
+from contextlib import ExitStack, contextmanager
+from os.path import basename, getsize, isfile, join, split
 from pprint import pformat
 from time import sleep, time
 
 from selenium.common.exceptions import TimeoutException, WebDriverException
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.support.ui import WebDriverWait
+from selenium.webdriver.remote.webelement import WebElement
 from selenium.webdriver.common.keys import Keys
 from selenium.webdriver.common.action_chains import ActionChains
 
 import tbcrawler.common as cm
 import tbcrawler.utils as ut
-from tbcrawler.dumputils import Sniffer
+from tbcrawler.deadlines import deadline
+from tbcrawler.dumputils import Sniffer, combine_filters, host_filter
+from tbcrawler.journal import SUCCESS, FAILED
 from tbcrawler.log import wl_log
+from tbcrawler import metrics, pages
+from tbcrawler.retries import BlockRetrier
+from tbcrawler.screenshots import ScreenshotWriter
+from tbcrawler.splitter import PcapSplitter
+from tbcrawler.termination import DeadlinePolicy
+from tbcrawler import waits
 
 class VideoCrawler(object):
-    def __init__(self, driver, controller, screenshots=True, device="eth0"):
+    def __init__(self, driver, controller, screenshots=True, device="eth0",
+                 termination=None, capture_backend=cm.DEFAULT_CAPTURE_BACKEND,
+                 batch_capture=None, screenshot_writer=None,
+                 screenshot_interval=0, filter_guards=False, retrier=None):
         self.driver = driver
+        self.drivers = [driver]
         self.controller = controller
         self.screenshots = screenshots
+        if screenshots and screenshot_writer is None:
+            screenshot_writer = ScreenshotWriter()
+        self.screenshot_writer = screenshot_writer
+        self.screenshot_interval = screenshot_interval
         self.device = device
+        self.capture_backend = capture_backend
+        self.batch_capture = batch_capture
+        self.batch_pcap = None
+        self.batch_filter = None
+        self.splitter = None
+        self.filter_guards = filter_guards
+        self.termination = termination or DeadlinePolicy()
+        self.retrier = retrier or BlockRetrier(controller)
         self.job = None
+        self.visit_meta = {}
+        self.waits = None
+        self.setup_started = None
 
     def crawl(self, job):
         """Crawls a set of urls in batches."""
         self.job = job
         wl_log.info("Starting new crawl")
         wl_log.info(pformat(self.job))
-        for self.job.batch in range(self.job.batches):
-            wl_log.info("**** Starting batch %s ***" % self.job.batch)
-            self._do_batch()
-            sleep(float(self.job.config['pause_between_batches']))
+        try:
+            for self.job.batch in range(self.job.batches):
+                wl_log.info("**** Starting batch %s ***" % self.job.batch)
+                self._do_batch()
+                sleep(float(self.job.config['pause_between_batches']))
+        finally:
+            self._flush_screenshots()
+            self.retrier.summary()
+            self._recycle_browsers()  # quits the browsers kept for reuse
+            if self.controller is not None:
+                self.controller.close()
 
     def _do_batch(self):
         """
@@ -39,46 +77,246 @@ class VideoCrawler(object):
         If the controller is configured to not pollute the profile, each
         restart forces to switch the entry guard.
         """
+        # a browser kept for reuse must not outlive the Tor process
+        self._recycle_browsers()
         if self.controller is None:
-            for self.job.site in range(len(self.job.urls)):
-                if len(self.job.url) > cm.MAX_FNAME_LENGTH:
-                    wl_log.warning("URL is too long: %s" % self.job.url)
-                    continue
-                self._do_instance()
-                sleep(float(self.job.config['pause_between_videos']))
+            with self._batch_capture():
+                self._do_sites()
         else:
             with self.controller.launch():
-                for self.job.site in range(len(self.job.urls)):
-                    if len(self.job.url) > cm.MAX_FNAME_LENGTH:
-                        wl_log.warning("URL is too long: %s" % self.job.url)
-                        continue
-                    self._do_instance()
-                    sleep(float(self.job.config['pause_between_videos']))
+                # a standby Tor process may have moved to other ports
+                for driver in self.drivers:
+                    driver.use_tor_ports(self.controller.socks_port,
+                                         self.controller.control_port)
+                if self.job.batch < self.job.batches - 1:
+                    self.controller.prepare_standby()
+                with self._batch_capture():
+                    self._do_sites()
+                # nothing is captured until the next batch
+                self.controller.wake_standby()
+
+    def _do_sites(self):
+        for self.job.site in range(len(self.job.urls)):
+            if not self._is_valid_site(self.job):
+                continue
+            self._do_instance()
+            sleep(float(self.job.config['pause_between_videos']))
+
+    def crawl_units(self, job, batch, units):
+        """Crawls the (site, visit) units of one batch.
+
+        Used by the parallel mode, where a shared work queue hands out
+        the units to each worker.
+        """
+        self.job = job
+        self.job.batch = batch
+        try:
+            if self.controller is None:
+                with self._batch_capture():
+                    self._do_units(units)
+            else:
+                with self.controller.launch(), self._batch_capture():
+                    self._do_units(units)
+        finally:
+            self._flush_screenshots()
+            self.retrier.summary()
+            self._recycle_browsers()
+
+    def _do_units(self, units):
+        site = None
+        for self.job.site, self.job.visit in units:
+            if not self._is_valid_site(self.job):
+                continue
+            # the queue hands out the units site by site, as _do_sites
+            # crawls them, so pause when the worker moves to a new site
+            if site is not None and site != self.job.site:
+                sleep(float(self.job.config['pause_between_videos']))
+            site = self.job.site
+            if self._do_load():
+                sleep(float(self.job.config['pause_between_loads']))
+
+    def _is_valid_site(self, job):
+        if job.video is None:
+            return False  # malformed entry, reported by the video list
+        if len(job.url) > cm.MAX_FNAME_LENGTH:
+            wl_log.warning("URL is too long: %s" % job.url)
+            return False
+        return True
+
+    def _recycle_browsers(self):
+        for driver in self.drivers:
+            driver.recycle()
 
     def _do_instance(self):
         for self.job.visit in range(self.job.visits):
-            ut.create_dir(self.job.path)
-            wl_log.info("*** Visit %s to %s ***", self.job.visit, self.job.url)
-            wl_log.info("*** Expected playback time is %s seconds ***", self.job.playback_time)
-            self.job.screen_num = 0
-            with self.driver.launch():
-                try:
-                    self.driver.set_page_load_timeout(cm.SOFT_VISIT_TIMEOUT)
-                except WebDriverException as seto_exc:
-                    wl_log.error("Setting soft timeout %s", seto_exc)
-                visit_successful = self._do_visit()
-                if not visit_successful:
-                    ut.delete_dir(self.job.path)
-                    continue
-            sleep(float(self.job.config['pause_between_loads']))
+            if self._do_load():
+                sleep(float(self.job.config['pause_between_loads']))
+
+    def _do_load(self):
+        """Launches the browser and visits the current url once.
+
+        Returns whether the visit was successful. The directory of an
+        unsuccessful visit is deleted, and units that the journal
+        records as successful are skipped. A visit that the platform
+        blocked is retried, as the retrier decides.
+        """
+        if self.job.is_done():
+            wl_log.info("Skipping %s, already crawled", self.job.path)
+            return False
+        for self.job.attempt in itertools.count():
+            visit = self._setup_load(self.job, self.driver)
+            with visit.browser:
+                self._run_load(visit)
+            # the time since the previous visit is charged to this one
+            visit.phases = metrics.take_spans()
+            self._finish_load(visit)
+            delay = self.retrier.retry_delay(visit)
+            if delay is None:
+                return visit.successful
+            sleep(delay)
+            self.retrier.new_identity()
+
+    def _setup_load(self, job, driver):
+        """Creates the directory of a visit and launches its browser.
+
+        The browser is quit, or kept for reuse, when `visit.browser`
+        is exited.
+        """
+        visit = Visit(job, driver)
+        ut.create_dir(job.path)
+        wl_log.info("*** Visit %s to %s ***", job.visit, job.url)
+        wl_log.info("*** Expected playback time is %s seconds ***", job.playback_time)
+        with ExitStack() as stack:
+            stack.enter_context(driver.launch())
+            try:
+                driver.set_page_load_timeout(cm.SOFT_VISIT_TIMEOUT)
+            except WebDriverException as seto_exc:
+                wl_log.error("Setting soft timeout %s", seto_exc)
+            visit.browser = stack.pop_all()
+        return visit
+
+    def _run_load(self, visit):
+        """Visits the url of a visit that was set up, while capturing."""
+        self.job, self.driver = visit.job, visit.driver
+        self.visit_meta = visit.meta
+        self.waits = waits.Waiter(self.driver, self.visit_meta['waits'])
+        self.job.screen_num = 0
+        self.retrier.prepare(self.job.url)
+        with self._tor_events():
+            visit.successful = self._do_visit()
+        pcap_file = self.job.pcap_file
+        visit.capture_bytes = getsize(pcap_file) if isfile(pcap_file) else None
+        if visit.successful:
+            self.visit_meta['guards'] = self._guard_snapshot()
+            self._check_guards()
+            self._write_visit_meta()
+        else:
+            if not self.visit_meta.get('blocked'):
+                self.driver.recycle()  # a blocked visit did not break it
+            # a retry recreates the directory, which queued screenshots
+            # of this attempt must not end up in
+            self._flush_screenshots()
+            ut.delete_dir(self.job.path)
+
+    def _finish_load(self, visit):
+        """Records the outcome of a visit once its browser is released."""
+        visit.job.record(visit.successful, visit.started)
+        self.retrier.record(visit)
+        self._write_visit_record(visit)
+
+    def _write_visit_record(self, visit):
+        job = visit.job
+        termination = visit.meta.get('termination', {})
+        metrics.write_record(join(cm.CRAWL_DIR, cm.VISITS_FILENAME), {
+            'url': job.url, 'platform': metrics.platform(job.url),
+            'batch': job.batch, 'site': job.start + job.site,
+            'visit': job.visit, 'dir': basename(job.path),
+            'device': self.device, 'started': visit.started,
+            'duration': round(time() - visit.started, 3),
+            'outcome': 'success' if visit.successful else 'failed',
+            'end_reason': termination.get('reason'),
+            'blocked': visit.meta.get('blocked', False),
+            'page_class': visit.meta.get('pages', [{}])[-1].get('class'),
+            'attempt': job.attempt,
+            'exit': visit.meta.get('tor_events', {}).get('exit'),
+            'phases': visit.phases, 'capture_bytes': visit.capture_bytes})
+
+    @contextmanager
+    def _batch_capture(self):
+        """Captures the whole batch into one file, which is split into
+        the captures of the visits, when batch capture is enabled."""
+        if self.batch_capture is None:
+            yield
+            return
+        name = 'batch_%d_%s' % (self.job.batch, self.device)
+        self.batch_pcap = join(cm.CRAWL_DIR, name + '.pcap')
+        if isfile(self.batch_pcap):
+            os.remove(self.batch_pcap)  # left by an interrupted crawl
+        self.batch_filter, self.batch_hosts = self._capture_filter()
+        sniffer = Sniffer(path=self.batch_pcap, filter=self.batch_filter,
+                          device=self.device,
+                          dumpcap_log=join(cm.LOGS_DIR, name + '.log'),
+                          backend=self.capture_backend, rotate=0)
+        self.splitter = PcapSplitter(self.batch_pcap,
+                                     live=self.batch_capture == 'live')
+        self.splitter.start()
+        try:
+            with sniffer:
+                yield
+        finally:
+            self.splitter.finish()
+            self.splitter = None
+
+    @contextmanager
+    def _tor_events(self):
+        """Records the Tor events of the visit next to its capture."""
+        if self.controller is None:
+            yield
+            return
+        with self.controller.timeline.record(self.job.tor_events_file) as summary:
+            yield
+        self.visit_meta['tor_events'] = summary
+
+    @contextmanager
+    def _visit_capture(self):
+        """Captures the current visit, with its own capture or as a
+        window of the batch capture."""
+        if self.splitter is not None:
+            self.visit_meta['capture_filter'] = self.batch_filter
+            self.visit_meta['capture_hosts'] = self.batch_hosts
+            window = self.splitter.begin_visit(self.job.pcap_file)
+            try:
+                yield
+            finally:
+                packets = self.splitter.end_visit(window)
+                if self.splitter.live:
+                    self.visit_meta['capture'] = {'packets': packets}
+        else:
+            capture_filter, hosts = self._capture_filter()
+            self.visit_meta['capture_filter'] = capture_filter
+            self.visit_meta['capture_hosts'] = hosts
+            sniffer = Sniffer(path=self.job.pcap_file, filter=capture_filter,
+                              device=self.device, dumpcap_log=self.job.pcap_log,
+                              backend=self.capture_backend)
+            try:
+                with sniffer:
+                    yield
+            finally:
+                # kernel drop statistics, with the afpacket backend only
+                if sniffer.stats is not None:
+                    self.visit_meta['capture'] = sniffer.stats
 
     def _do_visit(self):
-        with Sniffer(path=self.job.pcap_file, filter=cm.DEFAULT_FILTER,
-                     device=self.device, dumpcap_log=self.job.pcap_log):
+        with self._visit_capture():
             try:
-                with ut.timeout(cm.HARD_VISIT_TIMEOUT):
+                with deadline(cm.HARD_VISIT_TIMEOUT, [self.driver.kill],
+                              cm.HardTimeoutException):
                     # begin loading page
-                    self.driver.get(self.job.url)
+                    with metrics.span('page_load'):
+                        self.driver.get(self.job.url)
+                    self.setup_started = time()
+                    if not self._check_page('load'):
+                        return False
                     if 'youtube' in self.job.url:
                         return self._visit_youtube()
                     else: # it's Vimeo, Facebook, Rumble, or Dailymotion
@@ -96,48 +334,51 @@ class VideoCrawler(object):
         skip_button_xpath = "//button[@class='ytp-ad-skip-button ytp-button']"
         play_button_xpath = "//button[@aria-label='Play']"
         player_status = 4
-        screenshot_count = 0
+        banner_reject_xpath = "//button[@aria-label='Reject the use of cookies and other data for the purposes described']"
+        page_reject_xpath = "//button[@aria-label='Reject all']"
         time_0 = time()
-        sleep(5)
+        # wait for the cookies banner or page, or for the player
+        self.waits.until('youtube_page', EC.any_of(
+            EC.presence_of_element_located((By.XPATH, banner_reject_xpath)),
+            EC.presence_of_element_located((By.XPATH, page_reject_xpath)),
+            waits.player_api_ready()), cm.PAGE_READY_TIMEOUT)
 
         # deal with the cookies banner or page...
         # pressing TAB five times brings the buttons into view
         ActionChains(self.driver).send_keys(Keys.TAB * 5).perform()
         try:
-            reject_button_xpath = "//button[@aria-label='Reject the use of cookies and other data for the purposes described']"
-            reject_button = self.driver.find_element(By.XPATH, reject_button_xpath)
+            reject_button = self.driver.find_element(By.XPATH, banner_reject_xpath)
             ActionChains(self.driver).click(reject_button).perform()
             wl_log.info('Pressed Reject on cookies banner.')
-            sleep(5)
+            self.waits.until('youtube_banner_closed',
+                             EC.invisibility_of_element(reject_button),
+                             cm.BANNER_CLOSE_TIMEOUT)
         except:
             try:
-                reject_button_xpath = "//button[@aria-label='Reject all']"
-                reject_button = self.driver.find_element(By.XPATH, reject_button_xpath)
+                reject_button = self.driver.find_element(By.XPATH, page_reject_xpath)
                 ActionChains(self.driver).click(reject_button).perform()
                 wl_log.info('Pressed Reject on cookies page.')
-                sleep(5)
+                self.waits.until('youtube_banner_closed',
+                                 EC.invisibility_of_element(reject_button),
+                                 cm.BANNER_CLOSE_TIMEOUT)
             except:
                 pass
 
         # try to get an initial player status to see if this Tor
         # exit relay is blocked
+        self.waits.until('youtube_player', waits.player_api_ready(),
+                         cm.PAGE_READY_TIMEOUT)
         try:
             player_status = self.driver.execute_script(js)
         except WebDriverException:
             wl_log.error('Failed to get player status')
-            wl_log.info("Probably on the 'detected unusual traffic' page.")
+            self._check_page('player')
             return False
 
         # starting screenshot
-        if self.screenshots:
-            wl_log.info("Trying to take a screenshot.")
-            try:
-                self.driver.get_screenshot_as_file(self.job.png_file(screenshot_count))
-                screenshot_count += 1
-            except WebDriverException:
-                wl_log.error("Cannot get screenshot.")
+        self._take_screenshot()
 
-        while True:
+        def periodic_actions():
             # press play again if necessary
             try:
                 play_button = self.driver.find_element(By.XPATH, play_button_xpath)
@@ -154,47 +395,48 @@ class VideoCrawler(object):
                 pass
             loaded_fraction = self.driver.execute_script("return document.getElementById('movie_player').getVideoLoadedFraction()")
             wl_log.debug('Fraction of video loaded: ' + str(loaded_fraction))
-            # end when the video should end, or after 4 minutues, whichever is sooner
-            elapsed_time = time() - time_0
-            if elapsed_time > self.job.playback_time - 10 or elapsed_time > 240:
-                # ending screenshot
-                if self.screenshots:
-                    wl_log.info("Trying to take a screenshot.")
-                    try:
-                        self.driver.get_screenshot_as_file(self.job.png_file(screenshot_count))
-                        screenshot_count += 1
-                    except WebDriverException:
-                        wl_log.error("Cannot get screenshot.")
-                wl_log.info("Ending successful visit after " + str(time() - time_0) + " seconds.")
-                return True
-            sleep(10)
+
+        self._play_until_end(time_0, periodic_actions)
+        # ending screenshot
+        self._take_screenshot()
+        wl_log.info("Ending successful visit after " + str(time() - time_0) + " seconds.")
+        return True
 
     def _visit_other(self):
-        screenshot_count = 0
         # initialize time_0 variable here but reset it later
         time_0 = time()
 
         if 'vimeo' in self.job.url:
-            sleep(3)
+            play_button_xpath = "//button[@data-play-button='true']"
+            self.waits.until('vimeo_page', EC.any_of(
+                EC.element_to_be_clickable((By.ID, "onetrust-reject-all-handler")),
+                EC.element_to_be_clickable((By.XPATH, play_button_xpath))),
+                cm.PAGE_READY_TIMEOUT)
             # if cookies banner is covering the play button, deal with it
             try:
                 reject_button = self.driver.find_element(By.ID, "onetrust-reject-all-handler")
                 ActionChains(self.driver).click(reject_button).perform()
                 wl_log.info('Pressed Reject on cookies banner.')
-                sleep(2)
+                self.waits.until('vimeo_banner_closed',
+                                 EC.invisibility_of_element(reject_button),
+                                 cm.BANNER_CLOSE_TIMEOUT)
             except:
                 pass
             # Vimeo doesn't autoplay, so wait for the Play button to appear and start the video
-            wl_log.info("Waiting up to 30 seconds to click the play button.")
-            play_button_xpath = "//button[@data-play-button='true']"
-            WebDriverWait(self.driver, 30).until(EC.element_to_be_clickable((By.XPATH, play_button_xpath))).click()
+            self.waits.until('vimeo_play_button', EC.element_to_be_clickable(
+                (By.XPATH, play_button_xpath)), cm.PLAYER_READY_TIMEOUT,
+                required=True).click()
             time_0 = time()
 
         if 'dailymotion' in self.job.url:
-            sleep(3)
+            continue_without_xpath = '/html/body/div[2]/div/div/div[2]/div/div[1]/button'
+            like_button_xpath = "/html/body/div[1]/div/main/div/div[1]/div/div[1]/div/div[2]/div/div/div[2]/div[2]/button[2]"
+            self.waits.until('dailymotion_page', EC.any_of(
+                EC.element_to_be_clickable((By.XPATH, continue_without_xpath)),
+                EC.element_to_be_clickable((By.XPATH, like_button_xpath))),
+                cm.PAGE_READY_TIMEOUT)
             # if cookies banner is blocking, deal with it
             try:
-                continue_without_xpath = '/html/body/div[2]/div/div/div[2]/div/div[1]/button'
                 continue_without_button = self.driver.find_element(By.XPATH, continue_without_xpath)
                 ActionChains(self.driver).click(continue_without_button).perform()
                 wl_log.info('Pressed Continue Without on cookies banner.')
@@ -202,83 +444,225 @@ class VideoCrawler(object):
                 pass
             # Dailymotion will autoplay, but we'll wait for some elements to load before we
             # start the clock, so we don't end the capture too early
-            wl_log.info("Waiting up to 30 seconds for the Like button to appear.")
-            like_button_xpath = "/html/body/div[1]/div/main/div/div[1]/div/div[1]/div/div[2]/div/div/div[2]/div[2]/button[2]"
-            WebDriverWait(self.driver, 30).until(EC.element_to_be_clickable((By.XPATH, like_button_xpath)))
+            self.waits.until('dailymotion_like_button', EC.element_to_be_clickable(
+                (By.XPATH, like_button_xpath)), cm.PLAYER_READY_TIMEOUT,
+                required=True)
             time_0 = time()
 
         elif 'facebook' in self.job.url:
             # Facebook will autoplay, but we'll wait for some elements to load before we
             # start the clock, so we don't end the capture too early
-            wl_log.info("Waiting up to 30 seconds for the Like button to appear.")
             like_button_xpath = "/html/body/div[1]/div/div[1]/div/div[3]/div/div/div/div[1]/div[2]/div[1]/div/div/div[1]/div[2]/div[2]/div/div/div[1]/div/div[1]"
-            WebDriverWait(self.driver, 30).until(EC.element_to_be_clickable((By.XPATH, like_button_xpath)))
+            self.waits.until('facebook_like_button', EC.element_to_be_clickable(
+                (By.XPATH, like_button_xpath)), cm.PLAYER_READY_TIMEOUT,
+                required=True)
             time_0 = time()
 
         elif 'rumble' in self.job.url:
-            wl_log.info("Waiting up to 30 seconds for the video player to appear.")
-            WebDriverWait(self.driver, 30).until(EC.element_to_be_clickable((By.ID, "videoPlayer")))
-            video = self.driver.find_element(By.ID, "videoPlayer")
+            video = self.waits.until('rumble_player', EC.element_to_be_clickable(
+                (By.ID, "videoPlayer")), cm.PLAYER_READY_TIMEOUT, required=True)
             ActionChains(self.driver).click(video).perform()
             wl_log.info("Pressed play.")
             time_0 = time()
-            sleep(30)
-            # deal with Rumble ads which appear in an iframe
+            # deal with Rumble ads which appear in an iframe: wait until
+            # the ad can be skipped, or the video plays without one
+            skip_button_xpath = "//button[@aria-label='Skip Ad']"
             try:
-                iframe = self.driver.find_elements(By.TAG_NAME,'iframe')[0]
-                self.driver.switch_to.frame(iframe)
-                skip_button_xpath = "//button[@aria-label='Skip Ad']"
-                skip_button = self.driver.find_element(By.XPATH, skip_button_xpath)
-                ActionChains(self.driver).click(skip_button).perform()
-                wl_log.info("Pressed Skip Ad button.")
+                skip_button = self.waits.until('rumble_ad', waits.ad_skip_or_playback(
+                    (By.XPATH, skip_button_xpath)), cm.AD_SKIP_TIMEOUT)
+                if isinstance(skip_button, WebElement):
+                    ActionChains(self.driver).click(skip_button).perform()
+                    wl_log.info("Pressed Skip Ad button.")
             except:
                 pass
             finally:
                 self.driver.switch_to.default_content()
 
-        sleep(3)
+        self.waits.until('playback_start', waits.video_playing(),
+                         cm.PLAYBACK_START_TIMEOUT)
         # starting screenshot
-        if self.screenshots:
-            wl_log.info("Trying to take a screenshot.")
-            try:
-                self.driver.get_screenshot_as_file(self.job.png_file(screenshot_count))
-                screenshot_count += 1
-            except WebDriverException:
-                wl_log.error("Cannot get screenshot.")
+        self._take_screenshot()
+        self._play_until_end(time_0, lambda: wl_log.debug('Heartbeat.'))
+        # ending screenshot
+        self._take_screenshot()
+        wl_log.info("Ending successful visit after " + str(time() - time_0) + " seconds.")
+        return True
+
+    def _play_until_end(self, time_0, periodic_actions):
+        """Waits until the termination policy ends the visit.
+
+        `periodic_actions` (pressing play, skipping ads...) run every
+        `PERIODIC_ACTION_INTERVAL` seconds in between. The policy and the
+        reason for ending are recorded in the visit metadata.
+        """
+        # cookie banners, play buttons, ads and the first screenshot
+        playback_started = time()
+        metrics.add_span('player_setup', playback_started - self.setup_started)
+        self.termination.start(self, time_0)
+        next_actions = time()
+        next_screenshot = (next_actions + self.screenshot_interval
+                           if self.screenshot_interval else float('inf'))
         while True:
-            wl_log.debug('Heartbeat.')
-            # end when the video should end, or after 4 minutues, whichever is sooner
-            elapsed_time = time() - time_0
-            if elapsed_time > self.job.playback_time - 10 or elapsed_time > 240:
-                # ending screenshot
-                if self.screenshots:
-                    wl_log.info("Trying to take a screenshot.")
-                    try:
-                        self.driver.get_screenshot_as_file(self.job.png_file(screenshot_count))
-                        screenshot_count += 1
-                    except WebDriverException:
-                        wl_log.error("Cannot get screenshot.")
-                wl_log.info("Ending successful visit after " + str(time() - time_0) + " seconds.")
-                return True
-            sleep(10)
+            now = time()
+            if now >= next_actions:
+                periodic_actions()
+                next_actions = now + cm.PERIODIC_ACTION_INTERVAL
+                now = time()
+            if now >= next_screenshot:
+                self._take_screenshot()
+                next_screenshot = now + self.screenshot_interval
+                now = time()
+            reason = self.termination.check(now)
+            if reason:
+                break
+            sleep(max(min(self.termination.wait_time(now),
+                          next_actions - now, next_screenshot - now), 0))
+        metrics.add_span('playback', time() - playback_started)
+        wl_log.info("Ending playback (%s policy): %s",
+                    self.termination.name, reason)
+        self.visit_meta['termination'] = {'policy': self.termination.name,
+                                          'reason': reason,
+                                          'playback_time': now - time_0}
+
+    def _check_page(self, stage):
+        """Classifies the current page and records it in the visit
+        metadata under `pages`. Returns False on a block, captcha or
+        error page, and marks the visit as blocked on the first two."""
+        page = pages.classify_page(self.driver)
+        page['stage'] = stage
+        self.visit_meta.setdefault('pages', []).append(page)
+        if page['class'] not in pages.FAILED_CLASSES:
+            return True
+        wl_log.warning("Visit to %s on a %s page (%s)", self.job.url,
+                       page['class'], page['signature'])
+        if page['class'] in pages.BLOCK_CLASSES:
+            self.visit_meta['blocked'] = True
+        return False
+
+    def _capture_filter(self):
+        """The capture filter for the visit or batch that starts, and
+        the addresses it is limited to, or None.
+
+        With `filter_guards`, it only lets through the traffic to the
+        entry guards and bridges of the Tor process, or DNS and HTTPS
+        without Tor. It falls back to `DEFAULT_FILTER` when these are
+        unknown or too many for a filter.
+        """
+        if not self.filter_guards:
+            return cm.DEFAULT_FILTER, None
+        if self.controller is None:
+            return combine_filters(cm.WITHOUT_TOR_FILTER, cm.DEFAULT_FILTER), None
+        try:
+            addresses = self.controller.get_entry_addresses()
+        except Exception as exc:
+            wl_log.warning("Cannot get the entry guards: %s", exc)
+            addresses = None
+        if not addresses or len(addresses) > cm.MAX_FILTER_HOSTS:
+            wl_log.warning("Capturing with the default filter, %s entry "
+                           "addresses", len(addresses) if addresses else 'no')
+            return cm.DEFAULT_FILTER, None
+        return host_filter(addresses, cm.DEFAULT_FILTER), addresses
+
+    def _guard_snapshot(self):
+        """The addresses of the guards of the current circuits."""
+        if self.controller is None:
+            return None
+        try:
+            return self.controller.get_guard_ips()
+        except Exception as exc:
+            wl_log.warning("Cannot get the guards: %s", exc)
+            return None
+
+    def _check_guards(self):
+        """Warn if Tor moved to a guard that the capture filter, fixed
+        when the capture started, left out (see `tbcrawler.sanity`)."""
+        hosts = self.visit_meta.get('capture_hosts')
+        guards = self.visit_meta.get('guards')
+        if hosts is None or guards is None:
+            return
+        missed = sorted(set(guards) - set(hosts))
+        if missed:
+            wl_log.warning("The capture filter left out the guards %s",
+                           ', '.join(missed))
+
+    def _take_screenshot(self):
+        """Fetches a screenshot and leaves writing it to the writer."""
+        if not self.screenshots:
+            return
+        wl_log.info("Trying to take a screenshot.")
+        try:
+            png = self.driver.get_screenshot_as_png()
+        except WebDriverException:
+            wl_log.error("Cannot get screenshot.")
+            return
+        self.screenshot_writer.submit(png, self.job.png_file(self.job.screen_num))
+        self.job.screen_num += 1
+
+    def _flush_screenshots(self):
+        if self.screenshot_writer is not None:
+            self.screenshot_writer.flush()
+
+    def capture_size(self):
+        """Bytes captured so far during the current visit.
+
+        When the batch capture is split after the batch, this is the
+        size of the batch capture, which grows just as much.
+        """
+        pcap_file = self.job.pcap_file
+        if self.splitter is not None and not self.splitter.live:
+            pcap_file = self.batch_pcap
+        return getsize(pcap_file) if isfile(pcap_file) else 0
+
+    def _write_visit_meta(self):
+        with open(self.job.meta_file, 'w') as f:
+            json.dump(self.visit_meta, f, indent=1, sort_keys=True)
+
+
+class Visit(object):
+    """The state of one visit, from the launch of its browser to the
+    record of its outcome."""
+
+    def __init__(self, job, driver):
+        self.job = job
+        self.driver = driver
+        self.started = time()
+        self.meta = {'url': job.url, 'batch': job.batch,
+                     'site': job.start + job.site, 'visit': job.visit,
+                     'playback_time': job.playback_time,
+                     'started': self.started, 'waits': []}
+        self.browser = None
+        self.successful = False
+        self.capture_bytes = None
+        self.phases = {}
+
 
 class CrawlJob(object):
-    def __init__(self, config, urls, start):
+    def __init__(self, config, urls, start, journal=None):
         self.urls = urls
         self.visits = int(config['visits'])
         self.batches = int(config['batches'])
         self.config = config
         self.start = start - 1
+        self.journal = journal
 
         # state
         self.site = 0
         self.visit = 0
         self.batch = 0
+        self.attempt = 0  # retries of the current unit after a block
 
     @property
     def pcap_file(self):
         return join(self.path, "capture.pcap")
 
+    @property
+    def meta_file(self):
+        return join(self.path, "visit.json")
+
+    @property
+    def tor_events_file(self):
+        return join(self.path, "tor_events.jsonl")
+
     @property
     def pcap_log(self):
         return join(self.path, "dump.log")
@@ -287,19 +671,39 @@ class CrawlJob(object):
     def instance(self):
         return self.batch * self.visits + self.visit
 
+    @property
+    def video(self):
+        """The (url, playback time) entry of the current site."""
+        return self.urls[self.site]
+
     @property
     def url(self):
-        return self.urls[self.site][0]
+        return self.video[0]
 
     @property
     def playback_time(self):
-        return self.urls[self.site][1]
+        return self.video[1]
 
     @property
     def path(self):
         attributes = [self.batch, self.start + self.site, self.instance]
         return join(cm.CRAWL_DIR, "_".join(map(str, attributes)))
 
+    def is_done(self):
+        """Whether the journal records the current unit as successful."""
+        if self.journal is None:
+            return False
+        return self.journal.succeeded(self.batch, self.start + self.site,
+                                      self.visit, self.url)
+
+    def record(self, successful, started):
+        """Record the outcome of the current unit in the journal."""
+        if self.journal is None:
+            return
+        outcome = SUCCESS if successful else FAILED
+        self.journal.record(self.batch, self.start + self.site, self.visit,
+                            self.url, outcome, started, self.path)
+
     def png_file(self, time):
         return join(self.path, "screenshot_{}.png".format(time))
 
@@ -0,0 +1,126 @@
+"""Deadlines for blocks of code, in any thread.
+
+`deadline(seconds)` bounds the time a block runs in the calling thread.
+A single watchdog thread keeps the deadlines of all threads, so they
+can nest and be set from worker threads, with sub-second resolution.
+When a deadline passes, the watchdog raises the deadline's exception in
+the thread, asynchronously (`PyThreadState_SetAsyncExc`). Python only
+raises it between bytecodes, so a thread blocked in a call (waiting on
+geckodriver, say) does not see it until the call returns: if the block
+is still running `DEADLINE_GRACE` seconds later, the watchdog runs the
+deadline's `on_expire` callbacks, which should make the call return,
+e.g. by killing the browser.
+"""
+import ctypes
+import heapq
+import itertools
+import threading
+from contextlib import contextmanager
+from time import time
+
+import tbcrawler.common as cm
+from tbcrawler.log import wl_log
+
+
+def _raise_in_thread(thread_id, exc_type):
+    """Raise `exc_type` in a thread, or clear its pending exception if
+    `exc_type` is None."""
+    ctypes.pythonapi.PyThreadState_SetAsyncExc(
+        ctypes.c_ulong(thread_id),
+        ctypes.py_object(exc_type) if exc_type else ctypes.c_void_p(0))
+
+
+class _Deadline(object):
+    def __init__(self, seconds, on_expire, exception):
+        self.seconds = seconds
+        self.thread_id = threading.get_ident()
+        self.expires = time() + seconds
+        self.on_expire = on_expire
+        # a class of its own, so that nested deadlines tell theirs apart
+        self.exc_type = type(exception.__name__, (exception,), {})
+        self.expired = False
+        self.active = True
+
+
+class Watchdog(threading.Thread):
+    """Enforces the deadlines of all threads."""
+
+    def __init__(self):
+        super(Watchdog, self).__init__(name='watchdog', daemon=True)
+        self.condition = threading.Condition()
+        self.heap = []  # (time, sequence, deadline)
+        self.sequence = itertools.count()
+
+    def add(self, deadline):
+        with self.condition:
+            heapq.heappush(self.heap, (deadline.expires, next(self.sequence),
+                                       deadline))
+            self.condition.notify()
+
+    def cancel(self, deadline):
+        """Stop enforcing a deadline; return whether it had expired."""
+        with self.condition:
+            deadline.active = False
+            return deadline.expired
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.heap and not self.heap[0][2].active:
+                    heapq.heappop(self.heap)
+                if not self.heap:
+                    self.condition.wait()
+                    continue
+                when, _, deadline = self.heap[0]
+                if when > time():
+                    self.condition.wait(when - time())
+                    continue
+                heapq.heappop(self.heap)
+                if not deadline.expired:
+                    deadline.expired = True
+                    _raise_in_thread(deadline.thread_id, deadline.exc_type)
+                    # the callbacks run if the block is still running then
+                    heapq.heappush(self.heap, (when + cm.DEADLINE_GRACE,
+                                               next(self.sequence), deadline))
+                    continue
+            wl_log.warning("Deadline of %s s passed %s s ago, cancelling",
+                           deadline.seconds, cm.DEADLINE_GRACE)
+            for callback in deadline.on_expire:
+                try:
+                    callback()
+                except Exception as exc:
+                    wl_log.error("Cannot cancel after the deadline: %s", exc)
+
+
+_watchdog = None
+_watchdog_lock = threading.Lock()
+
+
+def watchdog():
+    """The watchdog thread, started on first use."""
+    global _watchdog
+    with _watchdog_lock:
+        if _watchdog is None or not _watchdog.is_alive():
+            _watchdog = Watchdog()
+            _watchdog.start()
+    return _watchdog
+
+
+@contextmanager
+def deadline(seconds, on_expire=(), exception=cm.TimeoutException):
+    """Raise `exception` in the block if it runs for more than `seconds`.
+
+    `on_expire` are called from the watchdog thread if the block still
+    runs `DEADLINE_GRACE` seconds after the deadline.
+    """
+    entry = _Deadline(seconds, on_expire, exception)
+    dog = watchdog()
+    dog.add(entry)
+    try:
+        yield
+    except entry.exc_type:
+        raise exception("Timed out after %s s" % seconds)
+    finally:
+        if dog.cancel(entry):
+            # expired as the block ended, the exception may still be pending
+            _raise_in_thread(entry.thread_id, None)
@@ -5,21 +5,50 @@ import psutil
 
 import tbcrawler.common as cm
 import tbcrawler.utils as ut
+from tbcrawler.afpacket import RingCapture
 from tbcrawler.log import wl_log
+from tbcrawler.metrics import span
 
 DUMPCAP_START_TIMEOUT = 10.0
 
 
+CAPTURE_BACKENDS = ('tcpdump', 'afpacket')
+
+
+def combine_filters(*filters):
+    """Return a capture filter matching all the non-empty `filters`."""
+    filters = [f for f in filters if f]
+    if len(filters) == 1:
+        return filters[0]
+    return ' and '.join('(%s)' % f for f in filters)
+
+
+def host_filter(addresses, base_filter=cm.DEFAULT_FILTER):
+    """Return a capture filter for the traffic to or from `addresses`,
+    within `base_filter` if there is one."""
+    return combine_filters(' or '.join('host %s' % address
+                                       for address in sorted(addresses)),
+                           base_filter)
+
+
 class Sniffer(object):
-    """Capture network traffic using dumpcap."""
+    """Capture network traffic using tcpdump, or in process on an
+    AF_PACKET ring (see tbcrawler.afpacket)."""
 
-    def __init__(self, path="/dev/null", filter="", device="eth0", dumpcap_log=None):
+    def __init__(self, path="/dev/null", filter="", device="eth0", dumpcap_log=None,
+                 backend=cm.DEFAULT_CAPTURE_BACKEND, rotate=None):
         self.pcap_file = path
         self.pcap_filter = filter
         self.p0 = None
+        self.ring = None
         self.is_recording = False
         self.device = device
         self.log = dumpcap_log
+        self.backend = backend
+        # tcpdump starts over the capture after this time, by default the
+        # hard visit timeout when the capture starts; 0 never rotates
+        self.rotate = rotate
+        self.stats = None
 
     def set_pcap_path(self, pcap_filename):
         """Set filename and filter options for capture."""
@@ -36,15 +65,31 @@ class Sniffer(object):
         """Return capture filter."""
         return self.pcap_filter
 
+    def tcpdump_command(self):
+        prefix = ""
+        # -U writes every packet at once, so the capture size is live, and
+        # --immediate-mode stops libpcap from buffering packets for up to
+        # a second before tcpdump gets them, after a live split window
+        # of the batch capture may have closed
+        seconds = cm.HARD_VISIT_TIMEOUT if self.rotate is None else self.rotate
+        rotate = '-G {} '.format(seconds) if seconds else ''
+        return '{}tcpdump -U --immediate-mode {}-i {} -s {} -w {} \'{}\'' \
+            .format(prefix, rotate, self.device, cm.SNAPLEN,
+                    self.pcap_file, self.pcap_filter)
+
     def start_capture(self, pcap_path=None, pcap_filter="", dumpcap_log=None):
         """Start capture. Configure sniffer if arguments are given."""
         if pcap_filter:
             self.set_capture_filter(pcap_filter)
         if pcap_path:
             self.set_pcap_path(pcap_path)
-        prefix = ""
-        command = '{}tcpdump -G {} -i {} -s 71 -w {} \'{}\'' \
-                .format(prefix, cm.HARD_VISIT_TIMEOUT, self.device, self.pcap_file, self.pcap_filter)
+        if self.backend == 'afpacket':
+            self.ring = RingCapture(self.pcap_file, self.device,
+                                    self.pcap_filter, cm.SNAPLEN)
+            self.ring.start()
+            self.is_recording = True
+            return
+        command = self.tcpdump_command()
         # command = '{}dumpcap -P -a duration:{} -a filesize:{} -i {} -s 0 -f \'{}\' -w {}'\
         #     .format(prefix, cm.HARD_VISIT_TIMEOUT, cm.MAX_DUMP_SIZE, self.device,
         #             self.pcap_filter, self.pcap_file)
@@ -74,7 +119,17 @@ class Sniffer(object):
         return False
 
     def stop_capture(self):
-        """Kill the dumpcap process."""
+        """Kill the dumpcap process, or stop the AF_PACKET capture."""
+        if self.ring is not None:
+            self.stats = self.ring.stop()
+            self.ring = None
+            self.is_recording = False
+            log = wl_log.warning if self.stats['drops'] else wl_log.info
+            log('AF_PACKET capture stopped. Capture size: %s Bytes %s, '
+                '%d packets written, %d dropped by the kernel',
+                os.path.getsize(self.pcap_file), self.pcap_file,
+                self.stats['written'], self.stats['drops'])
+            return
         ut.kill_all_children(self.p0.pid)  # self.p0.pid is the shell pid
         self.p0.kill()
         self.is_recording = False
@@ -88,11 +143,13 @@ class Sniffer(object):
                            % self.log)
 
     def __enter__(self):
-        self.start_capture(dumpcap_log=self.log)
+        with span('capture_start'):
+            self.start_capture(dumpcap_log=self.log)
         return self
 
     def __exit__(self, type, value, traceback):
-        self.stop_capture()
+        with span('capture_stop'):
+            self.stop_capture()
 
 
 class DumpcapTimeoutError(Exception):
@@ -0,0 +1,103 @@
+import json
+import os
+import sqlite3
+import threading
+from time import time
+
+SUCCESS = 'success'
+FAILED = 'failed'
+REQUEUED = 'requeued'  # flagged after the crawl, to be crawled again
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS units (
+    batch INTEGER NOT NULL,
+    site INTEGER NOT NULL,
+    visit INTEGER NOT NULL,
+    url TEXT NOT NULL,
+    outcome TEXT NOT NULL,
+    started REAL NOT NULL,
+    duration REAL NOT NULL,
+    path TEXT NOT NULL,
+    PRIMARY KEY (batch, site, visit)
+)"""
+# the arguments that select the units, which a resumed crawl must repeat
+PARAMETERS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS parameters (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+)"""
+
+
+class CrawlJournal(object):
+    """Durable record of the outcome of every crawled unit.
+
+    A unit is a (batch, site, visit) triple, where site is the index of
+    the video in the url file, so that a resumed crawl finds the same
+    units as long as it is started with the same url file, which is
+    checked with the crawl parameters recorded in it. The journal
+    is an SQLite database and each process (e.g. each parallel worker)
+    opens its own connection to it, which its threads share.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._connection = None
+        self._pid = None
+        self._lock = threading.Lock()
+        with self._lock, self.connection:
+            self.connection.execute(SCHEMA)
+            self.connection.execute(PARAMETERS_SCHEMA)
+
+    @property
+    def connection(self):
+        if self._pid != os.getpid():
+            self._connection = sqlite3.connect(self.path, timeout=60,
+                                               check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._pid = os.getpid()
+        return self._connection
+
+    def record(self, batch, site, visit, url, outcome, started, path):
+        """Record the outcome of a unit, replacing earlier attempts."""
+        with self._lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO units VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (batch, site, visit, url, outcome, started, time() - started,
+                 path))
+
+    def record_parameters(self, parameters):
+        """Record the parameters of the crawl, keeping those recorded
+        when it was started."""
+        with self._lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO parameters VALUES (?, ?)",
+                [(name, json.dumps(value))
+                 for name, value in parameters.items()])
+
+    def parameters(self):
+        """Return the recorded parameters of the crawl."""
+        with self._lock:
+            return {name: json.loads(value) for name, value in
+                    self.connection.execute("SELECT name, value FROM parameters")}
+
+    def succeeded(self, batch, site, visit, url):
+        """Whether the unit has already been crawled successfully."""
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT 1 FROM units WHERE batch = ? AND site = ? AND visit = ? "
+                "AND url = ? AND outcome = ?",
+                (batch, site, visit, url, SUCCESS)).fetchone()
+        return row is not None
+
+    def requeue(self, batch, site, visit):
+        """Mark a unit to be crawled again when the crawl is resumed."""
+        with self._lock, self.connection:
+            self.connection.execute(
+                "UPDATE units SET outcome = ? WHERE batch = ? AND site = ? "
+                "AND visit = ?", (REQUEUED, batch, site, visit))
+
+    def counts(self):
+        """Return the number of recorded units per outcome."""
+        with self._lock:
+            return dict(self.connection.execute(
+                "SELECT outcome, COUNT(*) FROM units GROUP BY outcome"))
@@ -0,0 +1,181 @@
+"""Phase timing of the visits and its export.
+
+Code that takes time runs in a `span`, and the durations of the spans
+are summed per phase. Each visit takes the spans recorded since the
+previous visit, so that the time spent between visits (bootstrapping Tor
+for a batch, say) is charged to the visit that waited for it. One JSON
+record per visit is appended to visits.jsonl in the crawl directory.
+`MetricsServer` serves totals computed from that file in the Prometheus
+text format, so that they cover the visits of all the workers.
+"""
+import json
+import threading
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os.path import isfile
+from time import time
+from urllib.parse import urlparse
+
+from tbcrawler.log import wl_log
+
+PLATFORMS = ('youtube', 'vimeo', 'dailymotion', 'facebook', 'rumble')
+METRICS_PREFIX = 'tbcrawler'
+RATE_WINDOW = 3600  # visits per hour
+
+_lock = threading.Lock()
+_phases = defaultdict(float)
+
+
+@contextmanager
+def span(phase):
+    """Add the time spent in the block to `phase`."""
+    start = time()
+    try:
+        yield
+    finally:
+        add_span(phase, time() - start)
+
+
+def add_span(phase, duration):
+    with _lock:
+        _phases[phase] += duration
+
+
+def take_spans():
+    """Return and reset the phase durations recorded so far."""
+    global _phases
+    with _lock:
+        phases, _phases = _phases, defaultdict(float)
+    return {phase: round(duration, 3) for phase, duration in phases.items()}
+
+
+def platform(url):
+    """Return the video platform of a URL, or its host name."""
+    host = urlparse(url).hostname or ''
+    for name in PLATFORMS:
+        if name in host:
+            return name
+    return host
+
+
+def write_record(path, record):
+    """Append a visit record to a JSON lines file.
+
+    Each record is written at once to a file opened for appending, so
+    that the records of concurrent workers do not interleave.
+    """
+    with open(path, 'a') as f:
+        f.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+def read_records(path):
+    """Return the complete records of a JSON lines file, if it exists."""
+    records = []
+    if isfile(path):
+        with open(path) as f:
+            for line in f:
+                if line.endswith('\n'):
+                    records.append(json.loads(line))
+    return records
+
+
+class VisitStats(object):
+    """Totals of the visit records in a JSON lines file, read as it grows."""
+
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+        self.visits = defaultdict(int)
+        self.phase_seconds = defaultdict(float)
+        self.visit_seconds = 0.
+        self.captured_bytes = 0
+        self.recent = deque()  # (end time, outcome) of the recent visits
+
+    def update(self):
+        try:
+            with open(self.path) as f:
+                f.seek(self.offset)
+                for line in iter(f.readline, ''):
+                    if not line.endswith('\n'):
+                        break  # being written, read it next time
+                    self.offset += len(line.encode())
+                    self.add(json.loads(line))
+        except IOError:
+            pass
+        while self.recent and self.recent[0][0] < time() - RATE_WINDOW:
+            self.recent.popleft()
+
+    def add(self, record):
+        outcome = record['outcome']
+        self.visits[(record['platform'], outcome)] += 1
+        for phase, duration in record['phases'].items():
+            self.phase_seconds[phase] += duration
+        self.visit_seconds += record['duration']
+        self.captured_bytes += record.get('capture_bytes') or 0
+        self.recent.append((record['started'] + record['duration'], outcome))
+
+    def exposition(self):
+        """Return the totals in the Prometheus text format."""
+        p = METRICS_PREFIX
+        lines = ['# TYPE %s_visits_total counter' % p]
+        for (platform_, outcome), count in sorted(self.visits.items()):
+            lines.append('%s_visits_total{platform="%s",outcome="%s"} %d'
+                         % (p, platform_, outcome, count))
+        lines.append('# TYPE %s_visit_seconds_total counter' % p)
+        lines.append('%s_visit_seconds_total %.3f' % (p, self.visit_seconds))
+        lines.append('# TYPE %s_phase_seconds_total counter' % p)
+        for phase, seconds in sorted(self.phase_seconds.items()):
+            lines.append('%s_phase_seconds_total{phase="%s"} %.3f'
+                         % (p, phase, seconds))
+        lines.append('# TYPE %s_captured_bytes_total counter' % p)
+        lines.append('%s_captured_bytes_total %d' % (p, self.captured_bytes))
+        lines.append('# HELP %s_visits_last_hour Visits that ended within '
+                     'the last hour.' % p)
+        lines.append('# TYPE %s_visits_last_hour gauge' % p)
+        recent = defaultdict(int)
+        for _, outcome in self.recent:
+            recent[outcome] += 1
+        for outcome in ('success', 'failed'):
+            lines.append('%s_visits_last_hour{outcome="%s"} %d'
+                         % (p, outcome, recent[outcome]))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsServer(object):
+    """Serves the totals of a visits.jsonl file at /metrics on localhost."""
+
+    def __init__(self, path, port, host='127.0.0.1'):
+        stats = VisitStats(path)
+        lock = threading.Lock()
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                with lock:
+                    stats.update()
+                    body = stats.exposition().encode()
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       daemon=True, name='metrics')
+
+    def start(self):
+        self.thread.start()
+        wl_log.info("Serving metrics at http://%s:%d/metrics"
+                    % self.httpd.server_address[:2])
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,291 @@
+"""Pack the visit directories of a crawl into compressed archives.
+
+The visit directories are packed in shards of `PACK_SHARD_SIZE` visits,
+each a tar archive compressed with zstd (which needs the `zstandard`
+package) or xz, written by a process pool into the `packed` directory of
+the crawl. Every packed visit gets a line in `packed/manifest.jsonl`
+with its URL, platform, outcome, archive, the size and SHA-256 of each
+of its files, and the row `tbcrawler.sanity` indexes it with, since
+the packed directories are then removed. A visit is read back by
+decompressing its shard only up to its files.
+
+Packing is incremental: visits already in the manifest are skipped, and
+visits that are still being crawled are left alone, as are the visits of
+a batch whose batch capture is not split yet, so it can run while the
+crawl proceeds.
+"""
+import argparse
+import hashlib
+import json
+import lzma
+import os
+import re
+import shutil
+import sys
+import tarfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from os.path import basename, getmtime, getsize, isdir, isfile, join
+from time import time
+
+import tbcrawler.common as cm
+from tbcrawler import metrics
+from tbcrawler.journal import SUCCESS
+from tbcrawler.sanity import VISIT_DIR, check_visit
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+FORMATS = {'zstd': '.tar.zst', 'xz': '.tar.xz'}
+BATCH_CAPTURE = re.compile(r'^batch_(\d+)_.*\.pcap$')
+ZSTD_LEVEL = 10
+XZ_PRESET = 6
+
+
+class _HashingReader(object):
+    """Reads a file and computes its SHA-256 on the way."""
+
+    def __init__(self, f):
+        self.f = f
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.sha256.update(data)
+        return data
+
+
+def _open_archive(path, fmt, mode):
+    """Return (tarfile, underlying stream) for a streamed archive."""
+    if fmt == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("zstd archives need the zstandard package")
+        f = open(path, mode + 'b')
+        if mode == 'w':
+            stream = zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(f)
+        else:
+            stream = zstandard.ZstdDecompressor().stream_reader(f)
+    elif mode == 'w':
+        stream = lzma.open(path, 'wb', preset=XZ_PRESET)
+    else:
+        stream = lzma.open(path, 'rb')
+    return tarfile.open(fileobj=stream, mode=mode + '|'), stream
+
+
+def archive_format(path):
+    for fmt, suffix in FORMATS.items():
+        if path.endswith(suffix):
+            return fmt
+    raise ValueError("Unknown archive format: %s" % path)
+
+
+def pack_shard(visit_dirs, archive_path, fmt):
+    """Check the visit directories and write them to an archive.
+
+    Returns {visit name: {file name: {'size', 'sha256'}}} and
+    {visit name: index row}.
+    """
+    checks = {basename(visit_dir): check_visit(visit_dir)
+              for visit_dir in visit_dirs}
+    files = {}
+    tmp_path = archive_path + '.tmp'
+    tar, stream = _open_archive(tmp_path, fmt, 'w')
+    with stream, tar:
+        for visit_dir in visit_dirs:
+            name = basename(visit_dir)
+            files[name] = {}
+            for filename in sorted(os.listdir(visit_dir)):
+                path = join(visit_dir, filename)
+                if not isfile(path):
+                    continue
+                info = tar.gettarinfo(path, '%s/%s' % (name, filename))
+                with open(path, 'rb') as f:
+                    reader = _HashingReader(f)
+                    tar.addfile(info, reader)
+                files[name][filename] = {'size': info.size,
+                                         'sha256': reader.sha256.hexdigest()}
+    os.replace(tmp_path, archive_path)
+    return files, checks
+
+
+def read_manifest(crawl_dir):
+    """Return {visit name: manifest entry} of the packed visits."""
+    return {entry['dir']: entry
+            for entry in metrics.read_records(
+                join(crawl_dir, cm.PACK_DIRNAME, cm.PACK_MANIFEST))}
+
+
+def _newest_mtime(visit_dir):
+    return max([getmtime(visit_dir)] +
+               [getmtime(join(visit_dir, name)) for name in os.listdir(visit_dir)])
+
+
+def find_packable(crawl_dir, packed, min_age=cm.PACK_MIN_AGE):
+    """Return the visit directories that are finished and not packed.
+
+    A visit is finished once nothing in its directory has changed for
+    `min_age` seconds and, if the crawl writes visits.jsonl, once its
+    record is written. With `--batch-capture post`, the capture of a
+    visit is only written once its batch ends, so the visits of a batch
+    whose batch capture is still there are not finished.
+    """
+    visits_file = join(crawl_dir, cm.VISITS_FILENAME)
+    recorded = None
+    if isfile(visits_file):
+        recorded = set(record.get('dir') for record in
+                       metrics.read_records(visits_file))
+    names = sorted(os.listdir(crawl_dir))
+    capturing = set(match.group(1) for match in map(BATCH_CAPTURE.match, names)
+                    if match)
+    visit_dirs = []
+    for name in names:
+        path = join(crawl_dir, name)
+        if not VISIT_DIR.match(name) or not isdir(path) or name in packed:
+            continue
+        if recorded is not None and name not in recorded:
+            continue
+        if name.split('_')[0] in capturing:
+            continue
+        if time() - _newest_mtime(path) < min_age:
+            continue
+        visit_dirs.append(path)
+    return visit_dirs
+
+
+def _visit_info(visit_dir, records):
+    """The manifest fields of a visit, from its record or visit.json."""
+    record = records.get(basename(visit_dir))
+    if record is None:
+        record = {}
+        meta_file = join(visit_dir, 'visit.json')
+        if isfile(meta_file):
+            with open(meta_file) as f:
+                meta = json.load(f)
+            record = {'url': meta.get('url'), 'outcome': SUCCESS}
+            record['platform'] = metrics.platform(record['url'] or '')
+    return {key: record.get(key) for key in
+            ('url', 'platform', 'batch', 'site', 'visit', 'outcome')}
+
+
+def pack_crawl(crawl_dir, fmt='zstd', workers=None,
+               shard_size=cm.PACK_SHARD_SIZE, min_age=cm.PACK_MIN_AGE,
+               keep=False):
+    """Pack the finished visits of a crawl in a process pool.
+
+    Returns the number of packed, already packed and failed visits.
+    """
+    pack_dir = join(crawl_dir, cm.PACK_DIRNAME)
+    os.makedirs(pack_dir, exist_ok=True)
+    packed = read_manifest(crawl_dir)
+    if not keep:
+        # visits packed by a run that stopped before removing them
+        for name in packed:
+            if isdir(join(crawl_dir, name)):
+                shutil.rmtree(join(crawl_dir, name))
+    visit_dirs = find_packable(crawl_dir, packed, min_age)
+    records = {record.get('dir'): record for record in
+               metrics.read_records(join(crawl_dir, cm.VISITS_FILENAME))}
+    shard = len([name for name in os.listdir(pack_dir)
+                 if name.startswith('shard_') and not name.endswith('.tmp')])
+    done = failed = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for i in range(0, len(visit_dirs), shard_size):
+            archive = 'shard_%06d%s' % (shard, FORMATS[fmt])
+            shard += 1
+            shard_dirs = visit_dirs[i:i + shard_size]
+            futures[pool.submit(pack_shard, shard_dirs, join(pack_dir, archive),
+                                fmt)] = (archive, shard_dirs)
+        for future in as_completed(futures):
+            archive, shard_dirs = futures[future]
+            try:
+                files, checks = future.result()
+            except Exception as exc:
+                print("Cannot pack %s: %s" % (archive, exc), file=sys.stderr)
+                failed += len(shard_dirs)
+                continue
+            archive_bytes = getsize(join(pack_dir, archive))
+            for visit_dir in shard_dirs:
+                name = basename(visit_dir)
+                entry = _visit_info(visit_dir, records)
+                entry.update({'dir': name, 'archive': archive,
+                              'archive_bytes': archive_bytes,
+                              'bytes': sum(f['size'] for f in files[name].values()),
+                              'files': files[name], 'check': checks[name]})
+                metrics.write_record(join(pack_dir, cm.PACK_MANIFEST), entry)
+                if not keep:
+                    shutil.rmtree(visit_dir)
+            done += len(shard_dirs)
+    return done, len(packed), failed
+
+
+def read_visit(crawl_dir, name, verify=True):
+    """Return {file name: contents} of a packed visit.
+
+    Only the visit's shard is read, and only up to the visit's files.
+    """
+    entry = read_manifest(crawl_dir).get(name)
+    if entry is None:
+        raise KeyError("%s is not packed in %s" % (name, crawl_dir))
+    archive = join(crawl_dir, cm.PACK_DIRNAME, entry['archive'])
+    contents = {}
+    tar, stream = _open_archive(archive, archive_format(archive), 'r')
+    with stream, tar:
+        for info in tar:
+            visit, _, filename = info.name.partition('/')
+            if visit != name:
+                if contents:
+                    break  # the files of a visit are contiguous
+                continue
+            contents[filename] = tar.extractfile(info).read()
+    if verify:
+        for filename, expected in entry['files'].items():
+            data = contents.get(filename)
+            if data is None or hashlib.sha256(data).hexdigest() != expected['sha256']:
+                raise IOError("%s/%s does not match its checksum"
+                              % (name, filename))
+    return contents
+
+
+def unpack_visit(crawl_dir, name, dest_dir):
+    """Write the files of a packed visit to `dest_dir`/`name`."""
+    visit_dir = join(dest_dir, name)
+    os.makedirs(visit_dir, exist_ok=True)
+    for filename, data in read_visit(crawl_dir, name).items():
+        with open(join(visit_dir, filename), 'wb') as f:
+            f.write(data)
+    return visit_dir
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Pack the visits of a crawl into compressed archives.')
+    parser.add_argument('crawl_dir', help='Crawl results directory.')
+    parser.add_argument('--format', choices=sorted(FORMATS),
+                        default='zstd' if zstandard else 'xz',
+                        help='Compression (default: zstd if the zstandard '
+                             'package is installed, else xz).')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='Number of processes (default: one per CPU).')
+    parser.add_argument('--shard-size', type=int, default=cm.PACK_SHARD_SIZE,
+                        help='Visits per archive (default: %(default)s).')
+    parser.add_argument('--min-age', type=float, default=cm.PACK_MIN_AGE,
+                        help='Only pack visits unchanged for this many seconds '
+                             '(default: %(default)s).')
+    parser.add_argument('--keep', action='store_true', default=False,
+                        help='Keep the visit directories after packing them.')
+    parser.add_argument('--extract', nargs=2, metavar=('VISIT', 'DEST_DIR'),
+                        help='Unpack one visit, e.g. 0_12_3, instead of packing.')
+    args = parser.parse_args(argv)
+    if args.extract:
+        print(unpack_visit(args.crawl_dir, *args.extract))
+        return 0
+    done, skipped, failed = pack_crawl(args.crawl_dir, args.format, args.jobs,
+                                       args.shard_size, args.min_age, args.keep)
+    print("%d packed, %d already packed, %d failed" % (done, skipped, failed))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,79 @@
+"""Classifying the page a visit landed on, right after it loaded.
+
+A blocked visit used to show only after the waits for the cookie banner
+and the player timed out. `classify_page` instead checks the loaded page
+against known signatures of the five platforms in a single
+`execute_script` round trip, so that a block, captcha or error page ends
+the visit within a second or two. Pages are classified as:
+
+  blocked   the platform refuses the exit, e.g. "detected unusual traffic"
+  captcha   a challenge to solve first (reCAPTCHA, hCaptcha, Cloudflare)
+  error     a browser network error, or the video is not available
+  consent   a cookie consent page or banner, which the handlers dismiss
+  player    a video element or player is present
+  unknown   none of the above, e.g. a player that is not rendered yet
+
+Text signatures are only matched on pages without a video, whose text
+is not a video page's description or comments. The first signature that
+matches wins: consent pages are checked before the "not available" text,
+which cookie banners use too ("some content isn't available").
+"""
+from time import time
+
+from selenium.common.exceptions import WebDriverException
+
+from tbcrawler.log import wl_log
+
+# the visit fails at once on these pages, and is retried on blocks
+FAILED_CLASSES = ('blocked', 'captcha', 'error')
+BLOCK_CLASSES = ('blocked', 'captcha')
+
+CLASSIFY_PAGE_JS = """
+var path = location.pathname, host = location.hostname;
+var title = document.title || '', uri = document.documentURI || '';
+var video = document.querySelector('video, #movie_player');
+var text = !video && document.body ? document.body.innerText.slice(0, 20000) : '';
+function has(selector) { return !!document.querySelector(selector); }
+var signatures = [
+  ['error', 'network_error', /^about:(neterror|certerror)/.test(uri)],
+  ['blocked', 'google_sorry', path.indexOf('/sorry/') === 0],
+  ['blocked', 'unusual_traffic', /unusual traffic/i.test(text)],
+  ['blocked', 'temporarily_blocked', /temporarily blocked/i.test(text)],
+  ['blocked', 'access_denied', /^(access denied|403 forbidden|forbidden)/i.test(title)],
+  ['captcha', 'recaptcha', has('iframe[src*="recaptcha"], .g-recaptcha')],
+  ['captcha', 'hcaptcha', has('iframe[src*="hcaptcha"], .h-captcha')],
+  ['captcha', 'cloudflare', title === 'Just a moment...' ||
+                            has('#challenge-form, #challenge-running, .cf-turnstile')],
+  ['captcha', 'facebook_checkpoint', path.indexOf('/checkpoint/') === 0],
+  ['error', 'youtube_unavailable', has('.ytp-error, yt-playability-error-supported-renderers:not([hidden])')],
+  ['consent', 'youtube_consent', host.indexOf('consent.') === 0 ||
+                                 has('ytd-consent-bump-v2-lightbox')],
+  ['consent', 'onetrust', has('#onetrust-banner-sdk')],
+  ['consent', 'didomi', has('#didomi-notice, #didomi-popup')],
+  ['consent', 'facebook_cookies', has('[data-cookiebanner]')],
+  ['error', 'not_found', /\\b(404|page not found)\\b/i.test(title) ||
+      /video (does not exist|is not available|isn't available|unavailable)|content isn't available/i.test(text)],
+  ['player', 'video', !!video]
+];
+for (var i = 0; i < signatures.length; i++) {
+  if (signatures[i][2]) {
+    return {'class': signatures[i][0], 'signature': signatures[i][1]};
+  }
+}
+return {'class': 'unknown', 'signature': null};
+"""
+
+
+def classify_page(driver):
+    """Return the class and matched signature of the current page, and
+    how long the check took, as a dict."""
+    start = time()
+    try:
+        page = driver.execute_script(CLASSIFY_PAGE_JS)
+    except WebDriverException as exc:
+        wl_log.warning("Cannot classify the page: %s", exc)
+        page = None
+    if not isinstance(page, dict):
+        page = {'class': 'unknown', 'signature': None}
+    page['latency'] = round(time() - start, 3)
+    return page
@@ -0,0 +1,161 @@
+import ctypes
+import multiprocessing
+import os
+import subprocess
+from time import sleep
+
+from tbselenium.utils import start_xvfb, stop_xvfb
+
+import tbcrawler.common as cm
+from tbcrawler.log import wl_log
+
+CLONE_NEWNET = 0x40000000
+NETNS_RUN_DIR = '/var/run/netns'
+
+
+class WorkerNetwork(object):
+    """Network namespace connected to the uplink through a veth pair.
+
+    Everything a worker runs (Tor, browser, capture) lives inside the
+    namespace, so the capture on the guest end of the veth pair only
+    sees the traffic of that worker.
+    """
+
+    def __init__(self, worker_id, uplink):
+        self.worker_id = worker_id
+        self.uplink = uplink
+        self.name = "%s%d" % (cm.WORKER_NETNS_PREFIX, worker_id)
+        self.host_if = "%sh%d" % (cm.WORKER_NETNS_PREFIX, worker_id)
+        self.guest_if = "%sg%d" % (cm.WORKER_NETNS_PREFIX, worker_id)
+        self.host_ip = cm.WORKER_SUBNET % (worker_id, 1)
+        self.guest_ip = cm.WORKER_SUBNET % (worker_id, 2)
+        self.subnet = "%s/30" % (cm.WORKER_SUBNET % (worker_id, 0))
+
+    def _nat_rules(self):
+        return [('nat', 'POSTROUTING', ['-s', self.subnet, '-o', self.uplink,
+                                        '-j', 'MASQUERADE']),
+                ('filter', 'FORWARD', ['-i', self.host_if, '-o', self.uplink,
+                                       '-j', 'ACCEPT']),
+                ('filter', 'FORWARD', ['-i', self.uplink, '-o', self.host_if,
+                                       '-m', 'state', '--state',
+                                       'RELATED,ESTABLISHED', '-j', 'ACCEPT'])]
+
+    @staticmethod
+    def _iptables(action, rule):
+        table, chain, spec = rule
+        return ['iptables', '-t', table, action, chain] + spec
+
+    def setup(self):
+        """Create the namespace, the veth pair and the NAT rules."""
+        netns = ['ip', 'netns', 'exec', self.name]
+        commands = [
+            ['ip', 'netns', 'add', self.name],
+            ['ip', 'link', 'add', self.host_if, 'type', 'veth',
+             'peer', 'name', self.guest_if],
+            ['ip', 'link', 'set', self.guest_if, 'netns', self.name],
+            ['ip', 'addr', 'add', self.host_ip + '/30', 'dev', self.host_if],
+            ['ip', 'link', 'set', self.host_if, 'up'],
+            netns + ['ip', 'addr', 'add', self.guest_ip + '/30',
+                     'dev', self.guest_if],
+            netns + ['ip', 'link', 'set', self.guest_if, 'up'],
+            netns + ['ip', 'link', 'set', 'lo', 'up'],
+            netns + ['ip', 'route', 'add', 'default', 'via', self.host_ip],
+            ['sysctl', '-q', '-w', 'net.ipv4.ip_forward=1']]
+        commands += [self._iptables('-A', rule) for rule in self._nat_rules()]
+        for command in commands:
+            subprocess.check_call(command)
+        wl_log.info("Worker %s: namespace %s on %s",
+                    self.worker_id, self.name, self.guest_ip)
+
+    def teardown(self):
+        """Remove the NAT rules and the namespace (and with it the veth pair)."""
+        commands = [self._iptables('-D', rule) for rule in self._nat_rules()]
+        commands.append(['ip', 'netns', 'del', self.name])
+        for command in commands:
+            subprocess.call(command, stderr=subprocess.DEVNULL)
+
+    def enter(self):
+        """Move the calling process into the namespace.
+
+        Must be called before the worker opens any network socket; the
+        processes it launches afterwards inherit the namespace.
+        """
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = os.open(os.path.join(NETNS_RUN_DIR, self.name), os.O_RDONLY)
+        try:
+            if libc.setns(fd, CLONE_NEWNET) != 0:
+                errno = ctypes.get_errno()
+                raise OSError(errno, os.strerror(errno))
+        finally:
+            os.close(fd)
+
+
+class ParallelCrawler(object):
+    """Crawls with several isolated workers fed by a shared work queue.
+
+    Each batch, the (site, visit) units are put in a queue and one
+    process per worker is forked. A worker enters its own network
+    namespace, starts its own virtual display and builds its own
+    controller, browser and sniffer through `make_crawler`.
+    """
+
+    def __init__(self, num_workers, make_crawler, uplink, xvfb_size):
+        self.num_workers = num_workers
+        self.make_crawler = make_crawler
+        self.xvfb_size = xvfb_size
+        self.networks = [WorkerNetwork(worker_id, uplink)
+                         for worker_id in range(num_workers)]
+        self.context = multiprocessing.get_context('fork')
+        self.job = None
+
+    def crawl(self, job):
+        """Crawls a set of urls in batches."""
+        self.job = job
+        wl_log.info("Starting new crawl with %s workers", self.num_workers)
+        for network in self.networks:
+            network.teardown()  # leftovers of an interrupted crawl
+            network.setup()
+        try:
+            for self.job.batch in range(self.job.batches):
+                wl_log.info("**** Starting batch %s ***" % self.job.batch)
+                self._do_batch()
+                sleep(float(self.job.config['pause_between_batches']))
+        finally:
+            for network in self.networks:
+                network.teardown()
+
+    def _do_batch(self):
+        units = self.context.Queue()
+        for self.job.site in range(len(self.job.urls)):
+            for self.job.visit in range(self.job.visits):
+                if self.job.video is not None and not self.job.is_done():
+                    units.put((self.job.site, self.job.visit))
+        for _ in range(self.num_workers):
+            units.put(None)
+        workers = [self.context.Process(target=self._run_worker,
+                                        args=(worker_id, units),
+                                        name="worker%d" % worker_id)
+                   for worker_id in range(self.num_workers)]
+        for worker in workers:
+            worker.start()
+        try:
+            for worker in workers:
+                worker.join()
+                if worker.exitcode:
+                    wl_log.error("%s exited with code %s",
+                                 worker.name, worker.exitcode)
+        except KeyboardInterrupt:
+            for worker in workers:
+                worker.terminate()
+            raise
+
+    def _run_worker(self, worker_id, units):
+        network = self.networks[worker_id]
+        network.enter()
+        xvfb_display = start_xvfb(*self.xvfb_size)
+        try:
+            crawler = self.make_crawler(worker_id, network.guest_if)
+            crawler.crawl_units(self.job, self.job.batch,
+                                iter(units.get, None))
+        finally:
+            stop_xvfb(xvfb_display)
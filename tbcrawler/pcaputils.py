@@ -0,0 +1,162 @@
+import os
+import socket
+import struct
+
+PCAP_MAGIC_USEC = 0xa1b2c3d4
+PCAP_MAGIC_NSEC = 0xa1b23c4d
+PCAP_HEADER_LEN = 24
+RECORD_HEADER_LEN = 16
+READ_CHUNK = 1 << 20
+WRITE_BUFFER = 1 << 20
+
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_IPV6 = 229
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_IPV6 = 0x86dd
+ETHERTYPES_VLAN = (0x8100, 0x88a8)
+
+PROTO_TCP = 6
+PROTO_UDP = 17
+
+
+class PcapFormatError(Exception):
+    pass
+
+
+class PcapRecords(object):
+    """Streams the records of a pcap file without decoding the packets.
+
+    Iterating yields (ts_sec, ts_frac, orig_len, record) tuples, where
+    ts_frac is in micro- or nanoseconds (see `nanoseconds`) and record
+    is the raw record, pcap record header included, so that it can be
+    written to another file as is. The packet starts at
+    `RECORD_HEADER_LEN` within the record.
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.header = fileobj.read(PCAP_HEADER_LEN)
+        if len(self.header) < PCAP_HEADER_LEN:
+            raise PcapFormatError("Truncated pcap header")
+        for self.endian in ('<', '>'):
+            magic, = struct.unpack(self.endian + 'I', self.header[:4])
+            if magic in (PCAP_MAGIC_USEC, PCAP_MAGIC_NSEC):
+                break
+        else:
+            raise PcapFormatError("Not a pcap file (pcapng is not supported)")
+        self.nanoseconds = magic == PCAP_MAGIC_NSEC
+        self.snaplen, self.linktype = \
+            struct.unpack(self.endian + 'II', self.header[16:24])
+        self.truncated = False
+
+    def __iter__(self):
+        record_header = struct.Struct(self.endian + 'IIII')
+        buf = b''
+        pos = 0
+        while True:
+            chunk = self.fileobj.read(READ_CHUNK)
+            if not chunk:
+                break
+            buf = buf[pos:] + chunk
+            pos = 0
+            end = len(buf)
+            while pos + RECORD_HEADER_LEN <= end:
+                ts_sec, ts_frac, incl_len, orig_len = \
+                    record_header.unpack_from(buf, pos)
+                next_pos = pos + RECORD_HEADER_LEN + incl_len
+                if next_pos > end:
+                    break
+                yield ts_sec, ts_frac, orig_len, buf[pos:next_pos]
+                pos = next_pos
+        # a capture killed mid-write may end with a partial record
+        self.truncated = pos != len(buf)
+
+
+def network_offset(linktype, packet, start=0):
+    """Return (ethertype, offset of the network header) of the packet
+    that begins at `start` within `packet`."""
+    if linktype == LINKTYPE_ETHERNET:
+        offset = start + 14
+        ethertype = packet[start + 12] << 8 | packet[start + 13]
+        while ethertype in ETHERTYPES_VLAN and len(packet) >= offset + 4:
+            ethertype = packet[offset + 2] << 8 | packet[offset + 3]
+            offset += 4
+        return ethertype, offset
+    if linktype == LINKTYPE_LINUX_SLL:
+        return packet[start + 14] << 8 | packet[start + 15], start + 16
+    if linktype in (LINKTYPE_RAW, LINKTYPE_IPV4, LINKTYPE_IPV6):
+        version = packet[start] >> 4
+        return ETHERTYPE_IPV6 if version == 6 else ETHERTYPE_IPV4, start
+    raise PcapFormatError("Unsupported link type %s" % linktype)
+
+
+def ip_header(linktype, packet, start=0):
+    """Return (protocol, source, destination) of an IP packet, or None.
+
+    The packet begins at `start` within `packet`, which saves a copy
+    when parsing raw records. Addresses are packed bytes, as returned by
+    `socket.inet_pton`. For IPv6 the protocol is the next header field;
+    extension headers are not followed.
+    """
+    if len(packet) < start + 16:
+        return None
+    ethertype, offset = network_offset(linktype, packet, start)
+    if ethertype == ETHERTYPE_IPV4:
+        if len(packet) < offset + 20:
+            return None
+        return (packet[offset + 9], packet[offset + 12:offset + 16],
+                packet[offset + 16:offset + 20])
+    if ethertype == ETHERTYPE_IPV6:
+        if len(packet) < offset + 40:
+            return None
+        return (packet[offset + 6], packet[offset + 8:offset + 24],
+                packet[offset + 24:offset + 40])
+    return None
+
+
+def pack_ips(iplist):
+    """Return the set of packed IPv4 and IPv6 addresses in `iplist`."""
+    packed = set()
+    for ip in iplist:
+        family = socket.AF_INET6 if ':' in ip else socket.AF_INET
+        packed.add(socket.inet_pton(family, ip))
+    return packed
+
+
+def filter_pcap(pcap_path, iplist, protocols=(PROTO_TCP,), keep_original=True):
+    """Filter capture by packets addressed to or from any address in ``iplist``.
+
+    Records are streamed from the input to the output without decoding
+    the packets beyond the IP header. With `keep_original`, the
+    unfiltered capture is renamed (not copied) to `pcap_path`.original.
+    Returns the number of packets kept and read.
+    """
+    addresses = pack_ips(iplist)
+    protocols = frozenset(protocols)
+    orig_pcap = pcap_path + ".original"
+    out_path = pcap_path if keep_original else pcap_path + ".filtered"
+    if keep_original:
+        os.rename(pcap_path, orig_pcap)
+    in_path = orig_pcap if keep_original else pcap_path
+    kept = total = 0
+    with open(in_path, 'rb') as fin, \
+            open(out_path, 'wb', buffering=WRITE_BUFFER) as fout:
+        records = PcapRecords(fin)
+        fout.write(records.header)
+        linktype = records.linktype
+        for _, _, _, record in records:
+            total += 1
+            fields = ip_header(linktype, record, RECORD_HEADER_LEN)
+            if fields is None:
+                continue
+            proto, src, dst = fields
+            if proto in protocols and (src in addresses or dst in addresses):
+                fout.write(record)
+                kept += 1
+    if not keep_original:
+        os.replace(out_path, pcap_path)
+    return kept, total
@@ -0,0 +1,164 @@
+"""Crawls with the teardown and setup of consecutive visits overlapped.
+
+`VideoCrawler` runs every step of a visit in sequence: launch the
+browser, capture the visit, quit the browser, pause, launch the next
+browser... Only the capture needs to run alone. `PipelinedCrawler` runs
+the same units, with the same `CrawlJob` and journal, in three stages
+scheduled on an asyncio event loop, with the blocking selenium and stem
+calls in a thread pool:
+
+  setup     create the visit directory, launch (or reset) a browser
+  capture   load and play the video while capturing it
+  teardown  quit (or keep) the browser, record the outcome
+
+When a capture ends, the teardown of its visit, the setup of the next
+visit with the other browser, and the pause between the two visits run
+at the same time. The next capture starts once all three are done, so
+captures never overlap and, as in a sequential crawl, the traffic of a
+browser starting up or quitting is never captured. A blocked visit is
+retried next, after the retrier's backoff instead of the pause.
+
+The browsers are not kept for reuse: a kept browser would idle, and
+keep its connections open, during the capture of the other one.
+"""
+import asyncio
+import copy
+import itertools
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+from tbcrawler import metrics
+from tbcrawler.crawler import VideoCrawler
+from tbcrawler.log import wl_log
+
+
+def _mark_new_sites(units):
+    """Yields the (site, visit) units of a worker with whether the unit
+    is of another site than the one before it."""
+    previous = None
+    for site, visit in units:
+        yield site, visit, site != previous
+        previous = site
+
+
+class PipelinedCrawler(VideoCrawler):
+    """A `VideoCrawler` that alternates between browsers, so that one
+    is set up while the other is torn down.
+
+    `idle_removed` is the time saved so far compared to running the
+    stages in sequence, out of `pipeline_time` spent crawling.
+    """
+
+    def __init__(self, drivers, *args, **kwargs):
+        super(PipelinedCrawler, self).__init__(drivers[0], *args, **kwargs)
+        self.drivers = list(drivers)
+        self.executor = ThreadPoolExecutor(max_workers=3,
+                                           thread_name_prefix='pipeline')
+        self.idle_removed = 0.
+        self.pipeline_time = 0.
+
+    def crawl(self, job):
+        try:
+            super(PipelinedCrawler, self).crawl(job)
+        finally:
+            self.executor.shutdown()
+
+    def crawl_units(self, job, batch, units):
+        try:
+            super(PipelinedCrawler, self).crawl_units(job, batch, units)
+        finally:
+            self.executor.shutdown()
+
+    def _do_sites(self):
+        job = self.job
+        units = ((site, visit, visit == 0)
+                 for site in range(len(job.urls))
+                 for visit in range(job.visits))
+        asyncio.run(self._pipeline(units))
+
+    def _do_units(self, units):
+        asyncio.run(self._pipeline(_mark_new_sites(units)))
+
+    async def _stage(self, function, *args):
+        """Runs a blocking stage in the pool; returns its result and
+        how long it took."""
+        def timed():
+            start = time()
+            return function(*args), time() - start
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, timed)
+
+    async def _pipeline(self, units):
+        """Crawls the (site, visit, first visit of the site) units."""
+        job = self.job  # the stages swap self.job for the unit's copy
+        drivers = itertools.cycle(self.drivers)
+        teardown = None  # of the previous visit
+        capture_end = None
+        pause = 0.
+        started = time()
+        removed = 0.
+        try:
+            for site, visit_num, new_site in units:
+                unit = copy.copy(job)
+                unit.site, unit.visit, unit.attempt = site, visit_num, 0
+                if not self._is_valid_site(unit):
+                    continue
+                if unit.is_done():
+                    wl_log.info("Skipping %s, already crawled", unit.path)
+                    continue
+                if new_site and capture_end is not None:
+                    pause += float(job.config['pause_between_videos'])
+                while unit is not None:  # until the unit is not retried
+                    visit, setup_time = await self._stage(
+                        self._setup_load, unit, next(drivers))
+                    teardown_time = 0.
+                    if capture_end is not None:
+                        await asyncio.sleep(capture_end + pause - time())
+                        if teardown is not None:
+                            _, teardown_time = await teardown
+                            teardown = None
+                        gap = time() - capture_end
+                        removed += max(teardown_time + pause + setup_time - gap,
+                                       0)
+                    try:
+                        await self._stage(self._capture_load, visit)
+                    except BaseException:
+                        await self._stage(self._teardown_load, visit,
+                                          sys.exc_info())
+                        raise
+                    capture_end = time()
+                    pause = (float(job.config['pause_between_loads'])
+                             if visit.successful else 0.)
+                    teardown = asyncio.ensure_future(
+                        self._stage(self._teardown_load, visit))
+                    unit = None
+                    delay = self.retrier.retry_delay(visit)
+                    if delay is not None:
+                        await self._stage(self.retrier.new_identity)
+                        pause = delay
+                        unit = copy.copy(visit.job)
+                        unit.attempt += 1
+        finally:
+            if teardown is not None:
+                await teardown
+            elapsed = time() - started
+            self.idle_removed += removed
+            self.pipeline_time += elapsed
+            wl_log.info("Pipelining removed %.1f s of idle time in %.1f s "
+                        "(%.0f s per hour)", removed, elapsed,
+                        3600 * self.idle_removed / max(self.pipeline_time, 1))
+
+    def _capture_load(self, visit):
+        job, driver = self.job, self.driver
+        try:
+            self._run_load(visit)
+        finally:
+            self.job, self.driver = job, driver
+            # the setup and teardown since the previous capture included
+            visit.phases = metrics.take_spans()
+
+    def _teardown_load(self, visit, exc_info=(None, None, None)):
+        visit.browser.__exit__(*exc_info)
+        if exc_info[0] is None:
+            self._finish_load(visit)
@@ -1,16 +1,20 @@
 import argparse
 import configparser
+import hashlib
 import sys
 import traceback
 from contextlib import contextmanager
 from logging import INFO, DEBUG
 from os import stat, chdir
-from os.path import isfile, join, basename
+from os.path import abspath, isdir, isfile, join, basename
 from shutil import copyfile
 from sys import maxsize, argv
+from time import time
 from urllib.parse import urlparse
 import re
 
+import psutil
+from selenium.common.exceptions import WebDriverException
 from selenium.webdriver import Firefox, FirefoxOptions
 from selenium.webdriver.common.desired_capabilities import DesiredCapabilities
 from tbselenium.tbdriver import TorBrowserDriver
@@ -20,9 +24,29 @@ from tbselenium.utils import start_xvfb, stop_xvfb
 import tbcrawler.common as cm
 import tbcrawler.utils as ut
 import tbcrawler.crawler as crawler_mod
+from tbcrawler.dumputils import CAPTURE_BACKENDS
+from tbcrawler.journal import CrawlJournal
 from tbcrawler.log import add_log_file_handler
 from tbcrawler.log import wl_log, add_symlink
+from tbcrawler.metrics import MetricsServer, add_span, span
+from tbcrawler.pack import FORMATS as PACK_FORMATS, pack_crawl
+from tbcrawler.parallel import ParallelCrawler
+from tbcrawler.pipeline import PipelinedCrawler
+from tbcrawler.retries import BlockRetrier
+from tbcrawler.sanity import INDEX_FILENAME, check_crawl
+from tbcrawler.screenshots import ScreenshotWriter
+from tbcrawler.splitter import SPLIT_MODES
+from tbcrawler.termination import POLICIES, make_policy
 from tbcrawler.torcontroller import TorController
+from tbcrawler.videolist import VideoList
+
+
+# clears cookies, cache, storage, history etc. from the chrome context
+CLEAR_BROWSER_DATA_JS = """
+const done = arguments[arguments.length - 1];
+Services.clearData.deleteData(Ci.nsIClearDataService.CLEAR_ALL,
+                              () => done(true));
+"""
 
 
 def run():
@@ -30,40 +54,25 @@ def run():
     args, config = parse_arguments()
 
     # build dirs
-    build_crawl_dirs(args.url_file)
+    build_crawl_dirs(args.url_file, args.resume)
+
+    # Check that a resumed crawl selects the same units
+    journal = open_journal(args)
 
     # Read URLs
-    url_dict = parse_video_list(args.url_file, args.start, args.stop)
+    video_list = parse_video_list(args.url_file, args.start, args.stop)
 
     # Configure logger
     add_log_file_handler(wl_log, cm.DEFAULT_CRAWL_LOG)
 
-    if args.without_tor:
-        controller = None
-        opts = FirefoxOptions()
-        opts.add_argument("--headless")
-        driver = FirefoxWrapper(options=opts)
-    else:
-        # Configure controller
-        torrc_config = ut.get_dict_subconfig(config, args.config, "torrc")
-        controller = TorController(cm.TBB_DIR,
-                                   torrc_dict=torrc_config,
-                                   pollute=False)
-
-        # Configure browser
-        ffprefs = ut.get_dict_subconfig(config, args.config, "ffpref")
-        driver = TorBrowserWrapper(cm.TBB_DIR,
-                                   tbb_logfile_path=cm.DEFAULT_FF_LOG,
-                                   tor_cfg=USE_RUNNING_TOR,
-                                   pref_dict=ffprefs,
-                                   socks_port=int(torrc_config['socksport']))
-
-    # Instantiate crawler
-    crawler = crawler_mod.VideoCrawler(driver, controller, args.screenshots, args.device)
-
     # Configure crawl
     job_config = ut.get_dict_subconfig(config, args.config, "job")
-    job = crawler_mod.CrawlJob(job_config, url_dict, args.start)
+    if args.resume:
+        wl_log.info("Resuming crawl in %s: %s", cm.CRAWL_DIR, journal.counts())
+    job = crawler_mod.CrawlJob(job_config, video_list, args.start, journal)
+    if args.metrics_port:
+        MetricsServer(join(cm.CRAWL_DIR, cm.VISITS_FILENAME),
+                      args.metrics_port).start()
 
     # Setup stem headless display
     if args.virtual_display:
@@ -72,7 +81,17 @@ def run():
     else:
         xvfb_h = cm.DEFAULT_XVFB_WIN_H
         xvfb_w = cm.DEFAULT_XVFB_WIN_W
-    xvfb_display = start_xvfb(xvfb_w, xvfb_h)
+
+    if args.workers > 1:
+        # each worker builds its own crawler and display in its namespace
+        def make_crawler(worker_id, device):
+            return build_crawler(args, config, worker_id, device)
+        crawler = ParallelCrawler(args.workers, make_crawler, args.device,
+                                  (xvfb_w, xvfb_h))
+        xvfb_display = None
+    else:
+        crawler = build_crawler(args, config)
+        xvfb_display = start_xvfb(xvfb_w, xvfb_h)
 
     # Run the crawl
     chdir(cm.CRAWL_DIR)
@@ -83,51 +102,150 @@ def run():
         sys.exit(-1)
     finally:
         # Post crawl
-        post_crawl()
+        post_crawl(args)
 
         # Close display
-        stop_xvfb(xvfb_display)
+        if xvfb_display:
+            stop_xvfb(xvfb_display)
 
     # die
     sys.exit(0)
 
 
-def post_crawl():
-    """Operations after the crawl."""
-    # TODO: pack crawl
-    # TODO: sanity checks
-    pass
+def build_crawler(args, config, worker_id=0, device=None):
+    """Instantiate a crawler with its own browser and Tor controller.
+
+    In parallel mode, worker i shifts the Tor ports by
+    i * `WORKER_PORT_OFFSET` and runs Tor on a temporary copy of the
+    data directory, which cannot be shared between Tor processes.
+    """
+    if args.without_tor:
+        controller = None
 
+        def make_driver():
+            opts = FirefoxOptions()
+            opts.add_argument("--headless")
+            return FirefoxWrapper(options=opts)
+    else:
+        # Configure controller
+        torrc_config = ut.get_dict_subconfig(config, args.config, "torrc")
+        port_offset = worker_id * cm.WORKER_PORT_OFFSET
+        for port in ('socksport', 'controlport'):
+            torrc_config[port] = str(int(torrc_config[port]) + port_offset)
+        controller = TorController(cm.TBB_DIR,
+                                   torrc_dict=torrc_config,
+                                   pollute=args.workers > 1,
+                                   standby=args.standby_tor)
 
-def build_crawl_dirs(video_file):
+        # Configure browser
+        ffprefs = ut.get_dict_subconfig(config, args.config, "ffpref")
+        ff_log = cm.DEFAULT_FF_LOG
+        if args.workers > 1:
+            ff_log = join(cm.LOGS_DIR, 'ff_worker%d.log' % worker_id)
+
+        def make_driver():
+            return TorBrowserWrapper(cm.TBB_DIR,
+                                     tbb_logfile_path=ff_log,
+                                     tor_cfg=USE_RUNNING_TOR,
+                                     pref_dict=ffprefs,
+                                     socks_port=int(torrc_config['socksport']),
+                                     control_port=int(torrc_config['controlport']))
+
+    # the pipeline launches a browser while the other one quits
+    drivers = [make_driver() for _ in range(2 if args.pipeline else 1)]
+    if args.reuse_browser:
+        for driver in drivers:
+            driver.enable_reuse(args.recycle_after, args.recycle_rss)
+
+    screenshot_writer = None
+    if args.screenshots:
+        screenshot_writer = ScreenshotWriter(args.screenshot_format,
+                                             args.screenshot_quality,
+                                             args.screenshot_scale)
+    crawler_args = (controller, args.screenshots, device or args.device,
+                    make_policy(args.end_visit_on), args.capture,
+                    args.batch_capture, screenshot_writer,
+                    cm.SCREENSHOT_INTERVAL if args.periodic_screenshots else 0,
+                    args.filter_guards,
+                    BlockRetrier(controller, args.block_retries))
+    if args.pipeline:
+        return PipelinedCrawler(drivers, *crawler_args)
+    return crawler_mod.VideoCrawler(drivers[0], *crawler_args)
+
+
+def post_crawl(args):
+    """Operations after the crawl."""
+    rows = check_crawl(cm.CRAWL_DIR, expect_screenshots=args.screenshots)
+    anomalous = [row['dir'] for row in rows if row['anomalous']]
+    wl_log.info("Checked %d visits, %d anomalous: %s (see %s)", len(rows),
+                len(anomalous), ' '.join(anomalous),
+                join(cm.CRAWL_DIR, INDEX_FILENAME))
+    if args.pack:
+        packed, _, failed = pack_crawl(cm.CRAWL_DIR, args.pack, min_age=0)
+        wl_log.info("Packed %d visits into %s (%d failed)", packed,
+                    join(cm.CRAWL_DIR, cm.PACK_DIRNAME), failed)
+
+
+def build_crawl_dirs(video_file, resume=False):
     # build crawl directory
     ut.create_dir(cm.RESULTS_DIR)
     ut.create_dir(cm.CRAWL_DIR)
     ut.create_dir(cm.LOGS_DIR)
-    copyfile(cm.CONFIG_FILE, join(cm.LOGS_DIR, 'config.ini'))
-    copyfile(video_file, join(cm.LOGS_DIR, 'videos.txt'))
+    if not resume:  # keep those the crawl was started with
+        copyfile(cm.CONFIG_FILE, join(cm.LOGS_DIR, 'config.ini'))
+        copyfile(video_file, join(cm.LOGS_DIR, 'videos.txt'))
     add_symlink(join(cm.RESULTS_DIR, 'latest_crawl'), basename(cm.CRAWL_DIR))
 
+
+def crawl_parameters(args):
+    """The arguments that select the units of the crawl."""
+    with open(args.url_file, 'rb') as f:
+        url_file_sha256 = hashlib.sha256(f.read()).hexdigest()
+    return {'start': args.start, 'stop': args.stop,
+            'url_file_sha256': url_file_sha256}
+
+
+def open_journal(args):
+    """Open the journal of the crawl, where its parameters are recorded
+    when it starts and checked when it is resumed."""
+    journal = CrawlJournal(join(cm.CRAWL_DIR, cm.JOURNAL_FILENAME))
+    parameters = crawl_parameters(args)
+    if args.resume:
+        check_resume(journal, parameters)
+    journal.record_parameters(parameters)
+    return journal
+
+
+def check_resume(journal, parameters):
+    """Exit if the crawl was started with other parameters, with which
+    the units of the journal are other videos."""
+    recorded = journal.parameters()
+    mismatched = ["%s %s (was %s)" % (name, value, recorded[name])
+                  for name, value in sorted(parameters.items())
+                  if name in recorded and recorded[name] != value]
+    if mismatched:
+        wl_log.error("Cannot resume the crawl in %s with other arguments: %s",
+                     cm.CRAWL_DIR, ', '.join(mismatched))
+        sys.exit(-1)
+
+
+def set_crawl_dir(crawl_dir):
+    """Point the crawl directory and the log paths within it to `crawl_dir`."""
+    cm.CRAWL_DIR = abspath(crawl_dir)
+    cm.LOGS_DIR = join(cm.CRAWL_DIR, 'logs')
+    cm.DEFAULT_CRAWL_LOG = join(cm.LOGS_DIR, 'crawl.log')
+    cm.DEFAULT_TOR_LOG = join(cm.LOGS_DIR, 'tor.log')
+    cm.DEFAULT_FF_LOG = join(cm.LOGS_DIR, 'ff.log')
+
 def parse_video_list(file_path, start, stop):
-    """Return list of videos from a file."""
+    """Return a lazy, indexed list of videos from a file."""
     try:
-        with open(file_path) as f:
-            # read file contents and split entries of the form url,length_in_seconds
-            file_contents = f.read()
-            url_list = file_contents.splitlines()
-            url_list = [url for url in url_list if url and not url.startswith('#')]
-            url_list = url_list[start - 1:stop]
-            url_dict = {}
-            i = 0
-            for entry in url_list:
-                parts = entry.split(',')
-                url = parts[0]
-                url_dict[i] = (url, int(parts[1]))
-                i += 1
+        video_list = VideoList(file_path, start, stop)
     except Exception as e:
         wl_log.error("while parsing video list: {} \n{}".format(e, traceback.format_exc()))
         sys.exit(-1)
-    return url_dict
+    wl_log.info("Crawling %s", video_list)
+    return video_list
 
 
 def parse_arguments():
@@ -145,6 +263,10 @@ def parse_arguments():
     parser.add_argument('-o', '--output',
                         help='Directory to dump the results (default=./results).',
                         default=cm.CRAWL_DIR)
+    parser.add_argument('--resume', metavar='CRAWL_DIR',
+                        help='Resume an interrupted crawl in this directory, '
+                             'skipping the visits its journal records as successful.',
+                        default=None)
     parser.add_argument('-c', '--config',
                         help="Crawler tor driver and controller configurations.",
                         choices=config.sections(),
@@ -157,6 +279,24 @@ def parse_arguments():
                         default=False)
     parser.add_argument('-d', '--device', type=str, default='eth0',
                         help='Device interface on which to capture traffic.')
+    parser.add_argument('--capture', choices=CAPTURE_BACKENDS,
+                        default=cm.DEFAULT_CAPTURE_BACKEND,
+                        help='Capture with a tcpdump process per visit, or in '
+                             'process on a memory-mapped AF_PACKET ring '
+                             '(default: %(default)s).')
+    parser.add_argument('--batch-capture', choices=SPLIT_MODES, default=None,
+                        help='Capture each batch at once instead of each visit, and '
+                             'split the capture into the visits while they run '
+                             '(live) or after the batch (post).')
+    parser.add_argument('--filter-guards', action='store_true', default=False,
+                        help='Only capture the traffic to the entry guards and '
+                             'bridges of Tor (DNS and HTTPS without Tor).')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='Serve crawl metrics in the Prometheus text format at '
+                             'http://127.0.0.1:PORT/metrics.')
+    parser.add_argument('--pack', choices=sorted(PACK_FORMATS), default=None,
+                        help='After the crawl, pack the visit directories into '
+                             'zstd or xz archives (see bin/pack_crawl.py).')
     parser.add_argument('--timeout', type=int, default=10,
                         help='Hard timeout (minutes) before video capture is interrupted.')
     parser.add_argument('--without-tor', action='store_true',
@@ -170,6 +310,51 @@ def parse_arguments():
     parser.add_argument('-s', '--screenshots', action='store_true',
                         help='Capture page screenshots',
                         default=False)
+    parser.add_argument('--screenshot-format', choices=cm.SCREENSHOT_FORMATS,
+                        default='png',
+                        help='Re-encode screenshots, which needs Pillow '
+                             '(default: %(default)s).')
+    parser.add_argument('--screenshot-quality', type=int, default=80,
+                        help='JPEG/WebP quality of screenshots (default: %(default)s).')
+    parser.add_argument('--screenshot-scale', type=float, default=1.0,
+                        help='Downscale screenshots by this factor, e.g. 0.5.')
+    parser.add_argument('--periodic-screenshots', action='store_true',
+                        help='Also take a screenshot every %d seconds of playback.'
+                             % cm.SCREENSHOT_INTERVAL,
+                        default=False)
+    parser.add_argument('--reuse-browser', action='store_true',
+                        help='Keep the browser between visits and only reset its state.',
+                        default=False)
+    parser.add_argument('--recycle-after', type=int, default=20,
+                        help='With --reuse-browser, relaunch the browser after this '
+                             'many visits (0: never, default: 20).')
+    parser.add_argument('--recycle-rss', type=int, default=0,
+                        help='With --reuse-browser, relaunch the browser when it uses '
+                             'more than this many MB (default: 0, no limit).')
+    parser.add_argument('--standby-tor', action='store_true',
+                        help='Bootstrap the Tor process of the next batch in the '
+                             'background while the current batch runs.',
+                        default=False)
+    parser.add_argument('--pipeline', action='store_true',
+                        help='Launch the browser of the next visit, and pause, '
+                             'while the browser of the last one quits, with '
+                             'two browsers in turn. Not with --reuse-browser.',
+                        default=False)
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='Number of parallel workers, each with its own Tor, '
+                             'browser, display and capture in a network namespace '
+                             '(default: 1).')
+
+    parser.add_argument('--block-retries', type=int, default=cm.BLOCK_RETRIES,
+                        help='Retry a visit that the platform blocked this many '
+                             'times, on new circuits and avoiding the exits that '
+                             'it blocks (default: %(default)s).')
+    parser.add_argument('--end-visit-on', nargs='+', default=[],
+                        choices=sorted(POLICIES),
+                        help='End a visit as soon as the player reports the video '
+                             'ended or fully loaded (player) and/or the capture stops '
+                             'growing (idle), besides the expected playback time '
+                             '(deadline, always on).')
 
     # Limit crawl
     parser.add_argument('--start', type=int,
@@ -182,12 +367,21 @@ def parse_arguments():
     # Parse arguments
     args = parser.parse_args()
 
+    # an idle browser kept for reuse would be captured with the other one
+    if args.pipeline and args.reuse_browser:
+        parser.error("--pipeline cannot be used with --reuse-browser")
+
     # Set verbose level
     wl_log.setLevel(DEBUG if args.verbose else INFO)
     del args.verbose
 
-    # Change results dir if output
-    cm.CRAWL_DIR = args.output
+    # Change results dir if output, or go back to an interrupted crawl
+    if args.resume:
+        if not isdir(args.resume):
+            parser.error("Cannot resume, no crawl directory %s" % args.resume)
+        set_crawl_dir(args.resume)
+    else:
+        set_crawl_dir(args.output)
     del args.output
 
     # Change video load timeout
@@ -198,20 +392,28 @@ def parse_arguments():
     return args, config
 
 
-class TorBrowserWrapper(object):
-    """Wraps the TorBrowserDriver to configure it at the constructor
-    and run it with the `launch` method.
+class BrowserWrapper(object):
+    """Configures a driver at the constructor and runs it with `launch`.
 
-    We might consider to change the TorBrowserDriver itself to follow
-    torcontroller and stem behaviour: init configures and a method is
-    used to launch driver/controller, and this method is the one used
-    to implement the contextmanager.
+    By default every launch starts a new browser and quits it at the
+    end. With `enable_reuse`, the browser is kept warm between launches
+    and only its state is reset, until the recycle policy says it must
+    be replaced: after a number of visits, when its memory grows above
+    a threshold, or after `recycle` is called, e.g. on an error.
     """
+    driver_class = None
 
     def __init__(self, *args, **kwargs):
         self.args = args
         self.kwargs = kwargs
         self.driver = None
+        self.reuse = False
+        self.recycle_after = 0
+        self.max_rss_mb = 0
+        self.visits = 0
+        self.recycle_pending = False
+        self.launch_times = []
+        self.launched = False
 
     def __getattr__(self, item):
         if self.driver is None:
@@ -220,31 +422,142 @@ class TorBrowserWrapper(object):
             return getattr(self, item)
         return getattr(self.driver, item)
 
+    def enable_reuse(self, recycle_after=0, max_rss_mb=0):
+        """Keep the browser between launches. Zero disables a limit."""
+        self.reuse = True
+        self.recycle_after = recycle_after
+        self.max_rss_mb = max_rss_mb
+
+    def recycle(self):
+        """Discard the browser; the next launch starts a fresh one."""
+        self.recycle_pending = True
+        if not self.launched:
+            self._quit()
+
+    def rss_mb(self):
+        """Resident memory of geckodriver and the browser processes."""
+        try:
+            proc = psutil.Process(self.driver.service.process.pid)
+            procs = [proc] + proc.children(recursive=True)
+            return sum(p.memory_info().rss for p in procs) / 2. ** 20
+        except (AttributeError, psutil.Error):
+            return 0
+
+    def kill(self):
+        """Kill geckodriver and the browser, so that a command blocked on
+        them returns. Safe to call from another thread."""
+        self.recycle_pending = True
+        try:
+            pid = self.driver.service.process.pid
+        except AttributeError:
+            return
+        wl_log.warning("Killing the browser")
+        ut.kill_all_children(pid)
+        try:
+            psutil.Process(pid).kill()
+        except psutil.Error:
+            pass
+
+    def _must_recycle(self):
+        if self.recycle_pending:
+            return True
+        if self.recycle_after and self.visits >= self.recycle_after:
+            wl_log.info("Recycling browser after %s visits", self.visits)
+            return True
+        if self.max_rss_mb:
+            rss = self.rss_mb()
+            if rss > self.max_rss_mb:
+                wl_log.info("Recycling browser using %.0f MB", rss)
+                return True
+        return False
+
+    def _start(self):
+        start = time()
+        with span('browser_launch'):
+            self.driver = self.driver_class(*self.args, **self.kwargs)
+        self.launch_times.append(time() - start)
+        self.visits = 0
+        self.recycle_pending = False
+
+    def _quit(self):
+        if self.driver is None:
+            return
+        try:
+            with span('browser_quit'):
+                self.driver.quit()
+        except Exception as exc:
+            wl_log.warning("Cannot quit browser: %s", exc)
+        self.driver = None
+
+    def _reset(self):
+        """Bring the warm browser back to a blank state."""
+        start = time()
+        handles = self.driver.window_handles
+        for handle in handles[1:]:
+            self.driver.switch_to.window(handle)
+            self.driver.close()
+        self.driver.switch_to.window(handles[0])
+        self.driver.get("about:blank")
+        try:
+            with self.driver.context(self.driver.CONTEXT_CHROME):
+                self.driver.execute_async_script(CLEAR_BROWSER_DATA_JS)
+        except WebDriverException as exc:
+            wl_log.warning("Cannot clear browser data: %s", exc)
+            self.driver.delete_all_cookies()
+        reset_time = time() - start
+        add_span('browser_reset', reset_time)
+        launch_time = sum(self.launch_times) / len(self.launch_times)
+        wl_log.info("Reused browser: reset in %.1f s, saved %.1f s",
+                    reset_time, launch_time - reset_time)
+
     @contextmanager
     def launch(self):
-        self.driver = TorBrowserDriver(*self.args, **self.kwargs)
-        yield self.driver
-        self.driver.quit()
-
-class FirefoxWrapper(object):
+        if self.driver is not None and self._must_recycle():
+            self._quit()
+        if self.driver is None:
+            self._start()
+        else:
+            try:
+                self._reset()
+            except WebDriverException as exc:
+                wl_log.warning("Cannot reset browser, relaunching: %s", exc)
+                self._quit()
+                self._start()
+        self.launched = True
+        try:
+            yield self.driver
+        except Exception:
+            self.recycle_pending = True
+            raise
+        finally:
+            self.launched = False
+            self.visits += 1
+            if not self.reuse or self.recycle_pending:
+                self._quit()
+
+
+class TorBrowserWrapper(BrowserWrapper):
+    """Wraps the TorBrowserDriver to configure it at the constructor
+    and run it with the `launch` method.
 
-    def __init__(self, *args, **kwargs):
-        self.args = args
-        self.kwargs = kwargs
-        self.driver = None
+    We might consider to change the TorBrowserDriver itself to follow
+    torcontroller and stem behaviour: init configures and a method is
+    used to launch driver/controller, and this method is the one used
+    to implement the contextmanager.
+    """
+    driver_class = TorBrowserDriver
 
-    def __getattr__(self, item):
-        if self.driver is None:
+    def use_tor_ports(self, socks_port, control_port):
+        """Point the next launched browser to a Tor process on other ports."""
+        if (self.kwargs.get('socks_port'), self.kwargs.get('control_port')) \
+                == (socks_port, control_port):
             return
-        if item == "launch":
-            return getattr(self, item)
-        return getattr(self.driver, item)
+        self.kwargs.update(socks_port=socks_port, control_port=control_port)
+        self.recycle()
 
-    @contextmanager
-    def launch(self):
-        self.driver = Firefox(*self.args, **self.kwargs)
-        yield self.driver
-        self.driver.quit()
+
+class FirefoxWrapper(BrowserWrapper):
+    driver_class = Firefox
 
 
 if __name__ == '__main__':
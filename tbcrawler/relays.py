@@ -0,0 +1,114 @@
+"""An in-memory index of the relays in the Tor consensus.
+
+The index is loaded from the controller once per Tor process, in a
+background thread, and replaced whenever Tor reports a new consensus,
+so that looking up the address of a guard needs no control port round
+trip.
+"""
+import re
+import threading
+from collections import namedtuple
+
+from stem.control import EventType
+
+from tbcrawler.log import wl_log
+
+Relay = namedtuple('Relay', ['fingerprint', 'nickname', 'address', 'or_port',
+                             'addresses', 'flags', 'bandwidth'])
+
+
+def relay_from_status(status):
+    """Return the Relay of a router status entry of the consensus."""
+    addresses = [status.address] + [address for address, _, _ in
+                                    getattr(status, 'or_addresses', [])
+                                    if address != status.address]
+    return Relay(status.fingerprint, status.nickname, status.address,
+                 status.or_port, tuple(addresses), frozenset(status.flags),
+                 status.bandwidth)
+
+
+BRIDGE_ADDRESS = re.compile(r'^\[?([0-9a-fA-F.:]+?)\]?:\d+$')
+# pluggable transports that do not connect to the address of the bridge
+INDIRECT_TRANSPORTS = ('snowflake', 'meek', 'meek_lite', 'conjure', 'webtunnel')
+
+
+def entry_guard_fingerprints(entry_guards):
+    """Return the fingerprints in the `GETINFO entry-guards` reply, except
+    those of unusable guards."""
+    fingerprints = []
+    for line in entry_guards.splitlines():
+        fields = line.split()
+        if not fields or (len(fields) > 1 and fields[1] == 'unusable'):
+            continue
+        fingerprints.append(re.split('[~=]', fields[0].lstrip('$'))[0])
+    return fingerprints
+
+
+def bridge_addresses(bridge_lines):
+    """Return the addresses of `Bridge` lines of the Tor configuration,
+    e.g. "obfs4 192.0.2.1:443 FINGERPRINT cert=... iat-mode=0", or None
+    if a bridge is reached at other addresses."""
+    addresses = []
+    for line in bridge_lines:
+        if line.split()[0] in INDIRECT_TRANSPORTS:
+            return None
+        for field in line.split()[:2]:
+            match = BRIDGE_ADDRESS.match(field)
+            if match:
+                addresses.append(match.group(1))
+                break
+    return addresses
+
+
+class RelayIndex(object):
+    """The relays of the consensus, by fingerprint."""
+    LOAD_TIMEOUT = 60
+
+    def __init__(self):
+        self.relays = {}
+        self.guard_addresses = frozenset()
+        self.loaded = threading.Event()
+
+    def attach(self, controller):
+        """Load the consensus of `controller` and follow its updates."""
+        self.loaded.clear()
+        controller.add_event_listener(self._on_new_consensus,
+                                      EventType.NEWCONSENSUS)
+        thread = threading.Thread(target=self._load, args=(controller,),
+                                  daemon=True, name='relay-index')
+        thread.start()
+
+    def _load(self, controller):
+        try:
+            self.update(controller.get_network_statuses())
+        except Exception as exc:
+            wl_log.error("Cannot load the consensus: %s", exc)
+        finally:
+            self.loaded.set()
+
+    def _on_new_consensus(self, event):
+        if event.desc is not None:
+            self.update(event.desc)
+            wl_log.info("New consensus: %d relays", len(self.relays))
+
+    def update(self, statuses):
+        """Replace the index with the relays of a consensus."""
+        relays = {}
+        for status in statuses:
+            relay = relay_from_status(status)
+            relays[relay.fingerprint] = relay
+        guard_addresses = frozenset(address for relay in relays.values()
+                                    if 'Guard' in relay.flags
+                                    for address in relay.addresses)
+        # replace, not mutate: lookups run in other threads
+        self.relays, self.guard_addresses = relays, guard_addresses
+
+    def get(self, fingerprint):
+        """Return the Relay with this fingerprint, or None."""
+        self.loaded.wait(self.LOAD_TIMEOUT)
+        return self.relays.get(fingerprint)
+
+    def guards(self):
+        """Return the addresses of all the relays with the Guard flag."""
+        self.loaded.wait(self.LOAD_TIMEOUT)
+        return self.guard_addresses
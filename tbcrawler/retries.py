@@ -0,0 +1,129 @@
+"""Retrying the visits that a platform blocks, through other exits.
+
+YouTube serves a "detected unusual traffic" page to many Tor exits.
+Such a visit fails, but the next attempt through another exit often
+succeeds, so instead of losing the unit until the next batch,
+`BlockRetrier` retries it at once, up to `BLOCK_RETRIES` times: it
+waits for an exponential backoff, signals NEWNYM and closes the open
+streams so that the new attempt is made on new circuits, even by a
+browser that kept its connections, and excludes the exits that the
+platform is known to block.
+
+The exit of each visit is the one most of its streams used (see
+`tbcrawler.timeline`). `ExitStats` keeps the visits, successes and
+blocks per platform and exit. They are also written to the visit
+records, from which the stats of an earlier run of a resumed crawl are
+loaded.
+"""
+from collections import defaultdict
+from os.path import join
+
+import tbcrawler.common as cm
+from tbcrawler import metrics
+from tbcrawler.log import wl_log
+
+
+class ExitStats(object):
+    """Visits, successes and blocks per (platform, exit fingerprint)."""
+
+    def __init__(self):
+        self.counts = defaultdict(lambda: [0, 0, 0])
+
+    def add(self, platform, exit, successful, blocked):
+        counts = self.counts[platform, exit]
+        counts[0] += 1
+        counts[1] += bool(successful)
+        counts[2] += bool(blocked)
+
+    def load(self, path):
+        """Add the visits of a visits.jsonl file that have an exit."""
+        for record in metrics.read_records(path):
+            if record.get('exit'):
+                self.add(record['platform'], record['exit'],
+                         record['outcome'] == 'success', record.get('blocked'))
+
+    def success_rate(self, platform, exit=None):
+        """The fraction of successful visits to a platform, through an
+        exit or any, or None before the first visit."""
+        visits = successes = 0
+        for (platform_, exit_), counts in self.counts.items():
+            if platform_ == platform and exit in (None, exit_):
+                visits += counts[0]
+                successes += counts[1]
+        return successes / visits if visits else None
+
+    def blocked_exits(self, platform):
+        """The exits that blocked at least `BLOCKED_EXIT_RATE` of at
+        least `BLOCKED_EXIT_MIN_VISITS` visits to a platform."""
+        return sorted(exit for (platform_, exit), (visits, _, blocks)
+                      in self.counts.items()
+                      if platform_ == platform
+                      and visits >= cm.BLOCKED_EXIT_MIN_VISITS
+                      and blocks >= cm.BLOCKED_EXIT_RATE * visits)
+
+
+class BlockRetrier(object):
+    """Decides whether to retry a blocked visit and prepares Tor for it.
+
+    Without a controller, e.g. without Tor, blocked visits are still
+    retried after the backoff, but through the same network path.
+    """
+
+    def __init__(self, controller=None, retries=cm.BLOCK_RETRIES,
+                 backoff=cm.BLOCK_RETRY_BACKOFF):
+        self.controller = controller
+        self.retries = retries
+        self.backoff = backoff
+        self.stats = None
+
+    def _stats(self):
+        if self.stats is None:
+            self.stats = ExitStats()
+            self.stats.load(join(cm.CRAWL_DIR, cm.VISITS_FILENAME))
+        return self.stats
+
+    def prepare(self, url):
+        """Keep the visit to `url` away from the exits its platform blocks."""
+        if self.controller is None:
+            return
+        platform = metrics.platform(url)
+        try:
+            self.controller.exclude_exits(self._stats().blocked_exits(platform))
+        except Exception as exc:
+            wl_log.warning("Cannot exclude exits: %s", exc)
+
+    def record(self, visit):
+        """Add the outcome of a visit to the stats."""
+        exit = visit.meta.get('tor_events', {}).get('exit')
+        if exit is not None:
+            self._stats().add(metrics.platform(visit.job.url), exit,
+                              visit.successful, visit.meta.get('blocked'))
+
+    def retry_delay(self, visit):
+        """The seconds to wait before retrying a blocked visit, or None
+        if it must not be retried."""
+        if not visit.meta.get('blocked') or visit.job.attempt >= self.retries:
+            return None
+        delay = self.backoff * 2 ** visit.job.attempt
+        wl_log.info("%s blocked (exit %s), retry %d/%d in %.0f s",
+                    visit.job.url, visit.meta.get('tor_events', {}).get('exit'),
+                    visit.job.attempt + 1, self.retries, delay)
+        return delay
+
+    def new_identity(self):
+        """Make the next attempt use new circuits."""
+        if self.controller is None:
+            return
+        try:
+            self.controller.new_identity()
+        except Exception as exc:
+            wl_log.warning("Cannot signal NEWNYM: %s", exc)
+
+    def summary(self):
+        """Log the success rate per platform and the blocked exits."""
+        stats = self._stats()
+        for platform in sorted({platform for platform, _ in stats.counts}):
+            wl_log.info("%s: %.0f%% of the visits succeeded, %d exits "
+                        "blocked", platform,
+                        100 * stats.success_rate(platform),
+                        len(stats.blocked_exits(platform)))
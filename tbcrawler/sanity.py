@@ -0,0 +1,265 @@
+"""Check the visits of a crawl and index them in an SQLite database.
+
+Every visit directory is checked in a process pool: its capture is read
+for the packet count, duration and volume, and is flagged when it is
+missing, empty, truncated or shorter than the playback the video list
+expects; the visit is also flagged for missing screenshots, packets
+dropped while capturing, errors in dump.log and guards that the capture
+filter left out. The results go to `index.sqlite` in the crawl
+directory, one row per visit with its flags, so that anomalous visits
+can be found with a query instead of during the analysis. Visits that
+were packed are checked before they are removed (see `tbcrawler.pack`),
+and their rows are read from the manifest. With `requeue`, the flagged
+visits are marked in the journal to be crawled again by `--resume`, and
+their directories are moved to `requeued`.
+"""
+import argparse
+import json
+import os
+import re
+import shutil
+import sqlite3
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from os.path import basename, getsize, isdir, isfile, join
+
+import tbcrawler.common as cm
+from tbcrawler import metrics
+from tbcrawler import pcaputils as pu
+from tbcrawler.journal import CrawlJournal
+from tbcrawler.termination import capture_time
+
+INDEX_FILENAME = 'index.sqlite'
+REQUEUE_DIRNAME = 'requeued'
+VISIT_DIR = re.compile(r'^\d+_\d+_\d+$')
+# tcpdump reports these on stderr during a normal capture
+DUMP_LOG_INFO = re.compile(r'listening on|verbose output suppressed|'
+                           r'packets (captured|received by filter)')
+DUMP_LOG_DROPS = re.compile(r'(\d+) packets dropped by kernel')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS visits (
+    dir TEXT PRIMARY KEY,
+    batch INTEGER,
+    site INTEGER,
+    visit INTEGER,
+    url TEXT,
+    packets INTEGER,
+    bytes INTEGER,
+    first_packet REAL,
+    capture_duration REAL,
+    playback_time REAL,
+    end_reason TEXT,
+    screenshots INTEGER,
+    drops INTEGER,
+    log_errors TEXT,
+    flags TEXT NOT NULL,
+    anomalous INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS visits_anomalous ON visits (anomalous);
+CREATE INDEX IF NOT EXISTS visits_url ON visits (url)
+"""
+COLUMNS = ('dir', 'batch', 'site', 'visit', 'url', 'packets', 'bytes',
+           'first_packet', 'capture_duration', 'playback_time', 'end_reason',
+           'screenshots', 'drops', 'log_errors', 'flags', 'anomalous')
+
+
+def read_capture(pcap_path):
+    """Return (packets, bytes on the wire, first and last time, truncated)."""
+    packets = volume = 0
+    first = last = None
+    with open(pcap_path, 'rb') as f:
+        records = pu.PcapRecords(f)
+        scale = 1e-9 if records.nanoseconds else 1e-6
+        for ts_sec, ts_frac, orig_len, _ in records:
+            last = ts_sec + ts_frac * scale
+            if first is None:
+                first = last
+            packets += 1
+            volume += orig_len
+    return packets, volume, first, last, records.truncated
+
+
+def read_dump_log(log_path):
+    """Return (error lines, packets dropped) of a tcpdump log."""
+    errors, drops = [], 0
+    if isfile(log_path):
+        with open(log_path, errors='replace') as f:
+            for line in f:
+                line = line.strip()
+                match = DUMP_LOG_DROPS.search(line)
+                if match:
+                    drops += int(match.group(1))
+                elif line and not DUMP_LOG_INFO.search(line):
+                    errors.append(line)
+    return errors, drops
+
+
+def check_visit(visit_dir, expect_screenshots=False,
+                min_duration=cm.SANITY_MIN_CAPTURE_FRACTION):
+    """Return the index row of a visit directory."""
+    row = dict.fromkeys(COLUMNS)
+    row['dir'] = basename(visit_dir)
+    flags = []
+    meta = {}
+    meta_file = join(visit_dir, 'visit.json')
+    if isfile(meta_file):
+        with open(meta_file) as f:
+            meta = json.load(f)
+    else:
+        flags.append('no_metadata')
+    for key in ('batch', 'site', 'visit', 'url'):
+        row[key] = meta.get(key)
+    termination = meta.get('termination', {})
+    row['playback_time'] = termination.get('playback_time')
+    row['end_reason'] = termination.get('reason')
+
+    pcap_path = join(visit_dir, 'capture.pcap')
+    if not isfile(pcap_path):
+        flags.append('no_capture')
+    else:
+        try:
+            packets, volume, first, last, truncated = read_capture(pcap_path)
+        except pu.PcapFormatError:
+            flags.append('bad_capture' if getsize(pcap_path) else 'empty_capture')
+        else:
+            row.update(packets=packets, bytes=volume, first_packet=first,
+                       capture_duration=last - first if packets else 0.)
+            if not packets:
+                flags.append('empty_capture')
+            if truncated:
+                flags.append('truncated_capture')
+            # a visit that a policy ended early, on purpose, is only
+            # compared with how long it played
+            if meta.get('playback_time') and \
+                    row['end_reason'] in (None, 'deadline'):
+                expected = capture_time(meta['playback_time'])
+            else:
+                expected = row['playback_time']
+            if expected and row['capture_duration'] < min_duration * expected:
+                flags.append('short_capture')
+
+    # the filter is fixed when the capture starts: the traffic to a
+    # guard that Tor moved to since is missing from the capture
+    hosts = meta.get('capture_hosts')
+    if hosts is not None and set(meta.get('guards') or ()) - set(hosts):
+        flags.append('guards_outside_filter')
+
+    row['screenshots'] = len([name for name in os.listdir(visit_dir)
+                              if name.startswith('screenshot_')])
+    if expect_screenshots and row['screenshots'] < 2:
+        flags.append('missing_screenshots')
+
+    errors, drops = read_dump_log(join(visit_dir, 'dump.log'))
+    drops += (meta.get('capture') or {}).get('drops', 0)
+    row['drops'] = drops
+    row['log_errors'] = '\n'.join(errors) or None
+    if drops:
+        flags.append('dropped_packets')
+    if errors:
+        flags.append('capture_errors')
+    row['flags'] = ','.join(flags)
+    row['anomalous'] = int(bool(flags))
+    return row
+
+
+def find_visits(crawl_dir):
+    """Return the visit directories of a crawl."""
+    return [join(crawl_dir, name) for name in sorted(os.listdir(crawl_dir))
+            if VISIT_DIR.match(name) and isdir(join(crawl_dir, name))]
+
+
+def packed_rows(crawl_dir, expect_screenshots=False):
+    """Return the index rows that the packed visits were checked with,
+    for the visits whose directory was removed."""
+    rows = []
+    manifest = join(crawl_dir, cm.PACK_DIRNAME, cm.PACK_MANIFEST)
+    for entry in metrics.read_records(manifest):
+        row = entry.get('check')
+        if row is None or isdir(join(crawl_dir, entry['dir'])):
+            continue
+        if expect_screenshots and row['screenshots'] < 2:
+            row['flags'] = ','.join(filter(None, [row['flags'],
+                                                  'missing_screenshots']))
+            row['anomalous'] = 1
+        rows.append(row)
+    return rows
+
+
+def write_index(index_path, rows):
+    connection = sqlite3.connect(index_path)
+    with connection:
+        connection.executescript(SCHEMA)
+        connection.execute("DELETE FROM visits")
+        connection.executemany(
+            "INSERT OR REPLACE INTO visits VALUES (%s)"
+            % ', '.join('?' * len(COLUMNS)),
+            [[row[column] for column in COLUMNS] for row in rows])
+    connection.close()
+
+
+def requeue(crawl_dir, rows):
+    """Have `--resume` crawl the anomalous visits again.
+
+    Returns the number of visits requeued.
+    """
+    journal = CrawlJournal(join(crawl_dir, cm.JOURNAL_FILENAME))
+    requeue_dir = join(crawl_dir, REQUEUE_DIRNAME)
+    count = 0
+    for row in rows:
+        if not row['anomalous'] or row['batch'] is None:
+            continue
+        journal.requeue(row['batch'], row['site'], row['visit'])
+        count += 1
+        if not isdir(join(crawl_dir, row['dir'])):
+            continue  # packed
+        os.makedirs(requeue_dir, exist_ok=True)
+        if isdir(join(requeue_dir, row['dir'])):
+            shutil.rmtree(join(requeue_dir, row['dir']))
+        shutil.move(join(crawl_dir, row['dir']),
+                    join(requeue_dir, row['dir']))
+    return count
+
+
+def check_crawl(crawl_dir, workers=None, expect_screenshots=False):
+    """Check the visits of a crawl in a process pool and index them,
+    with the packed visits.
+
+    Returns the index rows.
+    """
+    visit_dirs = find_visits(crawl_dir)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        rows = list(pool.map(check_visit, visit_dirs,
+                             [expect_screenshots] * len(visit_dirs),
+                             chunksize=16))
+    rows += packed_rows(crawl_dir, expect_screenshots)
+    rows.sort(key=lambda row: row['dir'])
+    write_index(join(crawl_dir, INDEX_FILENAME), rows)
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Check the visits of a crawl and index them.')
+    parser.add_argument('crawl_dir', help='Crawl results directory.')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='Number of processes (default: one per CPU).')
+    parser.add_argument('-s', '--screenshots', action='store_true', default=False,
+                        help='The crawl took screenshots; flag visits without.')
+    parser.add_argument('--requeue', action='store_true', default=False,
+                        help='Mark the anomalous visits to be crawled again by '
+                             '--resume, and move them to %s/.' % REQUEUE_DIRNAME)
+    args = parser.parse_args(argv)
+    rows = check_crawl(args.crawl_dir, args.jobs, args.screenshots)
+    anomalous = [row for row in rows if row['anomalous']]
+    for row in anomalous:
+        print("%s: %s" % (row['dir'], row['flags']))
+    print("%d visits, %d anomalous, indexed in %s"
+          % (len(rows), len(anomalous), join(args.crawl_dir, INDEX_FILENAME)))
+    if args.requeue:
+        print("%d visits requeued" % requeue(args.crawl_dir, anomalous))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,105 @@
+"""Screenshots written in the background.
+
+The crawl thread only fetches the PNG bytes from the browser; a pool of
+threads downscales and re-encodes them, if asked, and writes them to
+disk. Re-encoding needs Pillow; without it, screenshots are written as
+the browser returned them.
+"""
+import io
+import os
+import threading
+from queue import Full, Queue
+
+import tbcrawler.common as cm
+from tbcrawler.log import wl_log
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+FORMATS = {'png': 'PNG', 'jpeg': 'JPEG', 'webp': 'WEBP'}
+
+
+class ScreenshotWriter(object):
+    """Writes screenshots from a bounded queue with `workers` threads.
+
+    When the queue stays full for `QUEUE_TIMEOUT` seconds, the screenshot
+    is dropped rather than holding up the crawl.
+    """
+    QUEUE_TIMEOUT = 5
+
+    def __init__(self, fmt='png', quality=80, scale=1.0,
+                 workers=cm.SCREENSHOT_WORKERS,
+                 queue_size=cm.SCREENSHOT_QUEUE_SIZE):
+        if (fmt != 'png' or scale != 1) and Image is None:
+            wl_log.warning("Pillow is not installed, writing screenshots "
+                           "as full-size PNG")
+            fmt, scale = 'png', 1.0
+        self.fmt = fmt
+        self.quality = quality
+        self.scale = scale
+        self.queue = Queue(queue_size)
+        self.written = 0
+        self.dropped = 0
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._work, daemon=True,
+                                      name='screenshots-%d' % i)
+            thread.start()
+            self.threads.append(thread)
+
+    def path(self, png_path):
+        """The path a screenshot requested at `png_path` is written to."""
+        return os.path.splitext(png_path)[0] + '.' + self.fmt
+
+    def submit(self, png, png_path):
+        try:
+            self.queue.put((png, self.path(png_path)),
+                           timeout=self.QUEUE_TIMEOUT)
+        except Full:
+            self.dropped += 1
+            wl_log.warning("Screenshot queue full, dropping %s", png_path)
+
+    def flush(self):
+        """Wait until all submitted screenshots are written."""
+        self.queue.join()
+
+    def close(self):
+        self.flush()
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def encode(self, png):
+        """Return the screenshot in the output format and scale."""
+        if self.fmt == 'png' and self.scale == 1:
+            return png
+        image = Image.open(io.BytesIO(png))
+        if self.scale != 1:
+            size = (max(1, int(image.width * self.scale)),
+                    max(1, int(image.height * self.scale)))
+            image = image.resize(size, Image.BILINEAR)
+        if self.fmt == 'jpeg' and image.mode != 'RGB':
+            image = image.convert('RGB')
+        out = io.BytesIO()
+        image.save(out, FORMATS[self.fmt], quality=self.quality)
+        return out.getvalue()
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                png, path = item
+                # the directory of a failed visit may be gone already
+                if os.path.isdir(os.path.dirname(path)):
+                    with open(path, 'wb') as f:
+                        f.write(self.encode(png))
+                    self.written += 1
+            except Exception as exc:
+                wl_log.error("Cannot write screenshot %s: %s", item[1], exc)
+            finally:
+                self.queue.task_done()
@@ -0,0 +1,228 @@
+"""Split the capture of a whole batch into the captures of its visits.
+
+A batch capture runs for as long as the Tor process of the batch, and
+every visit is a time window within it. Records are routed to the
+capture of the window that contains their timestamp; records between
+windows belong to no visit and are dropped. The splitter either tails
+the batch capture while it is written (live), so that every visit's
+capture is complete when the visit ends, or splits it once the batch
+capture has stopped (post).
+"""
+import io
+import os
+import struct
+import threading
+from collections import deque
+from os.path import dirname, isdir
+from time import sleep, time
+
+from tbcrawler import pcaputils as pu
+from tbcrawler.log import wl_log
+
+TAIL_POLL_INTERVAL = 0.05  # in seconds
+# packets with earlier timestamps may still be in the capture buffers
+# this long after a visit ends
+FLUSH_GRACE = 0.5  # in seconds
+SPLIT_MODES = ('live', 'post')
+
+
+class VisitWindow(object):
+    """The time window of one visit and its output capture."""
+
+    def __init__(self, pcap_path, start):
+        self.pcap_path = pcap_path
+        self.start = start
+        self.end = None
+        self.packets = 0
+        self.out = None
+        self.discarded = False
+        self.closed = False
+
+    def _open(self, header):
+        # the directory of a failed visit is deleted, drop its packets
+        if not isdir(dirname(self.pcap_path)):
+            self.discarded = True
+            return
+        self.out = open(self.pcap_path, 'wb')
+        self.out.write(header)
+
+    def write(self, header, record):
+        if self.out is None and not self.discarded:
+            self._open(header)
+        if self.out is not None:
+            self.out.write(record)
+            self.packets += 1
+
+    def close(self, header):
+        # a visit without packets still gets an empty capture
+        if self.out is None and not self.discarded:
+            self._open(header)
+        if self.out is not None:
+            self.out.close()
+        self.closed = True
+
+
+class PcapSplitter(object):
+    """Routes the records of a batch capture to visit windows.
+
+    Call `begin_visit` right before a visit starts and `end_visit` right
+    after it ends, then `finish` once the batch capture has stopped. In
+    live mode, `end_visit` returns when the visit's capture is complete.
+    """
+
+    def __init__(self, pcap_path, live=True):
+        self.pcap_path = pcap_path
+        self.live = live
+        self.header = None
+        self.endian = '<'
+        self.windows = deque()
+        self.cond = threading.Condition()
+        self.at_eof = False
+        self.total = 0
+        self.late = 0  # records of a window that had already closed
+        self.closed_until = 0.
+        self.thread = None
+        self._stopping = False
+
+    def start(self):
+        if self.live:
+            self.thread = threading.Thread(target=self._tail, daemon=True,
+                                           name='pcap-splitter')
+            self.thread.start()
+
+    def begin_visit(self, pcap_path):
+        window = VisitWindow(pcap_path, time())
+        with self.cond:
+            self.windows.append(window)
+        return window
+
+    def end_visit(self, window):
+        """Close the window of a visit. In live mode, wait until all
+        the packets captured before it ended have been routed."""
+        with self.cond:
+            window.end = time()
+            if not self.live:
+                return window.packets
+            deadline = window.end + FLUSH_GRACE
+            while not window.closed:
+                remaining = deadline - time()
+                if remaining <= 0 and self.at_eof:
+                    self._close_window(window)
+                    break
+                self.cond.wait(max(remaining, TAIL_POLL_INTERVAL))
+        return window.packets
+
+    def finish(self):
+        """Route what is left of the batch capture, once it has stopped,
+        and remove it."""
+        if self.live:
+            with self.cond:
+                self._stopping = True
+            self.thread.join()
+        else:
+            self._split()
+        with self.cond:
+            while self.windows:
+                self._close_window(self.windows[0])
+        wl_log.info("Split %d packets of %s into visit captures",
+                    self.total, self.pcap_path)
+        if self.late:
+            wl_log.warning("%d packets reached %s after their visit's capture "
+                           "was closed", self.late, self.pcap_path)
+        if os.path.isfile(self.pcap_path):
+            os.remove(self.pcap_path)
+
+    def _close_window(self, window):
+        if window.end is not None:
+            self.closed_until = max(self.closed_until, window.end)
+        window.close(self.header or b'')
+        self.windows.remove(window)
+        self.cond.notify_all()
+
+    def _route(self, ts, record):
+        """Write a record to the window that contains it. Called with
+        the condition held."""
+        self.total += 1
+        windows = self.windows
+        while windows and windows[0].end is not None and ts > windows[0].end:
+            self._close_window(windows[0])
+        if windows and ts >= windows[0].start:
+            windows[0].write(self.header, record)
+        elif ts <= self.closed_until:
+            self.late += 1
+
+    def _split(self):
+        try:
+            f = open(self.pcap_path, 'rb')
+        except IOError as exc:
+            wl_log.error("Cannot split the batch capture: %s", exc)
+            return
+        with f:
+            try:
+                records = pu.PcapRecords(f)
+            except pu.PcapFormatError as exc:
+                wl_log.error("Cannot split %s: %s", self.pcap_path, exc)
+                return
+            self.header = records.header
+            scale = 1e-9 if records.nanoseconds else 1e-6
+            with self.cond:
+                for ts_sec, ts_frac, _, record in records:
+                    self._route(ts_sec + ts_frac * scale, record)
+
+    def _tail(self):
+        while not os.path.isfile(self.pcap_path) and not self._stopping:
+            sleep(TAIL_POLL_INTERVAL)
+        try:
+            with open(self.pcap_path, 'rb') as f:
+                self._tail_file(f)
+        except Exception as exc:
+            wl_log.error("Splitting %s failed: %s", self.pcap_path, exc)
+        with self.cond:
+            self.at_eof = True
+            self.cond.notify_all()
+
+    def _tail_file(self, f):
+        buf = b''
+        record_header = None
+        scale = 1e-6
+        while True:
+            # read the flag before the data, so that nothing written
+            # before the capture stopped is missed
+            stopping = self._stopping
+            chunk = f.read(pu.READ_CHUNK)
+            if not chunk:
+                with self.cond:
+                    self.at_eof = True
+                    self.cond.notify_all()
+                if stopping:
+                    return
+                sleep(TAIL_POLL_INTERVAL)
+                continue
+            buf += chunk
+            if self.header is None:
+                if len(buf) < pu.PCAP_HEADER_LEN:
+                    continue
+                records = pu.PcapRecords(io.BytesIO(buf[:pu.PCAP_HEADER_LEN]))
+                self.header = records.header
+                self.endian = records.endian
+                scale = 1e-9 if records.nanoseconds else 1e-6
+                record_header = struct.Struct(self.endian + 'IIII')
+                buf = buf[pu.PCAP_HEADER_LEN:]
+            pos = 0
+            end = len(buf)
+            with self.cond:
+                self.at_eof = False
+                while pos + pu.RECORD_HEADER_LEN <= end:
+                    ts_sec, ts_frac, incl_len, _ = \
+                        record_header.unpack_from(buf, pos)
+                    next_pos = pos + pu.RECORD_HEADER_LEN + incl_len
+                    if next_pos > end:
+                        break
+                    self._route(ts_sec + ts_frac * scale, buf[pos:next_pos])
+                    pos = next_pos
+                for window in self.windows:
+                    if window.out is not None:
+                        window.out.flush()
+                self.cond.notify_all()
+            buf = buf[pos:]
+
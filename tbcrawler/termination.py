@@ -0,0 +1,167 @@
+from collections import deque
+
+from selenium.common.exceptions import WebDriverException
+
+import tbcrawler.common as cm
+
+# YouTube's player API, or the progress of the first HTML5 video element
+PLAYER_STATE_JS = """
+var player = document.getElementById('movie_player');
+if (player && player.getPlayerState) {
+    return [player.getPlayerState() === 0, player.getVideoLoadedFraction()];
+}
+var video = document.querySelector('video');
+if (!video || !video.duration) {
+    return null;
+}
+var buffered = video.buffered;
+var end = buffered.length ? buffered.end(buffered.length - 1) : 0;
+return [video.ended, end / video.duration];
+"""
+
+
+def capture_time(playback_time):
+    """Seconds of playback that a visit to a video of `playback_time`
+    seconds captures, unless it ends early."""
+    return min(playback_time - cm.PLAYBACK_END_MARGIN, cm.MAX_PLAYBACK_TIME)
+
+
+class TerminationPolicy(object):
+    """Decides when a visit has captured enough and can end.
+
+    `start` is called when playback starts, then `check` is called until
+    it returns the reason for ending the visit. `wait_time` tells the
+    crawler how long it can sleep before the next check.
+    """
+    name = None
+    poll_interval = 1.0
+
+    def __init__(self):
+        self.crawler = None
+        self.time_0 = None
+
+    def start(self, crawler, time_0):
+        self.crawler = crawler
+        self.time_0 = time_0
+
+    def check(self, now):
+        return None
+
+    def wait_time(self, now):
+        return self.poll_interval
+
+
+class DeadlinePolicy(TerminationPolicy):
+    """Ends when the video should end, or after `MAX_PLAYBACK_TIME`."""
+    name = 'deadline'
+
+    def start(self, crawler, time_0):
+        super(DeadlinePolicy, self).start(crawler, time_0)
+        self.end = time_0 + capture_time(crawler.job.playback_time)
+
+    def check(self, now):
+        if now >= self.end:
+            return 'deadline'
+
+    def wait_time(self, now):
+        return max(self.end - now, 0)
+
+
+class PlayerStatePolicy(TerminationPolicy):
+    """Ends when the player reports the video ended, or `tail` seconds
+    after the whole video has been loaded."""
+    name = 'player'
+    poll_interval = 2.0
+
+    def __init__(self, tail=cm.PLAYER_LOADED_TAIL):
+        super(PlayerStatePolicy, self).__init__()
+        self.tail = tail
+        self.loaded_at = None
+
+    def start(self, crawler, time_0):
+        super(PlayerStatePolicy, self).start(crawler, time_0)
+        self.loaded_at = None
+
+    def check(self, now):
+        try:
+            state = self.crawler.driver.execute_script(PLAYER_STATE_JS)
+        except WebDriverException:
+            return None
+        if not state:
+            return None
+        ended, loaded_fraction = state
+        if ended:
+            return 'player_ended'
+        if loaded_fraction is not None and loaded_fraction >= 1:
+            if self.loaded_at is None:
+                self.loaded_at = now
+            if now - self.loaded_at >= self.tail:
+                return 'fully_loaded'
+
+
+class NetworkIdlePolicy(TerminationPolicy):
+    """Ends when the capture grows by less than `min_bytes` during
+    `idle_time` seconds, once the visit has lasted `min_time` seconds."""
+    name = 'idle'
+
+    def __init__(self, idle_time=cm.NETWORK_IDLE_TIME,
+                 min_bytes=cm.NETWORK_IDLE_BYTES,
+                 min_time=cm.NETWORK_IDLE_MIN_TIME):
+        super(NetworkIdlePolicy, self).__init__()
+        self.idle_time = idle_time
+        self.min_bytes = min_bytes
+        self.min_time = min_time
+        self.sizes = deque()
+
+    def start(self, crawler, time_0):
+        super(NetworkIdlePolicy, self).start(crawler, time_0)
+        self.sizes.clear()
+
+    def check(self, now):
+        size = self.crawler.capture_size()
+        self.sizes.append((now, size))
+        # keep the newest sample that is at least idle_time old
+        while len(self.sizes) > 1 and self.sizes[1][0] <= now - self.idle_time:
+            self.sizes.popleft()
+        since, since_size = self.sizes[0]
+        if now - self.time_0 < self.min_time or now - since < self.idle_time:
+            return None
+        if size - since_size < self.min_bytes:
+            return 'network_idle'
+
+
+class AnyPolicy(TerminationPolicy):
+    """Ends as soon as any of the policies is satisfied."""
+
+    def __init__(self, policies):
+        super(AnyPolicy, self).__init__()
+        self.policies = policies
+        self.name = '+'.join(policy.name for policy in policies)
+
+    def start(self, crawler, time_0):
+        super(AnyPolicy, self).start(crawler, time_0)
+        for policy in self.policies:
+            policy.start(crawler, time_0)
+
+    def check(self, now):
+        for policy in self.policies:
+            reason = policy.check(now)
+            if reason:
+                return reason
+
+    def wait_time(self, now):
+        return min(policy.wait_time(now) for policy in self.policies)
+
+
+POLICIES = {policy.name: policy for policy in
+            (DeadlinePolicy, PlayerStatePolicy, NetworkIdlePolicy)}
+
+
+def make_policy(names=()):
+    """Return a policy for the given names, always bounded by the deadline."""
+    policies = [DeadlinePolicy()]
+    policies += [POLICIES[name]() for name in names if name != 'deadline']
+    if len(policies) == 1:
+        return policies[0]
+    return AnyPolicy(policies)
+
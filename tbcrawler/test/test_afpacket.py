@@ -0,0 +1,61 @@
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+from time import sleep
+
+from tbcrawler import afpacket
+from tbcrawler import pcaputils as pu
+
+
+class AfPacketTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.pcap_path = os.path.join(self.tmpdir, 'capture.pcap')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_empty_filter_accepts_snaplen(self):
+        self.assertEqual(afpacket.compile_filter('', pu.LINKTYPE_ETHERNET,
+                                                 71, 'lo'),
+                         [(afpacket.BPF_RET_K, 0, 0, 71)])
+
+    def test_device_linktype(self):
+        self.assertEqual(afpacket.device_linktype('lo'), pu.LINKTYPE_ETHERNET)
+        with self.assertRaises(afpacket.CaptureError):
+            afpacket.device_linktype('nosuchdevice0')
+
+    def test_capture_loopback(self):
+        capture = afpacket.RingCapture(self.pcap_path, 'lo', '', 71)
+        try:
+            capture.start()
+        except afpacket.CaptureError as exc:
+            self.skipTest(str(exc))  # needs CAP_NET_RAW
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for _ in range(100):
+            client.sendto(b'x' * 500, server.getsockname())
+        sleep(0.1)
+        stats = capture.stop()
+        server.close()
+        client.close()
+
+        with open(self.pcap_path, 'rb') as f:
+            records = pu.PcapRecords(f)
+            udp = [(orig_len, record) for _, _, orig_len, record in records
+                   if pu.ip_header(records.linktype, record,
+                                   pu.RECORD_HEADER_LEN)[0] == pu.PROTO_UDP]
+        self.assertEqual(records.snaplen, 71)
+        # loopback packets are seen twice but written once
+        self.assertGreaterEqual(len(udp), 100)
+        self.assertEqual(stats['drops'], 0)
+        orig_len, record = udp[0]
+        self.assertEqual(orig_len, 14 + 20 + 8 + 500)
+        self.assertEqual(len(record), pu.RECORD_HEADER_LEN + 71)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,72 @@
+import os
+import tempfile
+import unittest
+from os.path import isdir, join
+from shutil import rmtree
+
+from tbcrawler import utils as ut
+
+NAMES = ('geoip', 'state', join('keys', 'secret_id_key'))
+
+
+class CloneDirTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        os.makedirs(join(self.tempdir, 'keys'))
+        for name in NAMES:
+            with open(join(self.tempdir, name), 'w') as f:
+                f.write(name)
+
+    def tearDown(self):
+        rmtree(self.tempdir)
+
+    def assert_unchanged(self):
+        for name in NAMES:
+            with open(join(self.tempdir, name)) as f:
+                self.assertEqual(f.read(), name)
+
+    def clone(self, tmp_root):
+        clonedir = tempfile.mkdtemp(dir=tmp_root)
+        try:
+            return ut.clone_dir(self.tempdir, clonedir, ('geoip',))
+        finally:
+            rmtree(clonedir)
+
+    def modify_clone(self, tmp_root):
+        tmpdir = ut.clone_dir_temporary(self.tempdir, ('geoip',), tmp_root)
+        self.assertTrue(isdir(tmpdir))
+        # Tor replaces linked files and modifies the others in place
+        with open(join(tmpdir, 'geoip.tmp'), 'w') as f:
+            f.write('new')
+        os.replace(join(tmpdir, 'geoip.tmp'), join(tmpdir, 'geoip'))
+        with open(join(tmpdir, 'state'), 'a') as f:
+            f.write('new')
+        rmtree(tmpdir)
+
+    def test_clone_dir(self):
+        counts = self.clone(None)
+        self.assertEqual(counts['linked'], 1)
+        self.assertEqual(counts['reflinked'] + counts['copied'], 2)
+
+    def test_clone_dir_to_tmpfs(self):
+        tmp_root = ut.tmpfs_dir()
+        if tmp_root is None:
+            self.skipTest("no tmpfs")
+        counts = self.clone(tmp_root)
+        self.assertEqual(counts['linked'], 1)
+        self.assertEqual(counts['reflinked'] + counts['copied'], 2)
+
+    def test_clone_dir_temporary_keeps_source(self):
+        self.modify_clone(None)
+        self.assert_unchanged()
+
+    def test_clone_dir_temporary_to_tmpfs_keeps_source(self):
+        tmp_root = ut.tmpfs_dir()
+        if tmp_root is None:
+            self.skipTest("no tmpfs")
+        self.modify_clone(tmp_root)
+        self.assert_unchanged()
+
+
+if __name__ == "__main__":
+    unittest.main()
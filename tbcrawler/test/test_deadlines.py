@@ -0,0 +1,71 @@
+import socket
+import threading
+import unittest
+from time import sleep, time
+
+import tbcrawler.common as cm
+from tbcrawler.deadlines import deadline
+
+
+def busy(seconds):
+    """Run Python code, where the deadline's exception can be raised."""
+    end = time() + seconds
+    while time() < end:
+        sleep(0.01)
+
+
+class DeadlineTest(unittest.TestCase):
+    def setUp(self):
+        self.grace = cm.DEADLINE_GRACE
+        cm.DEADLINE_GRACE = 0.2
+
+    def tearDown(self):
+        cm.DEADLINE_GRACE = self.grace
+
+    def test_expires(self):
+        start = time()
+        with self.assertRaises(cm.TimeoutException):
+            with deadline(0.1):
+                busy(2)
+        self.assertLess(time() - start, 0.5)
+
+    def test_cancelled(self):
+        with deadline(0.1):
+            busy(0.05)
+        busy(0.2)  # no exception after the block
+
+    def test_nested(self):
+        with self.assertRaises(cm.HardTimeoutException):
+            with deadline(0.5, exception=cm.HardTimeoutException):
+                with self.assertRaises(cm.TimeoutException):
+                    with deadline(0.1):
+                        busy(2)
+                busy(2)
+
+    def test_in_thread_with_blocking_call(self):
+        result = {}
+        left, right = socket.socketpair()
+
+        def unblock():
+            left.shutdown(socket.SHUT_RDWR)
+
+        def worker():
+            start = time()
+            try:
+                with deadline(0.1, [unblock]):
+                    left.recv(1)  # blocks until unblock() after the grace
+                    busy(2)
+            except cm.TimeoutException:
+                result['elapsed'] = time() - start
+
+        thread = threading.Thread(target=worker)
+        thread.start()
+        thread.join(5)
+        left.close()
+        right.close()
+        self.assertGreaterEqual(result['elapsed'], 0.3)
+        self.assertLess(result['elapsed'], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -3,9 +3,10 @@ import pytest
 import time
 import unittest
 import tempfile
-from urllib2 import urlopen
+from urllib.request import urlopen
 
-from tbcrawler.dumputils import Sniffer
+import tbcrawler.common as cm
+from tbcrawler.dumputils import Sniffer, combine_filters, host_filter
 
 TEST_CAP_FILTER = 'host 255.255.255.255'
 TEST_PCAP_FILE = tempfile.NamedTemporaryFile()
@@ -47,6 +48,25 @@ class SnifferTest(unittest.TestCase):
                         "Sniffer filter cannot be set %s %s"
                         % (TEST_CAP_FILTER, self.snf.get_capture_filter()))
 
+    def test_host_filter(self):
+        self.assertEqual(host_filter(['2001:67c:289c::9', '171.25.193.9'], ''),
+                         'host 171.25.193.9 or host 2001:67c:289c::9')
+        self.assertEqual(host_filter(['171.25.193.9'], 'not tcp port 22'),
+                         '(host 171.25.193.9) and (not tcp port 22)')
+        self.assertEqual(combine_filters('port 53', ''), 'port 53')
+
+    def test_rotation(self):
+        timeout = cm.HARD_VISIT_TIMEOUT
+        try:
+            cm.HARD_VISIT_TIMEOUT = 3600  # set by --timeout after import
+            self.assertIn('-G 3600 ', self.snf.tcpdump_command())
+        finally:
+            cm.HARD_VISIT_TIMEOUT = timeout
+        self.assertNotIn('-G', Sniffer(rotate=0).tcpdump_command())
+
+    def test_immediate_mode(self):
+        self.assertIn(' --immediate-mode ', self.snf.tcpdump_command())
+
     @pytest.mark.skipif(bool(os.getenv('CI', False)), reason='Skip in CI')
     def test_start_capture(self):
         if os.path.isfile(TEST_PCAP_PATH):
@@ -0,0 +1,53 @@
+import tempfile
+import unittest
+from os.path import join
+from shutil import rmtree
+from time import time
+
+from tbcrawler.journal import CrawlJournal, SUCCESS, FAILED, REQUEUED
+
+TEST_URL = 'https://vimeo.com/641878345'
+
+
+class CrawlJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = join(self.tempdir, 'journal.sqlite')
+        self.journal = CrawlJournal(self.path)
+
+    def tearDown(self):
+        rmtree(self.tempdir)
+
+    def test_success_is_skipped(self):
+        self.journal.record(0, 3, 0, TEST_URL, SUCCESS, time(), '/tmp/0_3_0')
+        self.assertTrue(self.journal.succeeded(0, 3, 0, TEST_URL))
+        self.assertFalse(self.journal.succeeded(0, 3, 1, TEST_URL))
+        self.assertFalse(self.journal.succeeded(0, 3, 0, 'https://vimeo.com/1'))
+
+    def test_failure_is_requeued(self):
+        self.journal.record(0, 3, 0, TEST_URL, FAILED, time(), '/tmp/0_3_0')
+        self.assertFalse(self.journal.succeeded(0, 3, 0, TEST_URL))
+        self.journal.record(0, 3, 0, TEST_URL, SUCCESS, time(), '/tmp/0_3_0')
+        self.assertTrue(self.journal.succeeded(0, 3, 0, TEST_URL))
+        self.assertDictEqual(self.journal.counts(), {SUCCESS: 1})
+
+    def test_success_can_be_requeued(self):
+        self.journal.record(0, 3, 0, TEST_URL, SUCCESS, time(), '/tmp/0_3_0')
+        self.journal.requeue(0, 3, 0)
+        self.assertFalse(self.journal.succeeded(0, 3, 0, TEST_URL))
+        self.assertDictEqual(self.journal.counts(), {REQUEUED: 1})
+
+    def test_parameters_of_the_start(self):
+        self.assertEqual(self.journal.parameters(), {})
+        self.journal.record_parameters({'start': 1, 'stop': 10})
+        self.journal.record_parameters({'start': 2, 'stop': 10, 'extra': 'a'})
+        self.assertEqual(CrawlJournal(self.path).parameters(),
+                         {'start': 1, 'stop': 10, 'extra': 'a'})
+
+    def test_survives_reopening(self):
+        self.journal.record(1, 0, 0, TEST_URL, SUCCESS, time(), '/tmp/1_0_1')
+        self.assertTrue(CrawlJournal(self.path).succeeded(1, 0, 0, TEST_URL))
+
+
+if __name__ == "__main__":
+    unittest.main()
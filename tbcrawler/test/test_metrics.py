@@ -0,0 +1,75 @@
+import os
+import shutil
+import tempfile
+import unittest
+from time import sleep, time
+from urllib.request import urlopen
+
+from tbcrawler import metrics
+
+
+def visit_record(outcome='success', url='https://www.youtube.com/watch?v=x',
+                 phases=None):
+    return {'url': url, 'platform': metrics.platform(url), 'outcome': outcome,
+            'started': time() - 100, 'duration': 90.0,
+            'phases': phases or {'page_load': 2.5, 'playback': 80.0},
+            'capture_bytes': 1000}
+
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'visits.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_spans(self):
+        metrics.take_spans()
+        with metrics.span('page_load'):
+            sleep(0.01)
+        metrics.add_span('page_load', 1)
+        metrics.add_span('playback', 2)
+        phases = metrics.take_spans()
+        self.assertGreaterEqual(phases['page_load'], 1.01)
+        self.assertEqual(phases['playback'], 2)
+        self.assertEqual(metrics.take_spans(), {})
+
+    def test_platform(self):
+        self.assertEqual(metrics.platform('https://vimeo.com/1'), 'vimeo')
+        self.assertEqual(metrics.platform('https://example.org/v'),
+                         'example.org')
+
+    def test_stats_follow_the_file(self):
+        stats = metrics.VisitStats(self.path)
+        stats.update()
+        metrics.write_record(self.path, visit_record())
+        metrics.write_record(self.path, visit_record('failed'))
+        stats.update()
+        metrics.write_record(self.path, visit_record(
+            url='https://vimeo.com/1', phases={'page_load': 1.5}))
+        stats.update()
+        text = stats.exposition()
+        self.assertIn('tbcrawler_visits_total{platform="youtube",'
+                      'outcome="success"} 1', text)
+        self.assertIn('tbcrawler_visits_total{platform="vimeo",'
+                      'outcome="success"} 1', text)
+        self.assertIn('tbcrawler_phase_seconds_total{phase="page_load"} '
+                      '6.500', text)
+        self.assertIn('tbcrawler_captured_bytes_total 3000', text)
+        self.assertIn('tbcrawler_visits_last_hour{outcome="failed"} 1', text)
+
+    def test_server(self):
+        metrics.write_record(self.path, visit_record())
+        server = metrics.MetricsServer(self.path, 0)
+        server.start()
+        try:
+            url = 'http://127.0.0.1:%d/metrics' % server.httpd.server_port
+            body = urlopen(url).read().decode()
+        finally:
+            server.stop()
+        self.assertIn('tbcrawler_visits_last_hour{outcome="success"} 1', body)
+
+
+if __name__ == "__main__":
+    unittest.main()
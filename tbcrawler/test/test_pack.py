@@ -0,0 +1,99 @@
+import os
+import tempfile
+import unittest
+from os.path import isdir, isfile, join
+from shutil import rmtree
+
+import tbcrawler.common as cm
+from tbcrawler import metrics, pack
+
+
+class PackTest(unittest.TestCase):
+    def setUp(self):
+        self.crawl_dir = tempfile.mkdtemp()
+        for i in range(5):
+            self.add_visit(i)
+
+    def tearDown(self):
+        rmtree(self.crawl_dir)
+
+    def add_visit(self, site, record=True):
+        name = '0_%d_0' % site
+        os.makedirs(join(self.crawl_dir, name))
+        with open(join(self.crawl_dir, name, 'capture.pcap'), 'wb') as f:
+            f.write(os.urandom(1000 + site))
+        with open(join(self.crawl_dir, name, 'dump.log'), 'w') as f:
+            f.write('log %d\n' % site)
+        if record:
+            metrics.write_record(join(self.crawl_dir, cm.VISITS_FILENAME), {
+                'url': 'https://vimeo.com/%d' % site, 'platform': 'vimeo',
+                'batch': 0, 'site': site, 'visit': 0, 'dir': name,
+                'outcome': 'success'})
+        return name
+
+    def test_pack_and_read_back(self):
+        with open(join(self.crawl_dir, '0_3_0', 'capture.pcap'), 'rb') as f:
+            pcap = f.read()
+        done, skipped, failed = pack.pack_crawl(self.crawl_dir, 'xz', workers=2,
+                                                shard_size=2, min_age=0)
+        self.assertEqual((done, skipped, failed), (5, 0, 0))
+        self.assertFalse(isdir(join(self.crawl_dir, '0_3_0')))
+        archives = sorted(os.listdir(join(self.crawl_dir, cm.PACK_DIRNAME)))
+        self.assertEqual(archives, [cm.PACK_MANIFEST, 'shard_000000.tar.xz',
+                                    'shard_000001.tar.xz', 'shard_000002.tar.xz'])
+
+        entry = pack.read_manifest(self.crawl_dir)['0_3_0']
+        self.assertEqual(entry['url'], 'https://vimeo.com/3')
+        self.assertEqual(entry['outcome'], 'success')
+        self.assertEqual(entry['files']['capture.pcap']['size'], 1003)
+        contents = pack.read_visit(self.crawl_dir, '0_3_0')
+        self.assertEqual(contents['capture.pcap'], pcap)
+        self.assertEqual(contents['dump.log'], b'log 3\n')
+
+    def test_incremental(self):
+        pack.pack_crawl(self.crawl_dir, 'xz', workers=1, min_age=0)
+        # a visit in progress has no record yet
+        running = self.add_visit(5, record=False)
+        self.assertEqual(pack.pack_crawl(self.crawl_dir, 'xz', workers=1,
+                                         min_age=0), (0, 5, 0))
+        self.assertTrue(isdir(join(self.crawl_dir, running)))
+        self.add_visit(6)
+        self.assertEqual(pack.pack_crawl(self.crawl_dir, 'xz', workers=1,
+                                         min_age=0), (1, 5, 0))
+        self.assertTrue(isfile(join(self.crawl_dir, cm.PACK_DIRNAME,
+                                    'shard_000001.tar.xz')))
+
+    def test_batch_capture_waits(self):
+        batch_pcap = join(self.crawl_dir, 'batch_0_eth0.pcap')
+        open(batch_pcap, 'wb').close()
+        self.assertEqual(pack.pack_crawl(self.crawl_dir, 'xz', workers=1,
+                                         min_age=0), (0, 0, 0))
+        os.remove(batch_pcap)  # split into the visits' captures
+        self.assertEqual(pack.pack_crawl(self.crawl_dir, 'xz', workers=1,
+                                         min_age=0), (5, 0, 0))
+
+    def test_checked_before_removal(self):
+        pack.pack_crawl(self.crawl_dir, 'xz', workers=1, min_age=0)
+        check = pack.read_manifest(self.crawl_dir)['0_3_0']['check']
+        self.assertEqual(check['dir'], '0_3_0')
+        self.assertEqual(check['flags'],
+                         'no_metadata,bad_capture,capture_errors')
+
+    def test_recently_changed_visits_wait(self):
+        self.assertEqual(pack.pack_crawl(self.crawl_dir, 'xz', workers=1,
+                                         min_age=60), (0, 0, 0))
+
+    def test_checksum_mismatch(self):
+        pack.pack_crawl(self.crawl_dir, 'xz', workers=1, min_age=0, keep=True)
+        manifest = join(self.crawl_dir, cm.PACK_DIRNAME, cm.PACK_MANIFEST)
+        with open(manifest) as f:
+            text = f.read()
+        entry = pack.read_manifest(self.crawl_dir)['0_1_0']
+        with open(manifest, 'w') as f:
+            f.write(text.replace(entry['files']['dump.log']['sha256'], '0' * 64))
+        self.assertRaises(IOError, pack.read_visit, self.crawl_dir, '0_1_0')
+        self.assertTrue(isdir(join(self.crawl_dir, '0_1_0')))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,114 @@
+import json
+import shutil
+import subprocess
+import unittest
+
+from selenium.common.exceptions import JavascriptException
+
+from tbcrawler.pages import CLASSIFY_PAGE_JS, classify_page
+
+
+class FakeDriver(object):
+    def __init__(self, result):
+        self.result = result
+        self.scripts = []
+
+    def execute_script(self, script):
+        self.scripts.append(script)
+        if isinstance(self.result, Exception):
+            raise self.result
+        return self.result
+
+
+# runs the script in node against a stub of the page: the selectors that
+# match, the title, the URL and the text
+NODE_RUNNER = """
+var page = JSON.parse(process.argv[2]);
+var url = new URL(page.url || 'https://www.youtube.com/watch?v=1');
+global.location = {pathname: url.pathname, hostname: url.hostname};
+global.document = {
+  title: page.title || '', documentURI: page.uri || url.href,
+  body: {innerText: page.text || ''},
+  querySelector: function (selectors) {
+    return selectors.split(',').some(function (selector) {
+      return (page.elements || []).indexOf(selector.trim()) !== -1;
+    }) ? {} : null;
+  }
+};
+console.log(JSON.stringify(new Function(process.argv[1])()));
+"""
+
+
+def run_classifier(**page):
+    output = subprocess.check_output(
+        ['node', '-e', NODE_RUNNER, CLASSIFY_PAGE_JS, json.dumps(page)])
+    result = json.loads(output)
+    return result['class'], result['signature']
+
+
+class ClassifyPageTest(unittest.TestCase):
+    def test_single_script(self):
+        driver = FakeDriver({'class': 'blocked', 'signature': 'google_sorry'})
+        page = classify_page(driver)
+        self.assertEqual(driver.scripts, [CLASSIFY_PAGE_JS])
+        self.assertEqual((page['class'], page['signature']),
+                         ('blocked', 'google_sorry'))
+        self.assertLess(page['latency'], 1)
+
+    def test_unknown_on_failure(self):
+        for result in (JavascriptException(), None):
+            page = classify_page(FakeDriver(result))
+            self.assertEqual((page['class'], page['signature']),
+                             ('unknown', None))
+
+
+@unittest.skipIf(shutil.which('node') is None, "node is not installed")
+class ClassifyPageScriptTest(unittest.TestCase):
+    def test_classes(self):
+        self.assertEqual(run_classifier(
+            url='https://www.google.com/sorry/index?continue=x'),
+            ('blocked', 'google_sorry'))
+        self.assertEqual(run_classifier(
+            text='Our systems have detected unusual traffic from your '
+                 'computer network.'), ('blocked', 'unusual_traffic'))
+        self.assertEqual(run_classifier(title='Access Denied'),
+                         ('blocked', 'access_denied'))
+        self.assertEqual(run_classifier(elements=['.g-recaptcha']),
+                         ('captcha', 'recaptcha'))
+        self.assertEqual(run_classifier(title='Just a moment...'),
+                         ('captcha', 'cloudflare'))
+        self.assertEqual(run_classifier(uri='about:neterror?e=netTimeout'),
+                         ('error', 'network_error'))
+        self.assertEqual(run_classifier(title='Page not found'),
+                         ('error', 'not_found'))
+        self.assertEqual(run_classifier(url='https://consent.youtube.com/m'),
+                         ('consent', 'youtube_consent'))
+        self.assertEqual(run_classifier(elements=['#onetrust-banner-sdk']),
+                         ('consent', 'onetrust'))
+        self.assertEqual(run_classifier(elements=['video']),
+                         ('player', 'video'))
+        self.assertEqual(run_classifier(), ('unknown', None))
+
+    def test_signature_order(self):
+        # cookie walls say that content is not available without cookies
+        self.assertEqual(run_classifier(
+            elements=['[data-cookiebanner]'],
+            text="Some content isn't available unless you allow cookies."),
+            ('consent', 'facebook_cookies'))
+        # a block or captcha is reported before the consent banner on it
+        self.assertEqual(run_classifier(
+            elements=['#onetrust-banner-sdk', '.g-recaptcha']),
+            ('captcha', 'recaptcha'))
+        # an unavailable YouTube video shows the player's error
+        self.assertEqual(run_classifier(
+            elements=['#movie_player', '.ytp-error',
+                      'ytd-consent-bump-v2-lightbox']),
+            ('error', 'youtube_unavailable'))
+        # a video page's text, e.g. its comments, is not matched
+        self.assertEqual(run_classifier(
+            elements=['video'], text='detected unusual traffic'),
+            ('player', 'video'))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,236 @@
+import argparse
+import configparser
+import multiprocessing
+import unittest
+
+import tbcrawler.common as cm
+from tbcrawler import crawler as crawler_mod, parallel, pytbcrawler
+from tbcrawler.crawler import CrawlJob, VideoCrawler
+from tbcrawler.parallel import ParallelCrawler, WorkerNetwork
+
+NUM_WORKERS = 3
+
+
+class FakeNetwork(object):
+    """Records the calls in the parent; `enter` runs in the workers."""
+
+    def __init__(self, worker_id):
+        self.worker_id = worker_id
+        self.guest_if = 'guest%d' % worker_id
+        self.calls = []
+
+    def setup(self):
+        self.calls.append('setup')
+
+    def teardown(self):
+        self.calls.append('teardown')
+
+    def enter(self):
+        pass
+
+
+class FakeCrawler(object):
+    """Sends the units that a worker crawled back to the test."""
+
+    def __init__(self, worker_id, device, results):
+        self.worker_id = worker_id
+        self.device = device
+        self.results = results
+
+    def crawl_units(self, job, batch, units):
+        self.results.put((self.worker_id, self.device, batch, list(units)))
+
+
+class FakeJournal(object):
+    def __init__(self, done):
+        self.done = done
+
+    def succeeded(self, batch, site, visit, url):
+        return (batch, site, visit) in self.done
+
+
+class ParallelCrawlerTest(unittest.TestCase):
+    def setUp(self):
+        self.xvfb = parallel.start_xvfb, parallel.stop_xvfb
+        parallel.start_xvfb = lambda width, height: None
+        parallel.stop_xvfb = lambda display: None
+        self.results = multiprocessing.get_context('fork').Queue()
+
+    def tearDown(self):
+        parallel.start_xvfb, parallel.stop_xvfb = self.xvfb
+
+    def crawl(self, urls, batches=2, visits=2, done=()):
+        def make_crawler(worker_id, device):
+            return FakeCrawler(worker_id, device, self.results)
+        config = {'visits': visits, 'batches': batches,
+                  'pause_between_batches': 0, 'pause_between_videos': 0,
+                  'pause_between_loads': 0}
+        job = CrawlJob(config, urls, 1, FakeJournal(set(done)))
+        crawler = ParallelCrawler(NUM_WORKERS, make_crawler, 'eth0', (800, 600))
+        crawler.networks = [FakeNetwork(worker_id)
+                            for worker_id in range(NUM_WORKERS)]
+        crawler.crawl(job)
+        # every worker reports once per batch, after its sentinel
+        results = [self.results.get(timeout=5)
+                   for _ in range(NUM_WORKERS * batches)]
+        return crawler, results
+
+    def test_units_crawled_once(self):
+        urls = [('https://www.youtube.com/watch?v=%d' % i, 60)
+                for i in range(4)]
+        crawler, results = self.crawl(urls, done=[(1, 0, 1), (0, 2, 0)])
+        for batch in range(2):
+            units = [unit for _, _, unit_batch, worker_units in results
+                     if unit_batch == batch for unit in worker_units]
+            expected = [(site, visit) for site in range(4)
+                        for visit in range(2)]
+            expected.remove((0, 1) if batch == 1 else (2, 0))
+            self.assertEqual(sorted(units), expected)
+        self.assertEqual(sorted((worker_id, device) for worker_id, device, _, _
+                                in results),
+                         sorted([(i, 'guest%d' % i)
+                                 for i in range(NUM_WORKERS)] * 2))
+
+    def test_units_in_site_order(self):
+        urls = [('https://vimeo.com/%d' % i, 60) for i in range(6)]
+        _, results = self.crawl(urls, batches=1, visits=3)
+        for _, _, _, units in results:
+            self.assertEqual(units, sorted(units))
+
+    def test_malformed_entries_and_more_workers_than_units(self):
+        urls = [None, ('https://vimeo.com/1', 60)]
+        crawler, results = self.crawl(urls, batches=1, visits=1)
+        self.assertEqual([units for _, _, _, units in results if units],
+                         [[(1, 0)]])
+        for network in crawler.networks:
+            self.assertEqual(network.calls, ['teardown', 'setup', 'teardown'])
+
+
+class UnitsCrawler(VideoCrawler):
+    """Records the visits and pauses of the units of a worker."""
+
+    def __init__(self):
+        super(UnitsCrawler, self).__init__(None, None, screenshots=False)
+        self.events = []
+
+    def _do_load(self):
+        self.events.append((self.job.site, self.job.visit))
+        return True
+
+
+class DoUnitsTest(unittest.TestCase):
+    def setUp(self):
+        self.sleep = crawler_mod.sleep
+        crawler_mod.sleep = self.record_sleep
+        self.crawler = UnitsCrawler()
+
+    def tearDown(self):
+        crawler_mod.sleep = self.sleep
+
+    def record_sleep(self, seconds):
+        self.crawler.events.append(seconds)
+
+    def test_pause_between_videos(self):
+        config = {'visits': 2, 'batches': 1, 'pause_between_batches': 0,
+                  'pause_between_videos': 5, 'pause_between_loads': 1}
+        urls = [('https://vimeo.com/%d' % i, 60) for i in range(3)]
+        self.crawler.job = CrawlJob(config, urls, 1)
+        self.crawler._do_units(iter([(0, 1), (2, 0), (2, 1)]))
+        self.assertEqual(self.crawler.events,
+                         [(0, 1), 1., 5., (2, 0), 1., (2, 1), 1.])
+
+
+class FakeSubprocess(object):
+    DEVNULL = None
+
+    def __init__(self):
+        self.commands = []
+
+    def check_call(self, command):
+        self.commands.append(command)
+
+    def call(self, command, stderr=None):
+        self.commands.append(command)
+
+
+class WorkerNetworkTest(unittest.TestCase):
+    def setUp(self):
+        self.subprocess = parallel.subprocess
+        parallel.subprocess = FakeSubprocess()
+
+    def tearDown(self):
+        parallel.subprocess = self.subprocess
+
+    def test_addresses(self):
+        network = WorkerNetwork(2, 'eth0')
+        self.assertEqual(network.name, cm.WORKER_NETNS_PREFIX + '2')
+        self.assertEqual((network.host_ip, network.guest_ip, network.subnet),
+                         ('10.200.2.1', '10.200.2.2', '10.200.2.0/30'))
+        self.assertNotEqual(network.host_if, WorkerNetwork(3, 'eth0').host_if)
+
+    def test_teardown_removes_the_rules_of_setup(self):
+        network = WorkerNetwork(0, 'eth0')
+        network.setup()
+        added = [command for command in parallel.subprocess.commands
+                 if command[0] == 'iptables']
+        parallel.subprocess.commands = []
+        network.teardown()
+        removed = [command for command in parallel.subprocess.commands
+                   if command[0] == 'iptables']
+        self.assertEqual(len(added), 3)
+        self.assertEqual([command[command.index('-D'):][1:]
+                          for command in removed],
+                         [command[command.index('-A'):][1:]
+                          for command in added])
+        self.assertEqual(parallel.subprocess.commands[-1],
+                         ['ip', 'netns', 'del', network.name])
+
+
+class FakeController(object):
+    def __init__(self, tbb_path, torrc_dict=None, pollute=True, standby=False):
+        self.torrc_dict = torrc_dict
+        self.pollute = pollute
+
+
+class BuildCrawlerTest(unittest.TestCase):
+    def setUp(self):
+        self.controller_class = pytbcrawler.TorController
+        pytbcrawler.TorController = FakeController
+        self.config = configparser.RawConfigParser()
+        self.config.read_string('[default]\n'
+                                'torrc ControlPort=9051\n'
+                                'torrc SocksPort=9050\n'
+                                'ffpref browser.startup.page=0\n')
+        self.args = argparse.Namespace(
+            without_tor=False, config='default', workers=3, standby_tor=False,
+            pipeline=False, reuse_browser=False, screenshots=False,
+            device='eth0', end_visit_on=[], capture='tcpdump',
+            batch_capture=None, periodic_screenshots=False,
+            filter_guards=False, block_retries=0)
+
+    def tearDown(self):
+        pytbcrawler.TorController = self.controller_class
+
+    def test_worker_port_offsets(self):
+        ports = []
+        for worker_id in range(3):
+            crawler = pytbcrawler.build_crawler(self.args, self.config,
+                                                worker_id, 'guest%d' % worker_id)
+            self.assertIsInstance(crawler, VideoCrawler)
+            self.assertEqual(crawler.device, 'guest%d' % worker_id)
+            self.assertTrue(crawler.controller.pollute)
+            torrc = crawler.controller.torrc_dict
+            browser = crawler.driver.kwargs
+            self.assertEqual((browser['socks_port'], browser['control_port']),
+                             (int(torrc['socksport']),
+                              int(torrc['controlport'])))
+            ports.append((browser['socks_port'], browser['control_port']))
+        offset = cm.WORKER_PORT_OFFSET
+        self.assertEqual(ports, [(9050, 9051), (9050 + offset, 9051 + offset),
+                                 (9050 + 2 * offset, 9051 + 2 * offset)])
+        # the offsets do not change the configuration of the next worker
+        self.assertEqual(self.config.get('default', 'torrc socksport'), '9050')
+
+
+if __name__ == "__main__":
+    unittest.main()
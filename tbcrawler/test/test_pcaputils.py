@@ -0,0 +1,68 @@
+import filecmp
+import os
+import tempfile
+import unittest
+from os.path import isfile, join
+from shutil import rmtree, copyfile
+
+from scapy.all import Ether, IP, IPv6, TCP, UDP, rdpcap, wrpcap
+
+from tbcrawler import pcaputils
+
+GUARD = '171.25.193.9'
+GUARD6 = '2001:67c:289c::9'
+OTHER = '10.0.0.1'
+LOCAL = '192.168.1.10'
+
+
+class FilterPcapTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.pcap = join(self.tempdir, 'capture.pcap')
+        self.packets = [Ether() / IP(src=LOCAL, dst=GUARD) / TCP(),
+                        Ether() / IP(src=GUARD, dst=LOCAL) / UDP(),
+                        Ether() / IP(src=OTHER, dst=LOCAL) / TCP(),
+                        Ether() / IPv6(src='fe80::1', dst=GUARD6) / TCP(),
+                        Ether() / IP(src=GUARD, dst=LOCAL) / TCP()]
+        wrpcap(self.pcap, self.packets)
+        self.unfiltered = join(self.tempdir, 'unfiltered.pcap')
+        copyfile(self.pcap, self.unfiltered)
+
+    def tearDown(self):
+        rmtree(self.tempdir)
+
+    def test_records(self):
+        with open(self.pcap, 'rb') as f:
+            records = pcaputils.PcapRecords(f)
+            self.assertEqual(records.linktype, pcaputils.LINKTYPE_ETHERNET)
+            self.assertEqual(len(list(records)), len(self.packets))
+            self.assertFalse(records.truncated)
+
+    def test_truncated_capture(self):
+        with open(self.pcap, 'ab') as f:
+            f.write(b'\x00' * 10)
+        with open(self.pcap, 'rb') as f:
+            records = pcaputils.PcapRecords(f)
+            self.assertEqual(len(list(records)), len(self.packets))
+            self.assertTrue(records.truncated)
+
+    def test_filter_tcp(self):
+        kept, total = pcaputils.filter_pcap(self.pcap, [GUARD, GUARD6])
+        self.assertEqual((kept, total), (3, 5))
+        filtered = rdpcap(self.pcap)
+        self.assertEqual([bytes(p) for p in filtered],
+                         [bytes(self.packets[i]) for i in (0, 3, 4)])
+        self.assertTrue(filecmp.cmp(self.pcap + '.original', self.unfiltered,
+                                    shallow=False))
+
+    def test_filter_udp_without_original(self):
+        kept, _ = pcaputils.filter_pcap(self.pcap, [GUARD],
+                                        protocols=(pcaputils.PROTO_UDP,),
+                                        keep_original=False)
+        self.assertEqual(kept, 1)
+        self.assertFalse(isfile(self.pcap + '.original'))
+        self.assertEqual(len(os.listdir(self.tempdir)), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
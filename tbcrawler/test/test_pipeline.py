@@ -0,0 +1,123 @@
+import threading
+import unittest
+from time import sleep, time
+
+from tbcrawler.crawler import CrawlJob, Visit
+from tbcrawler.pipeline import PipelinedCrawler
+from tbcrawler.retries import BlockRetrier
+
+SETUP = TEARDOWN = 0.1
+CAPTURE = 0.05
+
+
+class TimedCrawler(PipelinedCrawler):
+    """Runs stages that only sleep and record when they ran."""
+
+    def __init__(self, blocked=()):
+        super(TimedCrawler, self).__init__(['browser0', 'browser1'], None,
+                                           screenshots=False,
+                                           retrier=BlockRetrier(backoff=0))
+        self.blocked = list(blocked)  # (site, visit, attempt) to block
+        self.stages = []
+        self.lock = threading.Lock()
+
+    def _record(self, stage, visit, start):
+        with self.lock:
+            self.stages.append((stage, visit.job.site, visit.job.visit,
+                                visit.driver, start, time()))
+
+    def _setup_load(self, job, driver):
+        start = time()
+        visit = Visit(job, driver)
+        sleep(SETUP)
+        self._record('setup', visit, start)
+        return visit
+
+    def _capture_load(self, visit):
+        start = time()
+        sleep(CAPTURE)
+        job = visit.job
+        if (job.site, job.visit, job.attempt) in self.blocked:
+            visit.meta['blocked'] = True
+        else:
+            visit.successful = True
+        self._record('capture', visit, start)
+
+    def _teardown_load(self, visit, exc_info=(None, None, None)):
+        start = time()
+        sleep(TEARDOWN)
+        self._record('teardown', visit, start)
+
+    def _recycle_browsers(self):
+        pass
+
+    def windows(self, stage):
+        return [record[3:] for record in self.stages if record[0] == stage]
+
+
+def make_job(pause=0, site_pause=0):
+    config = {'visits': 2, 'batches': 1, 'pause_between_batches': 0,
+              'pause_between_videos': site_pause, 'pause_between_loads': pause}
+    urls = [('https://www.youtube.com/watch?v=%d' % i, 60) for i in range(2)]
+    return CrawlJob(config, urls, 1)
+
+
+class PipelinedCrawlerTest(unittest.TestCase):
+    def crawl(self, pause=0, blocked=()):
+        crawler = TimedCrawler(blocked)
+        crawler.job = make_job(pause)
+        crawler._do_sites()
+        return crawler
+
+    def test_stages_overlap(self):
+        crawler = self.crawl()
+        captures = crawler.windows('capture')
+        setups = crawler.windows('setup')
+        teardowns = crawler.windows('teardown')
+        self.assertEqual(len(captures), 4)
+        self.assertEqual([driver for driver, _, _ in captures],
+                         ['browser0', 'browser1'] * 2)
+        for i in range(1, 4):
+            # never captured with another stage or capture running
+            self.assertGreaterEqual(setups[i][1], captures[i - 1][2])
+            self.assertGreaterEqual(captures[i][1], teardowns[i - 1][2])
+            # the setup of the next visit runs during the teardown
+            self.assertLess(setups[i][1], teardowns[i - 1][2])
+        self.assertGreater(crawler.idle_removed, 3 * SETUP * 0.5)
+
+    def test_pause(self):
+        crawler = self.crawl(pause=0.3)
+        captures = crawler.windows('capture')
+        for previous, current in zip(captures, captures[1:]):
+            self.assertGreaterEqual(current[1] - previous[2], 0.3)
+        # setup and teardown overlap the pause
+        self.assertGreater(crawler.idle_removed, 3 * (SETUP + TEARDOWN) * 0.5)
+
+    def test_pause_between_videos_in_units(self):
+        crawler = TimedCrawler()
+        crawler.job = make_job(site_pause=0.3)
+        crawler._do_units(iter([(0, 0), (0, 1), (1, 1)]))
+        captures = crawler.windows('capture')
+        self.assertLess(captures[1][1] - captures[0][2], 0.3)
+        self.assertGreaterEqual(captures[2][1] - captures[1][2], 0.3)
+
+    def test_retry_blocked(self):
+        crawler = self.crawl(blocked=[(0, 1, 0), (1, 0, 0), (1, 0, 1),
+                                      (1, 0, 2)])
+        captures = [record[1:4] for record in crawler.stages
+                    if record[0] == 'capture']
+        self.assertEqual(captures, [(0, 0, 'browser0'), (0, 1, 'browser1'),
+                                    (0, 1, 'browser0'), (1, 0, 'browser1'),
+                                    (1, 0, 'browser0'), (1, 0, 'browser1'),
+                                    (1, 1, 'browser0')])
+
+    def test_executor_shutdown(self):
+        crawler = TimedCrawler()
+        crawler.crawl(make_job())
+        self.assertEqual(len(crawler.windows('capture')), 4)
+        with self.assertRaises(RuntimeError):
+            crawler.executor.submit(sleep, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
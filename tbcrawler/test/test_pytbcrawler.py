@@ -0,0 +1,132 @@
+import argparse
+import contextlib
+import tempfile
+import unittest
+from os.path import join
+from shutil import rmtree
+
+import tbcrawler.common as cm
+from tbcrawler import pytbcrawler
+from tbcrawler.pytbcrawler import BrowserWrapper
+
+
+class FakeDriver(object):
+    launched = 0
+
+    def __init__(self, *args, **kwargs):
+        FakeDriver.launched += 1
+        self.quitted = False
+        self.window_handles = ['main']
+        self.switch_to = self
+        self.CONTEXT_CHROME = 'chrome'
+
+    def window(self, handle):
+        pass
+
+    def get(self, url):
+        self.url = url
+
+    def context(self, context):
+        return contextlib.nullcontext()
+
+    def execute_async_script(self, script):
+        pass
+
+    def quit(self):
+        self.quitted = True
+
+
+class FakeWrapper(BrowserWrapper):
+    driver_class = FakeDriver
+
+
+class BrowserWrapperTest(unittest.TestCase):
+    def setUp(self):
+        FakeDriver.launched = 0
+        self.wrapper = FakeWrapper()
+
+    def test_relaunch_without_reuse(self):
+        for _ in range(3):
+            with self.wrapper.launch() as driver:
+                pass
+            self.assertTrue(driver.quitted)
+        self.assertEqual(FakeDriver.launched, 3)
+
+    def test_reuse_and_recycle_after(self):
+        self.wrapper.enable_reuse(recycle_after=2)
+        drivers = []
+        for _ in range(3):
+            with self.wrapper.launch() as driver:
+                drivers.append(driver)
+        self.assertIs(drivers[0], drivers[1])
+        self.assertEqual(drivers[1].url, 'about:blank')
+        self.assertIsNot(drivers[1], drivers[2])
+        self.assertTrue(drivers[0].quitted)
+        self.assertFalse(drivers[2].quitted)
+
+    def test_recycle_on_error(self):
+        self.wrapper.enable_reuse()
+        with self.wrapper.launch() as driver:
+            self.wrapper.recycle()
+        self.assertTrue(driver.quitted)
+        with self.assertRaises(ValueError):
+            with self.wrapper.launch() as driver:
+                raise ValueError()
+        self.assertTrue(driver.quitted)
+        self.assertEqual(FakeDriver.launched, 2)
+
+    def test_recycle_when_idle_quits(self):
+        self.wrapper.enable_reuse()
+        with self.wrapper.launch() as driver:
+            pass
+        self.assertFalse(driver.quitted)
+        self.wrapper.recycle()
+        self.assertTrue(driver.quitted)
+
+
+class ResumeTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        # set_crawl_dir also moves the logs into the crawl directory
+        self.paths = (cm.RESULTS_DIR, cm.CRAWL_DIR, cm.LOGS_DIR,
+                      cm.DEFAULT_CRAWL_LOG, cm.DEFAULT_TOR_LOG,
+                      cm.DEFAULT_FF_LOG)
+        cm.RESULTS_DIR = self.tempdir
+        pytbcrawler.set_crawl_dir(join(self.tempdir, 'crawl'))
+        self.url_file = join(self.tempdir, 'videos.txt')
+        self.write_urls('https://vimeo.com/1,60\n')
+
+    def tearDown(self):
+        (cm.RESULTS_DIR, cm.CRAWL_DIR, cm.LOGS_DIR, cm.DEFAULT_CRAWL_LOG,
+         cm.DEFAULT_TOR_LOG, cm.DEFAULT_FF_LOG) = self.paths
+        rmtree(self.tempdir)
+
+    def write_urls(self, text):
+        with open(self.url_file, 'w') as f:
+            f.write(text)
+
+    def start(self, resume, start=1, stop=10):
+        args = argparse.Namespace(url_file=self.url_file, start=start,
+                                  stop=stop, resume=resume)
+        pytbcrawler.build_crawl_dirs(self.url_file, resume)
+        return pytbcrawler.open_journal(args)
+
+    def test_resume_with_same_arguments(self):
+        self.start(False)
+        journal = self.start(True)
+        self.assertEqual(journal.parameters()['stop'], 10)
+
+    def test_mismatched_resume(self):
+        self.start(False)
+        with self.assertRaises(SystemExit):
+            self.start(True, stop=20)
+        self.write_urls('https://vimeo.com/2,60\n')
+        with self.assertRaises(SystemExit):
+            self.start(True)
+        # the copy of the url file the crawl was started with is kept
+        with open(join(cm.LOGS_DIR, 'videos.txt')) as f:
+            self.assertEqual(f.read(), 'https://vimeo.com/1,60\n')
+
+
+if __name__ == "__main__":
+    unittest.main()
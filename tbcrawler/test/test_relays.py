@@ -0,0 +1,79 @@
+import unittest
+from collections import namedtuple
+
+from stem.control import EventType
+
+from tbcrawler.relays import (RelayIndex, bridge_addresses,
+                              entry_guard_fingerprints)
+
+Status = namedtuple('Status', ['fingerprint', 'nickname', 'address', 'or_port',
+                               'or_addresses', 'flags', 'bandwidth'])
+Event = namedtuple('Event', ['desc'])
+
+GUARD = Status('A' * 40, 'guard', '171.25.193.9', 443,
+               [('171.25.193.9', 443, False), ('2001:67c:289c::9', 443, True)],
+               ['Fast', 'Guard', 'Running'], 5000)
+MIDDLE = Status('B' * 40, 'middle', '10.1.2.3', 9001, [], ['Fast', 'Running'], 100)
+
+
+class FakeController(object):
+    def __init__(self, statuses):
+        self.statuses = statuses
+        self.listeners = {}
+        self.calls = 0
+
+    def add_event_listener(self, listener, event_type):
+        self.listeners[event_type] = listener
+
+    def get_network_statuses(self):
+        self.calls += 1
+        return iter(self.statuses)
+
+
+class RelayIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.controller = FakeController([GUARD, MIDDLE])
+        self.index = RelayIndex()
+        self.index.attach(self.controller)
+
+    def test_lookup(self):
+        relay = self.index.get('A' * 40)
+        self.assertEqual(relay.address, '171.25.193.9')
+        self.assertEqual(relay.addresses, ('171.25.193.9', '2001:67c:289c::9'))
+        self.assertIn('Guard', relay.flags)
+        self.assertEqual(relay.bandwidth, 5000)
+        self.assertIsNone(self.index.get('C' * 40))
+
+    def test_guards(self):
+        self.assertEqual(self.index.guards(),
+                         {'171.25.193.9', '2001:67c:289c::9'})
+        self.index.guards()
+        self.assertEqual(self.controller.calls, 1)
+
+    def test_new_consensus(self):
+        self.index.guards()
+        promoted = MIDDLE._replace(flags=['Guard', 'Running'])
+        self.controller.listeners[EventType.NEWCONSENSUS](Event([promoted]))
+        self.assertEqual(self.index.guards(), {'10.1.2.3'})
+        self.assertIsNone(self.index.get('A' * 40))
+        self.assertEqual(self.controller.calls, 1)
+
+
+class EntryAddressesTest(unittest.TestCase):
+    def test_entry_guards(self):
+        self.assertEqual(entry_guard_fingerprints(
+            '$%s~guard up\n$%s=middle never-connected\n$%s~gone unusable\n'
+            % ('A' * 40, 'B' * 40, 'C' * 40)), ['A' * 40, 'B' * 40])
+        self.assertEqual(entry_guard_fingerprints(''), [])
+
+    def test_bridges(self):
+        self.assertEqual(bridge_addresses([
+            'obfs4 192.0.2.1:443 %s cert=abc iat-mode=0' % ('A' * 40),
+            '[2001:db8::1]:9001 %s' % ('B' * 40)]),
+            ['192.0.2.1', '2001:db8::1'])
+        self.assertIsNone(bridge_addresses([
+            'snowflake 192.0.2.3:80 %s url=https://example.org/' % ('C' * 40)]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+import os
+import tempfile
+import unittest
+from shutil import rmtree
+
+import tbcrawler.common as cm
+from tbcrawler import metrics
+from tbcrawler.crawler import CrawlJob, Visit
+from tbcrawler.retries import BlockRetrier, ExitStats
+
+YOUTUBE = 'https://www.youtube.com/watch?v=abc'
+EXIT1 = 'A' * 40
+EXIT2 = 'B' * 40
+
+
+class FakeController(object):
+    def __init__(self):
+        self.excluded = None
+        self.newnyms = 0
+
+    def exclude_exits(self, fingerprints):
+        self.excluded = fingerprints
+
+    def new_identity(self):
+        self.newnyms += 1
+
+
+def make_visit(attempt=0, blocked=False, exit=EXIT1):
+    config = {'visits': 1, 'batches': 1}
+    job = CrawlJob(config, [(YOUTUBE, 60)], 1)
+    job.attempt = attempt
+    visit = Visit(job, None)
+    visit.meta['tor_events'] = {'exit': exit}
+    if blocked:
+        visit.meta['blocked'] = True
+    else:
+        visit.successful = True
+    return visit
+
+
+class ExitStatsTest(unittest.TestCase):
+    def test_blocked_exits(self):
+        stats = ExitStats()
+        stats.add('youtube', EXIT1, False, True)
+        self.assertEqual(stats.blocked_exits('youtube'), [])  # one visit
+        stats.add('youtube', EXIT1, True, False)
+        stats.add('youtube', EXIT2, True, False)
+        stats.add('youtube', EXIT2, False, True)
+        stats.add('youtube', EXIT2, True, False)
+        self.assertEqual(stats.blocked_exits('youtube'), [EXIT1])
+        self.assertEqual(stats.blocked_exits('vimeo'), [])
+        self.assertEqual(stats.success_rate('youtube'), 0.6)
+        self.assertEqual(stats.success_rate('youtube', EXIT1), 0.5)
+        self.assertIsNone(stats.success_rate('vimeo'))
+
+
+class BlockRetrierTest(unittest.TestCase):
+    def setUp(self):
+        self.crawl_dir = cm.CRAWL_DIR
+        cm.CRAWL_DIR = tempfile.mkdtemp()
+        self.controller = FakeController()
+        self.retrier = BlockRetrier(self.controller, retries=2, backoff=10)
+
+    def tearDown(self):
+        rmtree(cm.CRAWL_DIR)
+        cm.CRAWL_DIR = self.crawl_dir
+
+    def test_retry_delay(self):
+        self.assertIsNone(self.retrier.retry_delay(make_visit()))
+        self.assertEqual(self.retrier.retry_delay(make_visit(0, True)), 10)
+        self.assertEqual(self.retrier.retry_delay(make_visit(1, True)), 20)
+        self.assertIsNone(self.retrier.retry_delay(make_visit(2, True)))
+
+    def test_excludes_blocked_exits(self):
+        for _ in range(2):
+            self.retrier.record(make_visit(blocked=True))
+        self.retrier.record(make_visit(exit=EXIT2))
+        self.retrier.prepare(YOUTUBE)
+        self.assertEqual(self.controller.excluded, [EXIT1])
+        self.retrier.prepare('https://vimeo.com/1')
+        self.assertEqual(self.controller.excluded, [])
+
+    def test_loads_visit_records(self):
+        for _ in range(2):
+            metrics.write_record(os.path.join(cm.CRAWL_DIR, cm.VISITS_FILENAME),
+                                 {'platform': 'youtube', 'exit': EXIT2,
+                                  'outcome': 'failed', 'blocked': True})
+        self.retrier.prepare(YOUTUBE)
+        self.assertEqual(self.controller.excluded, [EXIT2])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,157 @@
+import json
+import os
+import sqlite3
+import struct
+import tempfile
+import unittest
+from os.path import isdir, join
+from shutil import rmtree
+from time import time
+
+import tbcrawler.common as cm
+from tbcrawler import pcaputils as pu
+from tbcrawler import pack, sanity
+from tbcrawler.journal import CrawlJournal, SUCCESS, REQUEUED
+
+TEST_URL = 'https://vimeo.com/641878345'
+
+
+def pcap(times, size=60):
+    data = struct.pack('<IHHiIII', pu.PCAP_MAGIC_USEC, 2, 4, 0, 0, 71, 1)
+    for ts in times:
+        sec = int(ts)
+        data += struct.pack('<IIII', sec, int(round((ts - sec) * 1e6)),
+                            size, size + 1000) + b'\x00' * size
+    return data
+
+
+class SanityTest(unittest.TestCase):
+    def setUp(self):
+        self.crawl_dir = tempfile.mkdtemp()
+        self.journal = CrawlJournal(join(self.crawl_dir, cm.JOURNAL_FILENAME))
+
+    def tearDown(self):
+        rmtree(self.crawl_dir)
+
+    def add_visit(self, site, capture, playback_time=100., dump_log='',
+                  screenshots=2, expected=None, end_reason='deadline',
+                  **meta_fields):
+        name = '0_%d_0' % site
+        visit_dir = join(self.crawl_dir, name)
+        os.makedirs(visit_dir)
+        with open(join(visit_dir, 'capture.pcap'), 'wb') as f:
+            f.write(capture)
+        with open(join(visit_dir, 'dump.log'), 'w') as f:
+            f.write(dump_log)
+        for i in range(screenshots):
+            open(join(visit_dir, 'screenshot_%d.png' % i), 'wb').close()
+        meta = {'url': TEST_URL, 'batch': 0, 'site': site, 'visit': 0,
+                'termination': {'playback_time': playback_time,
+                                'reason': end_reason}}
+        if expected is not None:
+            meta['playback_time'] = expected
+        meta.update(meta_fields)
+        with open(join(visit_dir, 'visit.json'), 'w') as f:
+            json.dump(meta, f)
+        self.journal.record(0, site, 0, TEST_URL, SUCCESS, time(), visit_dir)
+        return visit_dir
+
+    def test_good_visit(self):
+        visit_dir = self.add_visit(0, pcap([1000 + i for i in range(101)]),
+                                   dump_log='tcpdump: listening on eth0\n'
+                                            '101 packets captured\n'
+                                            '0 packets dropped by kernel\n')
+        row = sanity.check_visit(visit_dir, expect_screenshots=True)
+        self.assertEqual(row['flags'], '')
+        self.assertEqual(row['packets'], 101)
+        self.assertEqual(row['bytes'], 101 * 1060)
+        self.assertAlmostEqual(row['capture_duration'], 100.)
+
+    def test_anomalies(self):
+        short = self.add_visit(0, pcap([1000, 1010]), screenshots=1)
+        truncated = self.add_visit(1, pcap([1000, 1100])[:-10])
+        empty = self.add_visit(2, b'')
+        failed = self.add_visit(3, pcap([1000, 1100]),
+                                dump_log="tcpdump: eth0: No such device exists\n"
+                                         "3 packets dropped by kernel\n")
+        self.assertEqual(sanity.check_visit(short, True)['flags'],
+                         'short_capture,missing_screenshots')
+        self.assertEqual(sanity.check_visit(truncated)['flags'],
+                         'truncated_capture,short_capture')
+        self.assertEqual(sanity.check_visit(empty)['flags'], 'empty_capture')
+        row = sanity.check_visit(failed)
+        self.assertEqual(row['flags'], 'dropped_packets,capture_errors')
+        self.assertEqual(row['drops'], 3)
+        self.assertEqual(row['log_errors'], 'tcpdump: eth0: No such device exists')
+
+    def test_short_capture_of_expected_playback(self):
+        capture = pcap([1000 + i for i in range(101)])
+        # the visit ended early, but the video list expects 300 s
+        ended_early = self.add_visit(0, capture, playback_time=100.,
+                                     expected=300)
+        capped = self.add_visit(1, capture, playback_time=240.,
+                                expected=cm.MAX_PLAYBACK_TIME + 60)
+        short_video = self.add_visit(2, pcap([1000 + i for i in range(51)]),
+                                     playback_time=50., expected=60)
+        self.assertEqual(sanity.check_visit(ended_early)['flags'],
+                         'short_capture')
+        self.assertEqual(sanity.check_visit(capped)['flags'], 'short_capture')
+        self.assertEqual(sanity.check_visit(short_video)['flags'], '')
+
+    def test_ended_early_on_purpose(self):
+        idle = self.add_visit(0, pcap([1000 + i for i in range(101)]),
+                              playback_time=100., expected=300,
+                              end_reason='network_idle')
+        self.assertEqual(sanity.check_visit(idle)['flags'], '')
+        idle_short = self.add_visit(1, pcap([1000, 1010]), playback_time=100.,
+                                    expected=300, end_reason='network_idle')
+        self.assertEqual(sanity.check_visit(idle_short)['flags'],
+                         'short_capture')
+
+    def test_guards_outside_filter(self):
+        capture = pcap([1000 + i for i in range(101)])
+        moved = self.add_visit(0, capture, capture_hosts=['1.2.3.4'],
+                               guards=['1.2.3.4', '5.6.7.8'])
+        kept = self.add_visit(1, capture, capture_hosts=['1.2.3.4', '5.6.7.8'],
+                              guards=['5.6.7.8'])
+        unfiltered = self.add_visit(2, capture, capture_hosts=None,
+                                    guards=['5.6.7.8'])
+        self.assertEqual(sanity.check_visit(moved)['flags'],
+                         'guards_outside_filter')
+        self.assertEqual(sanity.check_visit(kept)['flags'], '')
+        self.assertEqual(sanity.check_visit(unfiltered)['flags'], '')
+
+    def test_index_and_requeue(self):
+        self.add_visit(0, pcap([1000 + i for i in range(101)]))
+        self.add_visit(1, b'')
+        rows = sanity.check_crawl(self.crawl_dir, workers=2)
+        connection = sqlite3.connect(join(self.crawl_dir, sanity.INDEX_FILENAME))
+        self.assertEqual(connection.execute(
+            "SELECT dir, flags FROM visits WHERE anomalous").fetchall(),
+            [('0_1_0', 'empty_capture')])
+        connection.close()
+
+        self.assertEqual(sanity.requeue(self.crawl_dir, rows), 1)
+        self.assertFalse(isdir(join(self.crawl_dir, '0_1_0')))
+        self.assertTrue(isdir(join(self.crawl_dir, sanity.REQUEUE_DIRNAME, '0_1_0')))
+        self.assertTrue(self.journal.succeeded(0, 0, 0, TEST_URL))
+        self.assertFalse(self.journal.succeeded(0, 1, 0, TEST_URL))
+        self.assertEqual(self.journal.counts(), {SUCCESS: 1, REQUEUED: 1})
+
+    def test_packed_visits(self):
+        self.add_visit(0, pcap([1000 + i for i in range(101)]), screenshots=0)
+        self.add_visit(1, b'')
+        pack.pack_crawl(self.crawl_dir, 'xz', workers=1, min_age=0)
+        self.add_visit(2, pcap([1000 + i for i in range(101)]))
+        rows = sanity.check_crawl(self.crawl_dir, workers=1,
+                                  expect_screenshots=True)
+        self.assertEqual([(row['dir'], row['flags']) for row in rows],
+                         [('0_0_0', 'missing_screenshots'),
+                          ('0_1_0', 'empty_capture'),
+                          ('0_2_0', '')])
+        self.assertEqual(sanity.requeue(self.crawl_dir, rows), 2)
+        self.assertFalse(self.journal.succeeded(0, 1, 0, TEST_URL))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from tbcrawler import screenshots
+from tbcrawler.screenshots import ScreenshotWriter
+
+PNG = b'\x89PNG\r\n\x1a\n fake'
+
+
+class ScreenshotWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_writes_png_unchanged(self):
+        writer = ScreenshotWriter()
+        path = os.path.join(self.tmpdir, 'screenshot_0.png')
+        writer.submit(PNG, path)
+        writer.close()
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), PNG)
+        self.assertEqual(writer.written, 1)
+
+    def test_skips_deleted_visit_dir(self):
+        writer = ScreenshotWriter()
+        writer.submit(PNG, os.path.join(self.tmpdir, 'gone', 'screenshot_0.png'))
+        writer.close()
+        self.assertEqual(writer.written, 0)
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, 'gone')))
+
+    def test_drops_when_queue_stays_full(self):
+        writer = ScreenshotWriter(workers=1, queue_size=1)
+        writer.QUEUE_TIMEOUT = 0.05
+        release = threading.Event()
+        encode = writer.encode
+        writer.encode = lambda png: release.wait() and encode(png)
+        paths = [os.path.join(self.tmpdir, 'screenshot_%d.png' % i)
+                 for i in range(3)]
+        for path in paths:
+            writer.submit(PNG, path)
+        release.set()
+        writer.close()
+        # one is being written, one waits in the queue, one is dropped
+        self.assertEqual(writer.dropped, 1)
+        self.assertEqual(writer.written, 2)
+
+    @unittest.skipIf(screenshots.Image is None, "Pillow is not installed")
+    def test_downscales_and_reencodes(self):
+        import io
+        image = screenshots.Image.new('RGBA', (200, 100))
+        png = io.BytesIO()
+        image.save(png, 'PNG')
+        writer = ScreenshotWriter('jpeg', quality=50, scale=0.5)
+        writer.submit(png.getvalue(), os.path.join(self.tmpdir, 'screenshot_0.png'))
+        writer.close()
+        path = os.path.join(self.tmpdir, 'screenshot_0.jpeg')
+        self.assertEqual(screenshots.Image.open(path).size, (100, 50))
+
+    @unittest.skipIf(screenshots.Image is not None, "Pillow is installed")
+    def test_falls_back_to_png_without_pillow(self):
+        writer = ScreenshotWriter('webp', scale=0.5)
+        self.assertEqual(writer.fmt, 'png')
+        self.assertEqual(writer.path('/visit/screenshot_0.png'),
+                         '/visit/screenshot_0.png')
+        writer.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,114 @@
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import unittest
+from time import sleep, time
+
+from tbcrawler import pcaputils as pu
+from tbcrawler.splitter import FLUSH_GRACE, PcapSplitter, VisitWindow
+
+
+def pcap_header():
+    return struct.pack('<IHHiIII', pu.PCAP_MAGIC_USEC, 2, 4, 0, 0, 71, 1)
+
+
+def pcap_record(ts, payload=b'\x00' * 54):
+    sec = int(ts)
+    return struct.pack('<IIII', sec, int(round((ts - sec) * 1e6)),
+                       len(payload), len(payload)) + payload
+
+
+def read_times(path):
+    with open(path, 'rb') as f:
+        return [sec + usec * 1e-6 for sec, usec, _, _ in pu.PcapRecords(f)]
+
+
+class SplitterTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.batch_pcap = os.path.join(self.tmpdir, 'batch.pcap')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def visit_pcap(self, name):
+        os.mkdir(os.path.join(self.tmpdir, name))
+        return os.path.join(self.tmpdir, name, 'capture.pcap')
+
+    def test_post_split(self):
+        with open(self.batch_pcap, 'wb') as f:
+            f.write(pcap_header())
+            for ts in (5, 10, 12, 15, 18, 20, 22, 30):
+                f.write(pcap_record(ts))
+            f.write(pcap_record(31)[:20])  # killed mid-write
+        splitter = PcapSplitter(self.batch_pcap, live=False)
+        first, second = self.visit_pcap('a'), self.visit_pcap('b')
+        failed = os.path.join(self.tmpdir, 'deleted', 'capture.pcap')
+        for path, start, end in ((first, 10, 15), (failed, 17, 19),
+                                 (second, 21, 25)):
+            window = VisitWindow(path, start)
+            window.end = end
+            splitter.windows.append(window)
+        splitter.finish()
+        self.assertEqual(read_times(first), [10, 12, 15])
+        self.assertEqual(read_times(second), [22])
+        self.assertFalse(os.path.exists(os.path.dirname(failed)))
+        self.assertFalse(os.path.exists(self.batch_pcap))
+
+    def test_live_split(self):
+        splitter = PcapSplitter(self.batch_pcap, live=True)
+        splitter.start()
+        with open(self.batch_pcap, 'wb') as f:
+            f.write(pcap_header())
+            f.write(pcap_record(time()))
+            f.flush()
+            sleep(0.1)
+            window = splitter.begin_visit(self.visit_pcap('a'))
+            for _ in range(3):
+                f.write(pcap_record(time()))
+                f.flush()
+                sleep(0.01)
+            # packets are written to the visit's capture as they arrive
+            sleep(0.2)
+            self.assertEqual(len(read_times(window.pcap_path)), 3)
+            packets = splitter.end_visit(window)
+            f.write(pcap_record(time()))
+        splitter.finish()
+        self.assertEqual(packets, 3)
+        self.assertEqual(len(read_times(window.pcap_path)), 3)
+
+    def test_live_split_late_packets(self):
+        splitter = PcapSplitter(self.batch_pcap, live=True)
+        splitter.start()
+        with open(self.batch_pcap, 'wb') as f:
+            f.write(pcap_header())
+            f.flush()
+            window = splitter.begin_visit(self.visit_pcap('a'))
+            captured = [time() + 0.01 * i for i in range(3)]
+            sleep(0.05)
+
+            def flush_buffer():
+                # captured during the visit, written within the grace
+                sleep(FLUSH_GRACE / 2)
+                for ts in captured:
+                    f.write(pcap_record(ts))
+                f.flush()
+            writer = threading.Thread(target=flush_buffer)
+            writer.start()
+            packets = splitter.end_visit(window)
+            writer.join()
+            # captured during the visit, written after its window closed
+            f.write(pcap_record(window.end - 0.01))
+            f.flush()
+            sleep(0.2)
+        splitter.finish()
+        self.assertEqual(packets, 3)
+        self.assertEqual(read_times(window.pcap_path),
+                         [round(ts, 6) for ts in captured])
+        self.assertEqual(splitter.late, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+import unittest
+
+from selenium.common.exceptions import WebDriverException
+
+from tbcrawler import common as cm
+from tbcrawler import termination as tm
+
+
+class FakeJob(object):
+    playback_time = 100
+
+
+class FakeDriver(object):
+    def __init__(self):
+        self.state = None
+
+    def execute_script(self, script):
+        if self.state is None:
+            raise WebDriverException("no player")
+        return self.state
+
+
+class FakeCrawler(object):
+    def __init__(self):
+        self.job = FakeJob()
+        self.driver = FakeDriver()
+        self.size = 0
+
+    def capture_size(self):
+        return self.size
+
+
+class TerminationTest(unittest.TestCase):
+    def setUp(self):
+        self.crawler = FakeCrawler()
+
+    def test_deadline(self):
+        policy = tm.DeadlinePolicy()
+        policy.start(self.crawler, 1000)
+        end = 1000 + 100 - cm.PLAYBACK_END_MARGIN
+        self.assertIsNone(policy.check(end - 1))
+        self.assertEqual(policy.wait_time(end - 1), 1)
+        self.assertEqual(policy.check(end), 'deadline')
+
+    def test_deadline_is_capped(self):
+        self.crawler.job.playback_time = 3600
+        policy = tm.DeadlinePolicy()
+        policy.start(self.crawler, 0)
+        self.assertEqual(policy.check(cm.MAX_PLAYBACK_TIME), 'deadline')
+
+    def test_player_state(self):
+        policy = tm.PlayerStatePolicy(tail=5)
+        policy.start(self.crawler, 0)
+        self.assertIsNone(policy.check(1))
+        self.crawler.driver.state = [False, 1.0]
+        self.assertIsNone(policy.check(10))
+        self.assertEqual(policy.check(15), 'fully_loaded')
+        self.crawler.driver.state = [True, 1.0]
+        self.assertEqual(policy.check(16), 'player_ended')
+
+    def test_network_idle(self):
+        policy = tm.NetworkIdlePolicy(idle_time=10, min_bytes=1000, min_time=30)
+        policy.start(self.crawler, 0)
+        for now in range(0, 40):
+            self.crawler.size = min(now, 25) * 10000
+            reason = policy.check(now)
+            if reason:
+                break
+        self.assertEqual((reason, now), ('network_idle', 35))
+
+    def test_make_policy(self):
+        self.assertIsInstance(tm.make_policy(), tm.DeadlinePolicy)
+        policy = tm.make_policy(['player', 'idle'])
+        self.assertEqual(policy.name, 'deadline+player+idle')
+        policy.start(self.crawler, 0)
+        self.assertEqual(policy.check(100), 'deadline')
+
+
+if __name__ == "__main__":
+    unittest.main()
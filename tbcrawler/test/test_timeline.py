@@ -0,0 +1,71 @@
+import json
+import os
+import tempfile
+import unittest
+from shutil import rmtree
+
+from stem.control import EventType
+from stem.response import ControlMessage
+
+from tbcrawler.timeline import EVENTS, EventTimeline
+
+GUARD = 'A' * 40
+MIDDLE = 'B' * 40
+
+
+def event(line, arrived_at=1700000000.0):
+    return ControlMessage.from_str('650 %s\r\n' % line, 'EVENT',
+                                   arrived_at=arrived_at)
+
+
+class FakeController(object):
+    def add_event_listener(self, listener, *events):
+        self.listener = listener
+        self.events = events
+
+
+class EventTimelineTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.controller = FakeController()
+        self.timeline = EventTimeline()
+        self.timeline.attach(self.controller)
+
+    def tearDown(self):
+        rmtree(self.tempdir)
+
+    def test_listens_to_events(self):
+        self.assertEqual(set(self.controller.events), set(EVENTS))
+        self.assertIn(EventType.STATUS_CLIENT, self.controller.events)
+
+    def test_records_visit(self):
+        path = os.path.join(self.tempdir, 'tor_events.jsonl')
+        self.controller.listener(event('BW 1 2'))  # before the visit
+        with self.timeline.record(path) as summary:
+            self.controller.listener(event(
+                'CIRC 7 BUILT $%s~guard,$%s~middle PURPOSE=GENERAL'
+                % (GUARD, MIDDLE), 1700000000.1234))
+            self.controller.listener(event('STREAM 18 SUCCEEDED 7 www.youtube.com:443'))
+            self.controller.listener(event('BW 5000 300'))
+            self.controller.listener(event('BW 7000 200'))
+            self.controller.listener(event('CIRC 8 FAILED REASON=TIMEOUT'))
+            self.controller.listener(event('STATUS_CLIENT NOTICE CIRCUIT_ESTABLISHED'))
+        self.controller.listener(event('BW 1 2'))  # after the visit
+
+        with open(path) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual(len(records), 6)
+        self.assertEqual(records[0], {'t': 1700000000.123, 'e': 'circ', 'id': '7',
+                                      'status': 'BUILT', 'purpose': 'GENERAL',
+                                      'path': [GUARD, MIDDLE]})
+        self.assertEqual(records[1]['circ'], '7')
+        self.assertEqual(records[4]['reason'], 'TIMEOUT')
+        self.assertEqual(records[5]['action'], 'CIRCUIT_ESTABLISHED')
+        self.assertEqual(summary, {'circuits_built': 1, 'circuits_failed': 1,
+                                   'streams_succeeded': 1,
+                                   'bytes_read': 12000, 'bytes_written': 500,
+                                   'exit': MIDDLE})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+import os
+import tempfile
+import unittest
+from os.path import isfile, join
+from shutil import rmtree
+
+import numpy as np
+from scapy.all import Ether, Dot1Q, ARP, IP, IPv6, TCP, UDP, Raw, wrpcap
+
+from tbcrawler import traces
+
+LOCAL = '192.168.1.10'
+GUARD = '171.25.193.9'
+GUARD6 = '2001:67c:289c::9'
+
+
+class TracesTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.visit_dir = join(self.tempdir, '0_0_0')
+        self.pcap = join(self.visit_dir, traces.PCAP_FILENAME)
+        packets = [Ether() / IP(src=LOCAL, dst=GUARD) / TCP() / Raw(b'x' * 100),
+                   Ether() / IP(src=GUARD, dst=LOCAL) / TCP() / Raw(b'x' * 1400),
+                   Ether() / Dot1Q(vlan=3) / IP(src=GUARD, dst=LOCAL) / UDP(),
+                   Ether() / ARP(),
+                   Ether() / IPv6(src='fe80::1', dst=GUARD6) / TCP(),
+                   Ether() / IP(src=LOCAL, dst='10.0.0.1') / TCP()]
+        for i, packet in enumerate(packets):
+            packet.time = 1600000000 + i * 0.25
+        os.makedirs(self.visit_dir)
+        wrpcap(self.pcap, packets, snaplen=71)
+
+    def tearDown(self):
+        rmtree(self.tempdir)
+
+    def test_infer_local_address(self):
+        trace = traces.pcap_to_trace(self.pcap)
+        self.assertListEqual(list(trace['direction']), [1, -1, -1, 1])
+        self.assertListEqual(list(trace['size']), [154, 1454, 46, 54])
+        self.assertAlmostEqual(trace['time'][1] - trace['time'][0], 0.25)
+
+    def test_guard_ips(self):
+        trace = traces.pcap_to_trace(self.pcap, guard_ips=[GUARD, GUARD6])
+        self.assertListEqual(list(trace['direction']), [1, -1, -1, 1])
+        self.assertEqual(trace['size'][3], 74)
+
+    def test_convert_crawl(self):
+        self.assertEqual(traces.convert_crawl(self.tempdir, workers=1), (1, 0, 0))
+        trace_path = join(self.visit_dir, traces.TRACE_FILENAME)
+        self.assertTrue(isfile(trace_path))
+        self.assertEqual(len(np.load(trace_path, mmap_mode='r')), 4)
+        self.assertEqual(traces.convert_crawl(self.tempdir, workers=1), (0, 1, 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
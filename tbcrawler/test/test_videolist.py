@@ -0,0 +1,55 @@
+import os
+import tempfile
+import unittest
+from os.path import isfile, join
+from shutil import rmtree
+
+from tbcrawler.videolist import VideoList, INDEX_SUFFIX
+
+TEST_VIDEO_LIST = """# youtube
+https://www.youtube.com/watch?v=a,120
+
+https://vimeo.com/641878345,295
+https://vimeo.com/140473645
+https://vimeo.com/193568879,266
+"""
+
+
+class VideoListTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = join(self.tempdir, 'videos.txt')
+        with open(self.path, 'w') as f:
+            f.write(TEST_VIDEO_LIST)
+
+    def tearDown(self):
+        rmtree(self.tempdir)
+
+    def test_entries(self):
+        videos = VideoList(self.path)
+        self.assertEqual(len(videos), 4)
+        self.assertEqual(videos[0], ('https://www.youtube.com/watch?v=a', 120))
+        self.assertEqual(videos[3], ('https://vimeo.com/193568879', 266))
+        self.assertTrue(isfile(self.path + INDEX_SUFFIX))
+
+    def test_malformed_entry(self):
+        self.assertIsNone(VideoList(self.path)[2])
+
+    def test_slice(self):
+        videos = VideoList(self.path, start=2, stop=3)
+        self.assertEqual(list(videos), [('https://vimeo.com/641878345', 295),
+                                        None])
+        self.assertRaises(IndexError, videos.__getitem__, 2)
+
+    def test_index_is_rebuilt(self):
+        VideoList(self.path)
+        with open(self.path, 'a') as f:
+            f.write("https://rumble.com/v1,100\n")
+        os.utime(self.path, ns=(0, 0))
+        videos = VideoList(self.path)
+        self.assertEqual(len(videos), 5)
+        self.assertEqual(videos[4], ('https://rumble.com/v1', 100))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,109 @@
+import unittest
+
+from selenium.common.exceptions import (JavascriptException,
+                                        NoSuchElementException,
+                                        TimeoutException)
+
+from tbcrawler import waits
+
+
+class FakeDriver(object):
+    def __init__(self, results):
+        self.results = list(results)
+
+    def execute_script(self, script):
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+class FakeButton(object):
+    def is_displayed(self):
+        return True
+
+    def is_enabled(self):
+        return True
+
+
+class FakeFrame(object):
+    def __init__(self, displayed):
+        self.displayed = displayed
+
+    def is_displayed(self):
+        return self.displayed
+
+
+class FakeAdDriver(object):
+    """A page with an ad frame, hidden or not, whose skip button shows
+    after `skip_after` polls, and a video that plays from the start."""
+
+    def __init__(self, skip_after=None, frame=True):
+        self.switch_to = self
+        self.frame_shown = frame
+        self.skip_after = skip_after
+        self.polls = 0
+        self.in_frame = False
+
+    def default_content(self):
+        self.in_frame = False
+
+    def frame(self, frame):
+        self.in_frame = True
+
+    def find_elements(self, by, value):
+        self.polls += 1
+        return [FakeFrame(self.frame_shown)]
+
+    def find_element(self, by, value):
+        if self.skip_after is not None and self.polls > self.skip_after:
+            return FakeButton()
+        raise NoSuchElementException()
+
+    def execute_script(self, script):
+        return True  # the ad, or the video, plays
+
+
+class WaiterTest(unittest.TestCase):
+    def test_returns_when_condition_holds(self):
+        driver = FakeDriver([JavascriptException(), False, True])
+        waiter = waits.Waiter(driver)
+        self.assertTrue(waiter.until('playing', waits.video_playing(), 5))
+        self.assertEqual(len(waiter.latencies), 1)
+        wait = waiter.latencies[0]
+        self.assertEqual((wait['name'], wait['met']), ('playing', True))
+        self.assertLess(wait['latency'], 5)
+
+    def test_timeout(self):
+        latencies = []
+        waiter = waits.Waiter(FakeDriver([False] * 100), latencies)
+        self.assertIsNone(waiter.until('playing', waits.video_playing(), 0.3))
+        self.assertFalse(latencies[0]['met'])
+        self.assertGreaterEqual(latencies[0]['latency'], 0.3)
+
+    def test_required_timeout_raises(self):
+        waiter = waits.Waiter(FakeDriver([False] * 100))
+        with self.assertRaises(TimeoutException):
+            waiter.until('playing', waits.video_playing(), 0.3, required=True)
+        self.assertEqual(len(waiter.latencies), 1)
+
+    def test_ad_skipped_while_it_plays(self):
+        driver = FakeAdDriver(skip_after=2)
+        waiter = waits.Waiter(driver)
+        button = waiter.until('ad', waits.ad_skip_or_playback(('xpath', 'b')), 5)
+        self.assertIsInstance(button, FakeButton)
+        self.assertTrue(driver.in_frame)
+
+    def test_ad_not_skippable(self):
+        waiter = waits.Waiter(FakeAdDriver())
+        self.assertIsNone(waiter.until(
+            'ad', waits.ad_skip_or_playback(('xpath', 'b')), 0.3))
+
+    def test_video_plays_without_ad(self):
+        waiter = waits.Waiter(FakeAdDriver(frame=False))
+        self.assertTrue(waiter.until(
+            'ad', waits.ad_skip_or_playback(('xpath', 'b')), 5))
+
+
+if __name__ == "__main__":
+    unittest.main()
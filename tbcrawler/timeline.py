@@ -0,0 +1,108 @@
+"""A per-visit timeline of the Tor events.
+
+`EventTimeline` listens to the CIRC, STREAM, BW and STATUS_CLIENT
+events of a Tor controller. stem calls it on the controller's event
+thread, so the crawl thread makes no control port calls for it. While a
+visit is recorded, every event is appended to a JSON lines file in the
+visit directory, one compact object per event:
+
+  {"t": 1700000000.123, "e": "circ", "id": "12", "status": "BUILT", ...}
+  {"t": 1700000001.002, "e": "bw", "read": 52110, "written": 1204}
+
+`t` is when the event arrived. BW events come every second with the
+bytes read and written in that second, which gives the throughput; the
+CIRC and STREAM events give the circuit builds and closes and when the
+streams were attached, and through which exit.
+"""
+import json
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+from stem.control import EventType
+
+EVENTS = (EventType.CIRC, EventType.STREAM, EventType.BW,
+          EventType.STATUS_CLIENT)
+# the events counted in the summary of a visit
+COUNTED = {('circ', 'BUILT'): 'circuits_built',
+           ('circ', 'FAILED'): 'circuits_failed',
+           ('stream', 'SUCCEEDED'): 'streams_succeeded',
+           ('stream', 'FAILED'): 'streams_failed'}
+
+
+def event_record(event):
+    """Return the timeline record of a stem event."""
+    if event.type == EventType.CIRC:
+        record = {'e': 'circ', 'id': event.id, 'status': event.status,
+                  'purpose': event.purpose, 'reason': event.reason,
+                  'path': [fingerprint for fingerprint, _ in event.path or []]}
+    elif event.type == EventType.STREAM:
+        record = {'e': 'stream', 'id': event.id, 'status': event.status,
+                  'circ': event.circ_id, 'target': event.target,
+                  'reason': event.reason}
+    elif event.type == EventType.BW:
+        record = {'e': 'bw', 'read': event.read, 'written': event.written}
+    else:
+        record = {'e': 'status', 'action': event.action,
+                  'args': event.arguments or None}
+    record = {key: value for key, value in record.items()
+              if value is not None and value != []}
+    record['t'] = round(event.arrived_at, 3)
+    return record
+
+
+class EventTimeline(object):
+    """Writes the Tor events of a controller to the current visit's file."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.f = None
+        self.counts = Counter()
+        self.circuits = {}  # id: path, of the circuits built so far
+        self.exits = Counter()
+
+    def attach(self, controller):
+        controller.add_event_listener(self._on_event, *EVENTS)
+
+    @contextmanager
+    def record(self, path):
+        """Write the events to `path` while the block runs.
+
+        Yields a dictionary that is filled, when the block ends, with
+        the number of circuits built and failed, streams succeeded and
+        failed, bytes read and written, and the `exit` fingerprint of
+        the circuits most streams succeeded on.
+        """
+        summary = {}
+        with self.lock:
+            self.f = open(path, 'w')
+            self.counts = Counter()
+            self.exits = Counter()
+        try:
+            yield summary
+        finally:
+            with self.lock:
+                self.f.close()
+                self.f = None
+                summary.update(self.counts)
+                if self.exits:
+                    summary['exit'] = self.exits.most_common(1)[0][0]
+
+    def _on_event(self, event):
+        record = event_record(event)
+        with self.lock:
+            if record['e'] == 'circ' and record['status'] == 'BUILT':
+                self.circuits[record['id']] = record.get('path')
+            elif record['e'] == 'circ' and record['status'] == 'CLOSED':
+                self.circuits.pop(record['id'], None)
+            if self.f is None:
+                return
+            if (record['e'], record.get('status')) == ('stream', 'SUCCEEDED') \
+                    and self.circuits.get(record.get('circ')):
+                self.exits[self.circuits[record['circ']][-1]] += 1
+            self.f.write(json.dumps(record, separators=(',', ':')) + '\n')
+            if record['e'] == 'bw':
+                self.counts['bytes_read'] += record['read']
+                self.counts['bytes_written'] += record['written']
+            elif (record['e'], record.get('status')) in COUNTED:
+                self.counts[COUNTED[record['e'], record['status']]] += 1
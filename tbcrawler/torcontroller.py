@@ -1,15 +1,24 @@
 import shutil
+import tempfile
+import threading
 from contextlib import contextmanager
+from time import sleep, time
 from os import environ
 from os.path import join, isfile, isdir, dirname
 
 import stem.process
+from stem import ControllerError, Signal
 from stem.control import Controller
 from stem.util import term
 from tbselenium.common import DEFAULT_TOR_DATA_PATH, DEFAULT_TOR_BINARY_PATH
 
 import tbcrawler.common as cm
 import tbcrawler.utils as ut
+from tbcrawler.deadlines import deadline
+from tbcrawler.metrics import span
+from tbcrawler.relays import (RelayIndex, bridge_addresses,
+                               entry_guard_fingerprints)
+from tbcrawler.timeline import EventTimeline
 
 
 class TorController(object):
@@ -18,7 +27,8 @@ class TorController(object):
                  tor_binary_path=None,
                  tor_data_path=None,
                  torrc_dict={'controlport': '9051', 'socksport': '9050'},
-                 pollute=True):
+                 pollute=True,
+                 standby=False):
         assert (tbb_path or tor_binary_path and tor_data_path)
         if tbb_path:
             tbb_path = tbb_path.rstrip('/')
@@ -31,28 +41,93 @@ class TorController(object):
         self.tor_data_path = tor_data_path
         self.torrc_dict = torrc_dict
         self.controller = None
+        self.relays = RelayIndex()
+        self.timeline = EventTimeline()
+        self.excluded_exits = None
         self.tmp_tor_data_dir = None
         self.tor_process = None
         self.pollute = pollute
         self.control_port = int(self.torrc_dict['controlport'])
         self.socks_port = int(self.torrc_dict['socksport'])
+        self.base_ports = (self.socks_port, self.control_port)
+        # with standby, each Tor process runs on its own copy of the data dir
+        self.standby = standby
+        self.standby_tor = None
         self.export_lib_path()
 
     def get_guard_ips(self):
+        """Return the addresses of the first hops of the open circuits."""
         ips = []
         for circ in self.controller.get_circuits():
             # filter empty circuits out
             if len(circ.path) == 0:
                 continue
-            ip = self.controller.get_network_status(circ.path[0][0]).address
-            if ip not in ips:
-                ips.append(ip)
+            fingerprint = circ.path[0][0]
+            relay = self.relays.get(fingerprint)
+            if relay is not None:
+                addresses = relay.addresses
+            else:
+                # not in the consensus we have, e.g. a bridge
+                try:
+                    addresses = [self.controller.get_network_status(fingerprint).address]
+                except ControllerError:
+                    continue
+            for ip in addresses:
+                if ip not in ips:
+                    ips.append(ip)
         return ips
 
     def get_all_guard_ips(self):
-        for router_status in self.controller.get_network_statuses():
-            if 'Guard' in router_status.flags:
-                yield router_status.address
+        """Return the addresses of all the guards in the consensus."""
+        return self.relays.guards()
+
+    def get_entry_addresses(self):
+        """Return the addresses the Tor process connects to directly: its
+        entry guards, bridges and the first hops of its circuits.
+
+        Returns None if some cannot be known, e.g. with snowflake bridges.
+        """
+        addresses = set(self.get_guard_ips())
+        if self.controller.get_conf('UseBridges', '0') == '1':
+            bridges = bridge_addresses(self.controller.get_conf('Bridge', [],
+                                                                multiple=True))
+            if bridges is None:
+                return None
+            addresses.update(bridges)
+        else:
+            for fingerprint in entry_guard_fingerprints(
+                    self.controller.get_info('entry-guards', '')):
+                relay = self.relays.get(fingerprint)
+                if relay is not None:
+                    addresses.update(relay.addresses)
+        return sorted(addresses)
+
+    def new_identity(self):
+        """Signal NEWNYM, so that new streams use new circuits. Tor
+        accepts it once every few seconds, so this may wait.
+
+        NEWNYM only marks the circuits dirty: the open streams, e.g. the
+        keep-alive connections of a browser, stay on them. These are
+        closed, so that the browser reconnects through new circuits."""
+        sleep(self.controller.get_newnym_wait())
+        self.controller.signal(Signal.NEWNYM)
+        self.close_all_streams()
+
+    def exclude_exits(self, fingerprints):
+        """Keep new streams away from these exit relays, besides the
+        `ExcludeExitNodes` of the torrc."""
+        fingerprints = tuple(fingerprints)
+        if fingerprints == self.excluded_exits:
+            return
+        nodes = [value for key, value in self.torrc_dict.items()
+                 if key.lower() == 'excludeexitnodes']
+        nodes += ['$' + fingerprint for fingerprint in fingerprints]
+        if nodes:
+            self.controller.set_conf('ExcludeExitNodes', ','.join(nodes))
+        else:
+            self.controller.reset_conf('ExcludeExitNodes')
+        self.excluded_exits = fingerprints
+        print("Excluding %d exits" % len(fingerprints))
 
     def tor_log_handler(self, line):
         print(term.format(line))
@@ -75,10 +150,21 @@ class TorController(object):
             print("Removing tmp tor data dir")
             shutil.rmtree(self.tmp_tor_data_dir)
 
+    def clone_data_dir(self):
+        """Return a temporary clone of the Tor data directory."""
+        start = time()
+        tmp_root = ut.tmpfs_dir() if cm.TOR_DATA_ON_TMPFS else None
+        data_dir = tempfile.mkdtemp(prefix='tor_data_', dir=tmp_root)
+        counts = ut.clone_dir(self.tor_data_path, data_dir, cm.TOR_LINKED_FILES)
+        print("Cloned Tor data dir to %s in %.3f s (%d linked, %d reflinked, "
+              "%d copied)" % (data_dir, time() - start, counts['linked'],
+                              counts['reflinked'], counts['copied']))
+        return data_dir
+
     def launch_tor_service(self):
         """Launch Tor service and return the process."""
-        if self.pollute:
-            self.tmp_tor_data_dir = ut.clone_dir_temporary(self.tor_data_path)
+        if self.pollute or self.standby:
+            self.tmp_tor_data_dir = self.clone_data_dir()
             self.torrc_dict.update({'DataDirectory': self.tmp_tor_data_dir})
 
         print("Tor config: %s" % self.torrc_dict)
@@ -87,30 +173,186 @@ class TorController(object):
             config=self.torrc_dict,
             init_msg_handler=self.tor_log_handler,
             tor_cmd=self.tor_binary_path,
-            timeout=270
+            timeout=cm.TOR_BOOTSTRAP_TIMEOUT
         )
+        self.connect()
+        return self.tor_process
+
+    def connect(self):
         self.controller = Controller.from_port(port=self.control_port)
         self.controller.authenticate()
-        return self.tor_process
+        self.excluded_exits = None  # maybe another Tor process
+        self.relays.attach(self.controller)
+        self.timeline.attach(self.controller)
+
+    def reconnect(self):
+        """Replace the control connection, e.g. from another thread to
+        unblock a call that hangs on the current one."""
+        controller = self.controller
+        self.connect()
+        controller.close()
+
+    def prepare_standby(self):
+        """Bootstrap the Tor process of the next batch in the background.
+
+        The standby process runs on the ports the current process does
+        not use, and the next `launch` swaps to it.
+        """
+        if not self.standby or self.standby_tor is not None:
+            return
+        if (self.socks_port, self.control_port) == self.base_ports:
+            socks_port, control_port = [port + cm.STANDBY_PORT_OFFSET
+                                        for port in self.base_ports]
+        else:
+            socks_port, control_port = self.base_ports
+        torrc_dict = dict(self.torrc_dict, socksport=str(socks_port),
+                          controlport=str(control_port))
+        self.standby_tor = StandbyTor(self, torrc_dict)
+        self.standby_tor.start()
+
+    def wake_standby(self):
+        """Let the standby Tor process bootstrap, once the captures of
+        the current batch are over, during the pause between batches."""
+        if self.standby_tor is not None:
+            self.standby_tor.enable_network()
+
+    def _swap_to_standby(self):
+        """Make the standby Tor process the current one, if it is ready."""
+        standby_tor, self.standby_tor = self.standby_tor, None
+        standby_tor.join(max(standby_tor.deadline - time(), 0))
+        if standby_tor.is_alive() or standby_tor.tor_process is None:
+            print("Standby Tor not ready: %s" % standby_tor.error)
+            standby_tor.abandon()
+            return False
+        self.tor_process = standby_tor.tor_process
+        self.tmp_tor_data_dir = standby_tor.data_dir
+        self.torrc_dict = standby_tor.torrc_dict
+        self.socks_port = int(self.torrc_dict['socksport'])
+        self.control_port = int(self.torrc_dict['controlport'])
+        self.connect()
+        start = time()
+        if not self._enable_network(cm.TOR_BOOTSTRAP_TIMEOUT):
+            print("Standby Tor did not bootstrap, relaunching")
+            self.quit()
+            return False
+        # the bootstrap is only hidden by the time since the network was on
+        network_time = (start - standby_tor.network_on
+                        if standby_tor.network_on else 0.)
+        print("Swapped to standby Tor, started in %.1f s, network on %.1f s "
+              "before the swap, waited %.1f s for the bootstrap"
+              % (standby_tor.start_time, network_time, time() - start))
+        return True
+
+    def _enable_network(self, timeout):
+        """Turn on the network of a Tor process started without it, and
+        wait until it has bootstrapped."""
+        try:
+            self.controller.set_conf('DisableNetwork', '0')
+            with deadline(timeout):
+                while 'PROGRESS=100' not in self.controller.get_info(
+                        'status/bootstrap-phase'):
+                    sleep(cm.WAIT_POLL_INTERVAL)
+        except (ControllerError, cm.TimeoutException) as exc:
+            print("Cannot bootstrap: %s" % exc)
+            return False
+        return True
+
+    def close(self):
+        """Kill the standby Tor process, if any, at the end of a crawl."""
+        if self.standby_tor is not None:
+            self.standby_tor.abandon()
+            self.standby_tor = None
 
     def close_all_streams(self):
         """Close all streams of a controller."""
         print("Closing all streams")
         try:
-            with ut.timeout(cm.STREAM_CLOSE_TIMEOUT):
+            with deadline(cm.STREAM_CLOSE_TIMEOUT, [self.reconnect]):
                 for stream in self.controller.get_streams():
                     print("Closing stream %s %s %s " %
                           (stream.id, stream.purpose, stream.target_address))
                     self.controller.close_stream(stream.id)  # MISC reason
-        except ut.TimeoutException:
+        except cm.TimeoutException:
             print("Closing streams timed out!")
         except:
             print("Exception closing stream")
 
     @contextmanager
     def launch(self):
-        self.launch_tor_service()
+        with span('tor_launch'):
+            if self.standby_tor is None or not self._swap_to_standby():
+                self.launch_tor_service()
         yield
-        self.quit()
+        with span('tor_quit'):
+            self.quit()
+
+
+class StandbyTor(threading.Thread):
+    """Launches a Tor process in a background thread.
+
+    The process starts with `DisableNetwork 1`, so that it makes no
+    connection while the current batch is captured. `enable_network`
+    turns its network on once the captures of the batch are over, and the
+    swap waits for what is left of the bootstrap.
+    stem can only enforce its launch timeout in the main thread, so the
+    thread runs without one and a process that is not ready by the
+    deadline is abandoned: it is killed as soon as its launch returns.
+    """
+
+    def __init__(self, tor_controller, torrc_dict):
+        super(StandbyTor, self).__init__(name="standby-tor", daemon=True)
+        self.tor_binary_path = tor_controller.tor_binary_path
+        self.data_dir = tor_controller.clone_data_dir()
+        self.torrc_dict = dict(torrc_dict, DataDirectory=self.data_dir)
+        self.deadline = time() + cm.TOR_BOOTSTRAP_TIMEOUT
+        self.tor_process = None
+        self.start_time = None
+        self.network_on = None
+        self.error = None
+        self.abandoned = False
+        self.lock = threading.Lock()
+
+    def run(self):
+        start = time()
+        try:
+            tor_process = stem.process.launch_tor_with_config(
+                config=dict(self.torrc_dict, DisableNetwork='1'),
+                tor_cmd=self.tor_binary_path,
+                completion_percent=0,
+                timeout=None)
+        except Exception as exc:
+            self.error = exc
+            return
+        with self.lock:
+            if self.abandoned:
+                tor_process.kill()
+                return
+            self.tor_process = tor_process
+            self.start_time = time() - start
+
+    def enable_network(self):
+        """Turn on the network of the process, if it has started."""
+        with self.lock:
+            if self.tor_process is None or self.abandoned:
+                return
+        try:
+            controller = Controller.from_port(
+                port=int(self.torrc_dict['controlport']))
+            with controller:
+                controller.authenticate()
+                controller.set_conf('DisableNetwork', '0')
+        except Exception as exc:
+            print("Cannot turn on the network of the standby Tor: %s" % exc)
+            return
+        self.network_on = time()
+
+    def abandon(self):
+        """Kill the process, now or when its launch eventually returns."""
+        with self.lock:
+            self.abandoned = True
+            if self.tor_process:
+                self.tor_process.kill()
+        if isdir(self.data_dir):
+            shutil.rmtree(self.data_dir, ignore_errors=True)
 
 
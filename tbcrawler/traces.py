@@ -0,0 +1,277 @@
+"""Convert the captures of a crawl into (time, direction, size) traces.
+
+Every capture.pcap in a crawl results tree is turned into a trace.npy
+next to it: a NumPy structured array that `numpy.load(path,
+mmap_mode='r')` maps without reading it. Captures are converted in a
+process pool, and visits whose trace is newer than their capture are
+skipped.
+"""
+import argparse
+import mmap
+import os
+import socket
+import struct
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from os.path import getmtime, isfile, join
+
+import numpy as np
+
+from tbcrawler import pcaputils as pu
+
+TRACE_FILENAME = 'trace.npy'
+PCAP_FILENAME = 'capture.pcap'
+TRACE_DTYPE = np.dtype([('time', '<f8'), ('direction', 'i1'), ('size', '<u4')])
+OUTGOING = 1
+INCOMING = -1
+
+# records whose headers are gathered at once, bounds the memory per chunk
+CHUNK_RECORDS = 1 << 18
+# bytes gathered per packet: Ethernet, one VLAN tag and an IPv6 header
+GATHER_LEN = 14 + 4 + 40
+# mixes the two halves of an IPv6 address into one integer for lookups
+IPV6_MIX = np.uint64(0x9e3779b97f4a7c15)
+
+
+def record_offsets(buf, endian, start=pu.PCAP_HEADER_LEN):
+    """Return the offsets of all complete records in a pcap buffer."""
+    incl_len_at = struct.Struct(endian + 'I').unpack_from
+    offsets = []
+    append = offsets.append
+    pos = start
+    end = len(buf) - pu.RECORD_HEADER_LEN
+    while pos <= end:
+        next_pos = pos + pu.RECORD_HEADER_LEN + incl_len_at(buf, pos + 8)[0]
+        if next_pos > len(buf):
+            break  # partial record at the end of the capture
+        append(pos)
+        pos = next_pos
+    return np.array(offsets, dtype=np.int64)
+
+
+def _gather(data, offsets, length):
+    index = offsets[:, None] + np.arange(length)
+    np.minimum(index, len(data) - 1, out=index)
+    return data[index]
+
+
+def _be_uint(columns):
+    value = np.zeros(len(columns), dtype=np.uint64)
+    for i in range(columns.shape[1]):
+        value = (value << np.uint64(8)) | columns[:, i].astype(np.uint64)
+    return value
+
+
+def _ipv6_key(columns):
+    return _be_uint(columns[:, :8]) ^ (_be_uint(columns[:, 8:]) * IPV6_MIX)
+
+
+def address_keys(ips):
+    """Return the lookup keys of IPv4 and IPv6 addresses, as two arrays."""
+    v4, v6 = [], []
+    for ip in ips:
+        if ':' in ip:
+            packed = np.frombuffer(socket.inet_pton(socket.AF_INET6, ip),
+                                   dtype=np.uint8)[None, :]
+            v6.append(_ipv6_key(packed)[0])
+        else:
+            v4.append(struct.unpack('!I', socket.inet_aton(ip))[0])
+    return np.array(v4, dtype=np.uint64), np.array(v6, dtype=np.uint64)
+
+
+def parse_headers(data, offsets, endian, linktype, nanoseconds):
+    """Return the timestamp, size, protocol and address keys of records.
+
+    Works on whole arrays of record offsets at once. Source and
+    destination are IPv4 addresses as integers, or mixed IPv6 keys
+    (see `address_keys`); `is_ip` marks IPv4/IPv6 packets whose headers
+    fit in the snapshot length.
+    """
+    rec = _gather(data, offsets, pu.RECORD_HEADER_LEN).copy()
+    rec = rec.view(endian + 'u4')
+    ts = rec[:, 0] + rec[:, 1] * (1e-9 if nanoseconds else 1e-6)
+    incl_len, orig_len = rec[:, 2].astype(np.int64), rec[:, 3]
+
+    pkt = _gather(data, offsets + pu.RECORD_HEADER_LEN, GATHER_LEN)
+    rows = np.arange(len(offsets))
+    if linktype == pu.LINKTYPE_ETHERNET:
+        l3 = np.full(len(offsets), 14)
+        ethertype = pkt[:, 12].astype(np.int64) << 8 | pkt[:, 13]
+        vlan = np.isin(ethertype, pu.ETHERTYPES_VLAN)
+        ethertype[vlan] = pkt[vlan, 16].astype(np.int64) << 8 | pkt[vlan, 17]
+        l3[vlan] += 4
+    elif linktype == pu.LINKTYPE_LINUX_SLL:
+        l3 = np.full(len(offsets), 16)
+        ethertype = pkt[:, 14].astype(np.int64) << 8 | pkt[:, 15]
+    elif linktype in (pu.LINKTYPE_RAW, pu.LINKTYPE_IPV4, pu.LINKTYPE_IPV6):
+        l3 = np.zeros(len(offsets), dtype=np.int64)
+        ethertype = np.where(pkt[:, 0] >> 4 == 6, pu.ETHERTYPE_IPV6,
+                             pu.ETHERTYPE_IPV4)
+    else:
+        raise pu.PcapFormatError("Unsupported link type %s" % linktype)
+
+    is_v4 = (ethertype == pu.ETHERTYPE_IPV4) & (incl_len >= l3 + 20)
+    is_v6 = (ethertype == pu.ETHERTYPE_IPV6) & (incl_len >= l3 + 40)
+    col = l3[:, None]
+    l3_bytes = pkt[rows[:, None], np.minimum(col + np.arange(40),
+                                             GATHER_LEN - 1)]
+    proto = np.where(is_v6, l3_bytes[:, 6], l3_bytes[:, 9])
+    src = np.where(is_v6, _ipv6_key(l3_bytes[:, 8:24]),
+                   _be_uint(l3_bytes[:, 12:16]))
+    dst = np.where(is_v6, _ipv6_key(l3_bytes[:, 24:40]),
+                   _be_uint(l3_bytes[:, 16:20]))
+    return {'time': ts, 'size': orig_len, 'proto': proto, 'is_v6': is_v6,
+            'is_ip': is_v4 | is_v6, 'src': src, 'dst': dst}
+
+
+def _in(keys, is_v6, v4_keys, v6_keys):
+    return np.where(is_v6, np.isin(keys, v6_keys), np.isin(keys, v4_keys))
+
+
+def infer_local_keys(headers):
+    """Return the address in most packets, i.e. the capturing host."""
+    v4_keys = np.empty(0, dtype=np.uint64)
+    v6_keys = np.empty(0, dtype=np.uint64)
+    ip = headers['is_ip']
+    if not ip.any():
+        return v4_keys, v6_keys
+    addrs = np.concatenate([headers['src'][ip], headers['dst'][ip]])
+    is_v6 = np.concatenate([headers['is_v6'][ip]] * 2)
+    values, counts = np.unique(np.stack([addrs, is_v6]), axis=1,
+                               return_counts=True)
+    key, v6 = values[:, counts.argmax()]
+    if v6:
+        return v4_keys, np.array([key], dtype=np.uint64)
+    return np.array([key], dtype=np.uint64), v6_keys
+
+
+def pcap_to_trace(pcap_path, local_ips=None, guard_ips=None,
+                  protocols=(pu.PROTO_TCP, pu.PROTO_UDP)):
+    """Return the trace of a capture as a `TRACE_DTYPE` array.
+
+    With `guard_ips`, only packets to or from a guard are kept and
+    packets to a guard are outgoing. Otherwise direction is relative to
+    `local_ips`, or to the address that appears in most packets.
+    """
+    with open(pcap_path, 'rb') as f:
+        records = pu.PcapRecords(f)
+        if os.fstat(f.fileno()).st_size <= pu.PCAP_HEADER_LEN:
+            return np.empty(0, dtype=TRACE_DTYPE)
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        chunks = _trace_chunks(buf, records, local_ips, guard_ips, protocols)
+    finally:
+        buf.close()
+    if not chunks:
+        return np.empty(0, dtype=TRACE_DTYPE)
+    return np.concatenate(chunks)
+
+
+def _trace_chunks(buf, records, local_ips, guard_ips, protocols):
+    data = np.frombuffer(buf, dtype=np.uint8)
+    offsets = record_offsets(buf, records.endian)
+    local_keys = address_keys(local_ips) if local_ips else None
+    guard_keys = address_keys(guard_ips) if guard_ips else None
+    chunks = []
+    for first in range(0, len(offsets), CHUNK_RECORDS):
+        headers = parse_headers(data, offsets[first:first + CHUNK_RECORDS],
+                                records.endian, records.linktype,
+                                records.nanoseconds)
+        keep = headers['is_ip'] & np.isin(headers['proto'], protocols)
+        is_v6 = headers['is_v6']
+        if guard_keys is not None:
+            outgoing = _in(headers['dst'], is_v6, *guard_keys)
+            incoming = _in(headers['src'], is_v6, *guard_keys)
+        else:
+            if local_keys is None:
+                local_keys = infer_local_keys(headers)
+            outgoing = _in(headers['src'], is_v6, *local_keys)
+            incoming = _in(headers['dst'], is_v6, *local_keys)
+        keep &= outgoing | incoming
+        chunk = np.empty(int(keep.sum()), dtype=TRACE_DTYPE)
+        chunk['time'] = headers['time'][keep]
+        chunk['direction'] = np.where(outgoing[keep], OUTGOING, INCOMING)
+        chunk['size'] = headers['size'][keep]
+        chunks.append(chunk)
+    return chunks
+
+
+def needs_conversion(pcap_path, trace_path):
+    return not isfile(trace_path) or getmtime(trace_path) < getmtime(pcap_path)
+
+
+def convert(pcap_path, local_ips=None, guard_ips=None):
+    """Write the trace of a capture next to it, return its length."""
+    trace = pcap_to_trace(pcap_path, local_ips, guard_ips)
+    trace_path = join(os.path.dirname(pcap_path), TRACE_FILENAME)
+    tmp_path = trace_path + '.tmp.npy'
+    np.save(tmp_path, trace)
+    os.replace(tmp_path, trace_path)
+    return len(trace)
+
+
+def find_captures(crawl_dir):
+    """Yield the captures in a crawl results tree."""
+    for dirpath, _, filenames in os.walk(crawl_dir):
+        if PCAP_FILENAME in filenames:
+            yield join(dirpath, PCAP_FILENAME)
+
+
+def convert_crawl(crawl_dir, workers=None, local_ips=None, guard_ips=None,
+                  force=False):
+    """Convert the captures of a crawl in a process pool.
+
+    Returns the number of converted, skipped and failed captures.
+    """
+    converted = skipped = failed = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for pcap_path in find_captures(crawl_dir):
+            trace_path = join(os.path.dirname(pcap_path), TRACE_FILENAME)
+            if not force and not needs_conversion(pcap_path, trace_path):
+                skipped += 1
+                continue
+            futures[pool.submit(convert, pcap_path, local_ips,
+                                guard_ips)] = pcap_path
+        for future in as_completed(futures):
+            try:
+                future.result()
+                converted += 1
+            except Exception as exc:
+                print("Cannot convert %s: %s" % (futures[future], exc),
+                      file=sys.stderr)
+                failed += 1
+    return converted, skipped, failed
+
+
+def read_ips(path):
+    with open(path) as f:
+        return [line.strip() for line in f
+                if line.strip() and not line.startswith('#')]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Convert the captures of a crawl into traces.')
+    parser.add_argument('crawl_dir', help='Crawl results directory.')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='Number of processes (default: one per CPU).')
+    parser.add_argument('--local', nargs='+', default=None,
+                        help='Local addresses (default: the most common one).')
+    parser.add_argument('--guards', default=None,
+                        help='File with one guard IP per line; only traffic '
+                             'to these guards is kept.')
+    parser.add_argument('-f', '--force', action='store_true', default=False,
+                        help='Convert captures that already have a trace.')
+    args = parser.parse_args(argv)
+    guard_ips = read_ips(args.guards) if args.guards else None
+    converted, skipped, failed = convert_crawl(args.crawl_dir, args.jobs,
+                                               args.local, guard_ips,
+                                               args.force)
+    print("%d converted, %d already converted, %d failed"
+          % (converted, skipped, failed))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,15 +1,15 @@
-import signal
-from contextlib import contextmanager
-from distutils.dir_util import copy_tree
+import errno
+import fcntl
+import os
+import tempfile
 from os import makedirs
-from os.path import exists
-from shutil import copyfile, rmtree
-
-from scapy.all import PcapReader, wrpcap
-from scapy.layers.inet import IP
+from os.path import exists, isdir, join
+from shutil import copyfile, copymode, rmtree
 
 import psutil
+from tbcrawler import pcaputils
 from tbcrawler.common import TimeoutException
+from tbcrawler.deadlines import deadline
 
 
 def create_dir(dir_path):
@@ -23,11 +23,68 @@ def delete_dir(dir_path):
     if exists(dir_path):
         rmtree(dir_path)
 
-def clone_dir_temporary(dir_path):
-    """Makes a temporary copy of a directory."""
-    import tempfile
-    tempdir = tempfile.mkdtemp()
-    copy_tree(dir_path, tempdir)
+FICLONE = 0x40049409  # ioctl that reflinks a whole file (btrfs, xfs...)
+
+
+def reflink(src, dst):
+    """Make `dst` a copy-on-write clone of `src`; False if unsupported."""
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError as exc:
+            if exc.errno in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV,
+                             errno.EINVAL, errno.EBADF, errno.EPERM):
+                return False
+            raise
+    return True
+
+
+def clone_dir(src_dir, dst_dir, link_names=()):
+    """Copy the contents of a directory tree into `dst_dir`, cheaply.
+
+    Files named in `link_names` must only ever be replaced (written to a
+    new file and renamed), never modified in place: they are hard-linked,
+    or symlinked when `dst_dir` is on another file system. The other files
+    are reflinked where the file system supports it, and copied
+    otherwise. Returns how many files were linked, reflinked and copied.
+    """
+    counts = {'linked': 0, 'reflinked': 0, 'copied': 0}
+    for name in os.listdir(src_dir):
+        src, dst = join(src_dir, name), join(dst_dir, name)
+        if isdir(src):
+            makedirs(dst, exist_ok=True)
+            copymode(src, dst)
+            for key, count in clone_dir(src, dst, link_names).items():
+                counts[key] += count
+            continue
+        if name in link_names:
+            try:
+                os.link(src, dst)
+            except OSError:
+                os.symlink(os.path.abspath(src), dst)
+            counts['linked'] += 1
+            continue
+        if reflink(src, dst):
+            counts['reflinked'] += 1
+        else:
+            copyfile(src, dst)
+            counts['copied'] += 1
+        copymode(src, dst)
+    return counts
+
+
+def tmpfs_dir():
+    """A writable tmpfs directory for temporary files, or None."""
+    for path in ('/dev/shm',):
+        if isdir(path) and os.access(path, os.W_OK | os.X_OK):
+            return path
+    return None
+
+
+def clone_dir_temporary(dir_path, link_names=(), tmp_root=None):
+    """Makes a temporary copy of a directory (see `clone_dir`)."""
+    tempdir = tempfile.mkdtemp(dir=tmp_root)
+    clone_dir(dir_path, tempdir, link_names)
     return tempdir
 
 
@@ -50,10 +107,21 @@ def get_dict_subconfig(config, section, prefix):
             for option in config.options(section) if option.startswith(prefix)}
 
 
-def filter_pcap(pcap_path, iplist):
+def filter_pcap(pcap_path, iplist, keep_original=True):
     """
     Filter capture by TCP packets addressed to any address in ``iplist``
     """
+    return pcaputils.filter_pcap(pcap_path, iplist, keep_original=keep_original)
+
+
+def filter_pcap_scapy(pcap_path, iplist):
+    """
+    Filter capture by TCP packets addressed to any address in ``iplist``,
+    decoding every packet with scapy (slow, kept for comparison).
+    """
+    from scapy.all import PcapReader, wrpcap
+    from scapy.layers.inet import IP
+
     pcap_filtered = []
     orig_pcap = pcap_path + ".original"
     copyfile(pcap_path, orig_pcap)
@@ -67,15 +135,7 @@ def filter_pcap(pcap_path, iplist):
     wrpcap(pcap_path, pcap_filtered)
 
 
-@contextmanager
 def timeout(seconds):
-    """From: http://stackoverflow.com/a/601168/1336939"""
-    def signal_handler(signum, frame):
-        raise TimeoutException("Timed out!")
-
-    signal.signal(signal.SIGALRM, signal_handler)
-    signal.alarm(seconds)
-    try:
-        yield
-    finally:
-        signal.alarm(0)
+    """Raise TimeoutException in the block after `seconds`, in any thread
+    (see tbcrawler.deadlines)."""
+    return deadline(seconds)
@@ -0,0 +1,130 @@
+import os
+import struct
+from array import array
+from sys import maxsize
+
+from tbcrawler.log import wl_log
+
+INDEX_SUFFIX = '.idx'
+INDEX_MAGIC = b'TBVL'
+INDEX_VERSION = 1
+# magic, version, size and mtime of the indexed video list
+INDEX_HEADER = struct.Struct('<4sIQQ')
+INDEX_ENTRY = struct.Struct('=Q')  # native order, as written by array
+
+
+class VideoList(object):
+    """Lazy view on the (url, playback time) entries of a video list file.
+
+    Entries are the lines of the form url,length_in_seconds that are
+    neither empty nor comments. A sidecar index next to the list keeps
+    the byte offset of every entry, so an entry is read with one seek
+    whatever the size of the list, and the index is only rebuilt when
+    the list changes. Only the entries between `start` and `stop`
+    (1-based, inclusive, as in the command line) are visible.
+
+    A malformed entry is reported and yields None instead of a tuple.
+    """
+
+    def __init__(self, path, start=1, stop=maxsize):
+        self.path = path
+        self.index_path = path + INDEX_SUFFIX
+        self._file = None
+        self._index_file = None
+        self._index = None
+        self._pid = None
+        self._cached = (None, None)
+        num_entries = self._load_index()
+        self.first = min(start - 1, num_entries)
+        self.last = min(stop, num_entries)
+
+    def _source_stamp(self):
+        st = os.stat(self.path)
+        return st.st_size, st.st_mtime_ns
+
+    def _load_index(self):
+        """Open the sidecar index, building it if it is missing or stale."""
+        size, mtime = self._source_stamp()
+        try:
+            with open(self.index_path, 'rb') as f:
+                magic, version, idx_size, idx_mtime = \
+                    INDEX_HEADER.unpack(f.read(INDEX_HEADER.size))
+            if (magic, version, idx_size, idx_mtime) == \
+                    (INDEX_MAGIC, INDEX_VERSION, size, mtime):
+                self._index = None  # entries are read from the file
+                return (os.path.getsize(self.index_path) -
+                        INDEX_HEADER.size) // INDEX_ENTRY.size
+        except (OSError, struct.error):
+            pass
+        offsets = self.build_index()
+        try:
+            tmp_path = self.index_path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION,
+                                          size, mtime))
+                offsets.tofile(f)
+            os.replace(tmp_path, self.index_path)
+        except OSError as exc:
+            wl_log.warning("Cannot write video list index %s: %s",
+                           self.index_path, exc)
+            self._index = offsets  # keep it in memory instead
+        return len(offsets)
+
+    def build_index(self):
+        """Return the byte offsets of the entries in the video list."""
+        offsets = array('Q')
+        offset = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                stripped = line.strip()
+                if stripped and not stripped.startswith(b'#'):
+                    offsets.append(offset)
+                offset += len(line)
+        return offsets
+
+    def _handles(self):
+        # files are reopened after a fork, e.g. by parallel workers
+        if self._pid != os.getpid():
+            self._file = open(self.path, 'rb')
+            self._index_file = None
+            if self._index is None:
+                self._index_file = open(self.index_path, 'rb')
+            self._pid = os.getpid()
+        return self._file, self._index_file
+
+    def _offset(self, entry):
+        if self._index is not None:
+            return self._index[entry]
+        _, index_file = self._handles()
+        index_file.seek(INDEX_HEADER.size + entry * INDEX_ENTRY.size)
+        return INDEX_ENTRY.unpack(index_file.read(INDEX_ENTRY.size))[0]
+
+    def _read_entry(self, entry):
+        video_file, _ = self._handles()
+        video_file.seek(self._offset(entry))
+        line = video_file.readline().decode('utf-8', 'replace').strip()
+        try:
+            parts = line.split(',')
+            return parts[0].strip(), int(parts[1])
+        except (IndexError, ValueError):
+            wl_log.warning("Skipping malformed entry %s of %s: %r",
+                           entry + 1, self.path, line)
+            return None
+
+    def __len__(self):
+        return max(self.last - self.first, 0)
+
+    def __getitem__(self, site):
+        if not 0 <= site < len(self):
+            raise IndexError("site %s out of range" % site)
+        if self._cached[0] != site:
+            self._cached = (site, self._read_entry(self.first + site))
+        return self._cached[1]
+
+    def __iter__(self):
+        for site in range(len(self)):
+            yield self[site]
+
+    def __repr__(self):
+        return "VideoList(%s, entries %s-%s)" % (self.path, self.first + 1,
+                                                 self.last)
@@ -0,0 +1,118 @@
+from time import time
+
+from selenium.common.exceptions import TimeoutException, WebDriverException
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support.ui import WebDriverWait
+
+import tbcrawler.common as cm
+from tbcrawler.log import wl_log
+
+VIDEO_PLAYING_JS = """
+var video = document.querySelector('video');
+return !!video && !video.paused && video.currentTime > 0;
+"""
+PLAYER_API_JS = """
+var player = document.getElementById('movie_player');
+return !!player && typeof player.getPlayerState === 'function';
+"""
+
+
+class Waiter(object):
+    """Waits for conditions on the page and measures how long each took.
+
+    Every wait returns as soon as its condition holds, or after its
+    timeout. Each wait is logged and appended to `latencies` as a dict
+    with its name, latency in seconds and whether the condition was met.
+    """
+
+    def __init__(self, driver, latencies=None):
+        self.driver = driver
+        self.latencies = [] if latencies is None else latencies
+
+    def until(self, name, condition, timeout, required=False):
+        """Return the value of `condition` once it holds, or None after
+        `timeout` seconds. With `required`, TimeoutException is raised
+        instead."""
+        start = time()
+        wait = WebDriverWait(self.driver, timeout,
+                             poll_frequency=cm.WAIT_POLL_INTERVAL)
+        try:
+            value = wait.until(condition)
+        except TimeoutException:
+            value = None
+        latency = time() - start
+        met = value is not None
+        self.latencies.append({'name': name, 'latency': round(latency, 3),
+                               'met': met})
+        wl_log.info("Waited %.2f s for %s (%s)", latency, name,
+                    'met' if met else 'timed out')
+        if required and not met:
+            raise TimeoutException("Timed out waiting for %s" % name)
+        return value
+
+
+def script_true(script):
+    """Condition that holds when `script` returns a truthy value."""
+    def _predicate(driver):
+        try:
+            return driver.execute_script(script) or False
+        except WebDriverException:
+            return False
+    return _predicate
+
+
+def video_playing():
+    return script_true(VIDEO_PLAYING_JS)
+
+
+def player_api_ready():
+    return script_true(PLAYER_API_JS)
+
+
+def clickable_in_frame(locator, frame_locator=(By.TAG_NAME, 'iframe')):
+    """Condition that holds when the element at `locator` inside the
+    first frame at `frame_locator` can be clicked.
+
+    When the condition holds the driver is left in that frame, so the
+    caller must switch back to the default content afterwards.
+    """
+    def _predicate(driver):
+        driver.switch_to.default_content()
+        try:
+            frames = driver.find_elements(*frame_locator)
+            if frames:
+                driver.switch_to.frame(frames[0])
+                element = driver.find_element(*locator)
+                if element.is_displayed() and element.is_enabled():
+                    return element
+        except WebDriverException:
+            pass
+        driver.switch_to.default_content()
+        return False
+    return _predicate
+
+
+def ad_skip_or_playback(skip_locator, frame_locator=(By.TAG_NAME, 'iframe')):
+    """Condition that holds with the skip button of an ad in the first
+    frame at `frame_locator` once it can be clicked, or with True once
+    no such frame is displayed and the video plays: while the ad frame
+    is there, a playing video may be the ad itself.
+
+    As with `clickable_in_frame`, the driver is left in the frame when
+    the button is returned.
+    """
+    skip_button = clickable_in_frame(skip_locator, frame_locator)
+    playing = video_playing()
+
+    def _predicate(driver):
+        element = skip_button(driver)
+        if element:
+            return element
+        try:
+            if any(frame.is_displayed()
+                   for frame in driver.find_elements(*frame_locator)):
+                return False
+        except WebDriverException:
+            return False
+        return playing(driver)
+    return _predicate